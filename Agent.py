@@ -3,7 +3,7 @@ import torch
 import numpy as np
 import numpy.random as rd
 from Net import QNet, QNetTwin
-from Net import Actor, ActorSAC, ActorPPO
+from Net import Actor, ActorSAC, ActorPPO, ActorCriticPPO
 from Net import Critic, CriticAdv, CriticTwin
 
 
@@ -216,6 +216,8 @@ class AgentTD3(AgentDDPG):
 
 
 class AgentPPO(AgentBase):
+    if_on_policy = True  # ReplayBufferCPU and no explore_before_train(), the subclasses inherit it
+
     def __init__(self, net_dim, state_dim, action_dim, learning_rate=1e-4):
         super().__init__()
         self.clip = 0.25  # ratio.clamp(1 - clip, 1 + clip)
@@ -262,14 +264,10 @@ class AgentPPO(AgentBase):
             buf_reward, buf_mask, buf_action, buf_noise, buf_state = buffer.sample_for_ppo()
 
             bs = 2 ** 10  # set a smaller 'bs: batch size' when out of GPU memory.
-            buf_value = torch.cat([self.cri(buf_state[i:i + bs]) for i in range(0, buf_state.size(0), bs)], dim=0)
+            buf_value = torch.cat([self.get_value(buf_state[i:i + bs]) for i in range(0, buf_state.size(0), bs)], dim=0)
             buf_log_prob = -(buf_noise.pow(2).__mul__(0.5) + self.act.a_std_log + self.act.sqrt_2pi_log).sum(1)
 
-<<<<<<< HEAD
-            buf_r_sum = torch.empty(max_memo, dtype=torch.float32, device=self.device)  # old policy value
-=======
             buf_r_sum = torch.empty(max_memo, dtype=torch.float32, device=self.device)  # reward sum
->>>>>>> 19e6346769ffd3ec2ae636434913fa4d958b2052
             pre_r_sum = 0  # reward sum of previous step
             for i in range(max_memo - 1, -1, -1):
                 buf_r_sum[i] = buf_reward[i] + buf_mask[i] * pre_r_sum
@@ -288,17 +286,12 @@ class AgentPPO(AgentBase):
             log_prob = buf_log_prob[indices]
             advantage = buf_advantage[indices]
 
-            new_log_prob = self.act.compute__log_prob(state, action)  # it is obj_actor
+            new_log_prob, value = self.compute__log_prob_value(state, action)  # value: predict the reward_sum
             ratio = (new_log_prob - log_prob).exp()
             obj_surrogate1 = advantage * ratio
             obj_surrogate2 = advantage * ratio.clamp(1 - self.clip, 1 + self.clip)
             obj_actor = -torch.min(obj_surrogate1, obj_surrogate2).mean()
 
-<<<<<<< HEAD
-            value = self.cri(state).squeeze(1)  # critic network predicts the reward_sum value of state
-=======
-            value = self.cri(state).squeeze(1)  # critic network predicts the reward_sum (Q value) of state
->>>>>>> 19e6346769ffd3ec2ae636434913fa4d958b2052
             obj_critic = self.criterion(value, r_sum)
 
             obj_united = obj_actor + obj_critic / (r_sum.std() + 1e-5)
@@ -309,6 +302,29 @@ class AgentPPO(AgentBase):
         self.obj_a = obj_actor.item()
         self.obj_c = obj_critic.item()
 
+    def get_value(self, state):  # the critic network predicts the reward_sum (Q value) of state
+        return self.cri(state)
+
+    def compute__log_prob_value(self, state, action):  # the log_prob of action and the value of state
+        return self.act.compute__log_prob(state, action), self.cri(state).squeeze(1)
+
+
+class AgentSharedPPO(AgentPPO):  # PPO with ActorCriticPPO: the actor and critic share a trunk
+    def __init__(self, net_dim, state_dim, action_dim, learning_rate=1e-4):
+        AgentBase.__init__(self)
+        self.clip = 0.25  # ratio.clamp(1 - clip, 1 + clip)
+
+        self.act = ActorCriticPPO(net_dim, state_dim, action_dim).to(self.device)
+
+        self.criterion = torch.nn.SmoothL1Loss()
+        self.optimizer = torch.optim.Adam(self.act.parameters(), lr=learning_rate)
+
+    def get_value(self, state):
+        return self.act.get_value(state)
+
+    def compute__log_prob_value(self, state, action):  # one forward of the shared trunk
+        return self.act.compute__log_prob_value(state, action)
+
 
 class AgentSAC(AgentBase):
     def __init__(self, net_dim, state_dim, action_dim, learning_rate=1e-4):
@@ -367,3 +383,10 @@ class AgentSAC(AgentBase):
 def soft_target_update(target, current, tau=5e-3):
     for target_param, param in zip(target.parameters(), current.parameters()):
         target_param.data.copy_(tau * param.data + (1.0 - tau) * target_param.data)
+
+
+def get_actor(agent_rl, net_dim, env, actor_path):  # the actor on CPU, the workers do not share a GPU
+    act = agent_rl(net_dim, env.state_dim, env.action_dim).act.to('cpu')
+    act.load_state_dict(torch.load(actor_path, map_location='cpu'))
+    act.eval()
+    return act
@@ -0,0 +1,212 @@
+import os
+import time
+import torch
+import numpy as np
+import multiprocessing as mp
+from Agent import get_actor
+
+
+def run__walk_forward(npy_path='./FinanceMultiStock.npy', actor_path=None, agent_rl=None, net_dim=2 ** 8,
+                      retrain_args=None, train_len=2 ** 9, valid_len=2 ** 7, test_len=2 ** 7, step_len=None,
+                      worker_num=None, cwd='./backtest'):
+    """walk-forward backtest of FinanceMultiStockEnv in parallel worker processes
+
+    The market data is split into rolling (train, valid, test) windows. For each window, a worker
+    evaluates the saved actor (actor_path, built by agent_rl(net_dim, ...)) on the valid and test days,
+    or retrains an agent on the train days first (retrain_args: the Arguments of train_and_evaluate,
+    the trained actor is `cwd/window{i}/actor.pth`). Return the portfolio metrics of each window and of
+    the test windows chained into one backtest.
+    """
+    from Env import FinanceMultiStockEnv
+    env = FinanceMultiStockEnv(npy_path=npy_path)  # build the cache of the market data before forking
+    windows = get_walk_forward_windows(env.ary.shape[0], train_len, valid_len, test_len, step_len)
+    assert windows, f'| run__walk_forward: {env.ary.shape[0]} days are not enough for one window'
+    if retrain_args is None:
+        assert actor_path is not None and agent_rl is not None
+    os.makedirs(cwd, exist_ok=True)
+
+    cpu_ids = sorted(os.sched_getaffinity(0))
+    worker_num = min(len(windows), len(cpu_ids)) if worker_num is None else worker_num
+    cpus_per_worker = max(1, len(cpu_ids) // worker_num)
+    cpu_sets = [cpu_ids[i * cpus_per_worker:(i + 1) * cpus_per_worker] or cpu_ids for i in range(worker_num)]
+
+    start_time = time.time()
+    ctx = mp.get_context('fork')  # the workers inherit env and retrain_args, the memory maps are shared
+    task_queue = ctx.SimpleQueue()
+    result_queue = ctx.SimpleQueue()
+    workers = [ctx.Process(target=mp__backtest_worker, args=(
+        env, windows, actor_path, agent_rl, net_dim, retrain_args, cwd, cpu_set, task_queue, result_queue))
+               for cpu_set in cpu_sets]
+    [worker.start() for worker in workers]
+
+    for window_id in range(len(windows)):
+        task_queue.put(window_id)
+    for _ in workers:
+        task_queue.put(None)  # stop signal
+
+    results = sorted((result_queue.get() for _ in windows), key=lambda result: result[0])
+    [worker.join() for worker in workers]
+    errors = [result for result in results if result[1] is not None]
+    assert not errors, f'| run__walk_forward: {errors}'
+
+    valid_assets, valid_trades = (np.stack([result[2][i] for result in results]) for i in range(2))
+    test_assets, test_trades = (np.stack([result[3][i] for result in results]) for i in range(2))
+    chain_assets, chain_trades = chain_backtests(test_assets, test_trades, step_len is None or step_len == test_len)
+
+    backtest = {'windows': windows,
+                'valid': get_portfolio_metrics(valid_assets, valid_trades),
+                'test': get_portfolio_metrics(test_assets, test_trades),
+                'chain': get_portfolio_metrics(chain_assets, chain_trades),
+                'chain_assets': chain_assets,
+                'used_time': time.time() - start_time}
+    np.savez(f'{cwd}/backtest.npz', valid_assets=valid_assets, test_assets=test_assets, chain_assets=chain_assets)
+    print_backtest(backtest)
+    return backtest
+
+
+def mp__backtest_worker(env, windows, actor_path, agent_rl, net_dim, retrain_args, cwd, cpu_set,
+                        task_queue, result_queue):
+    os.sched_setaffinity(0, cpu_set)
+    torch.set_num_threads(len(cpu_set))
+    act = None if retrain_args is not None else get_actor(agent_rl, net_dim, env, actor_path)
+
+    while True:
+        window_id = task_queue.get()
+        if window_id is None:
+            break
+        train, valid, test = windows[window_id]
+
+        try:
+            if retrain_args is not None:
+                args = retrain_window(retrain_args, env, train, f'{cwd}/window{window_id}', len(cpu_set))
+                act = get_actor(args.agent_rl, args.net_dim, env, f'{args.cwd}/actor.pth')
+            result = (window_id, None, backtest_window(env, act, *valid), backtest_window(env, act, *test))
+        except Exception as exception:  # report the window, keep the other windows going
+            result = (window_id, repr(exception), None, None)
+        result_queue.put(result)
+
+
+def retrain_window(retrain_args, env, train, cwd, num_threads):
+    from copy import deepcopy
+    from Main import train_and_evaluate
+    args = deepcopy(retrain_args)
+    args.env = get_window_env(env, *train)
+    args.cwd = cwd
+    args.gpu_id = 0 if args.gpu_id is None else args.gpu_id
+    args.if_remove = True
+    args.max_step = args.env.max_step
+    args.num_threads = num_threads
+    train_and_evaluate(args)
+    return args
+
+
+def get_window_env(env, beg, end):  # a copy of env on the days in [beg, end), sharing the market data
+    from copy import deepcopy
+    env = deepcopy(env)
+    env.ary = env.ary[beg:end]
+    env.state_ary = env.state_ary[beg:end]
+    env.max_step = end - beg
+    return env
+
+
+'''backtest'''
+
+
+def get_walk_forward_windows(day_num, train_len, valid_len, test_len, step_len=None) -> list:
+    """rolling (train, valid, test) windows, each a range of days [beg, end), moved forward by step_len days
+
+    A window trades on the days in [beg, end) and values the portfolio on day `end`, so `end < day_num`.
+    The test windows do not overlap when step_len == test_len (default), and they chain into one backtest.
+    """
+    step_len = test_len if step_len is None else step_len
+    windows = list()
+    beg = 0
+    while beg + train_len + valid_len + test_len < day_num:
+        train = (beg, beg + train_len)
+        valid = (train[1], train[1] + valid_len)
+        test = (valid[1], valid[1] + test_len)
+        windows.append((train, valid, test))
+        beg += step_len
+    return windows
+
+
+def backtest_window(env, act, beg, end) -> (np.ndarray, np.ndarray):
+    """trade on the days in [beg, end) with the deterministic actions of act, starting with env.initial_account
+
+    Return total_assets [end - beg + 1] (before each day and on day `end`) and trade_values [end - beg]
+    (the value of the stocks bought or sold on each day).
+    """
+    total_assets = np.empty(end - beg + 1)
+    trade_values = np.empty(end - beg)
+    state = env.reset(day=beg, account=env.initial_account)
+    total_assets[0] = env.initial_account
+    with torch.no_grad():
+        for i in range(end - beg):
+            prices = env.day_npy[:env.stock_dim]
+            stocks = env.stocks.copy()
+            action = act(torch.as_tensor(state).unsqueeze(0)).numpy()[0]
+            state = env.step(action)[0]
+            trade_values[i] = np.dot(prices, np.abs(env.stocks - stocks))
+            total_assets[i + 1] = env.total_asset
+    return total_assets, trade_values
+
+
+def chain_backtests(total_assets, trade_values, if_chain=True):
+    """the test windows [window_num, day_num + 1] as one backtest: each window starts with the assets
+    the last one ends with. Return the first window if the windows overlap (step_len < test_len)
+    """
+    if not if_chain:
+        return total_assets[0], trade_values[0]
+    scales = np.cumprod(np.concatenate(((1.0,), total_assets[:-1, -1] / total_assets[:-1, 0])))  # [window_num]
+    chain_assets = np.concatenate((total_assets[0, :1], (total_assets[:, 1:] * scales[:, None]).ravel()))
+    chain_trades = (trade_values * scales[:, None]).ravel()
+    return chain_assets, chain_trades
+
+
+def get_portfolio_metrics(total_assets, trade_values, days_per_year=252) -> dict:
+    """the metrics of many backtests at once, over the last axis: total_assets [..., day_num + 1],
+    trade_values [..., day_num]
+
+    cumulative_return: of the whole backtest, sharpe: annualized Sharpe ratio of the daily returns
+    (risk-free rate 0), max_drawdown: the largest loss from a peak, turnover: the daily traded value
+    over the average total asset
+    """
+    returns = total_assets[..., 1:] / total_assets[..., :-1] - 1
+    return_std = returns.std(axis=-1)
+    peaks = np.maximum.accumulate(total_assets, axis=-1)
+    return {'cumulative_return': total_assets[..., -1] / total_assets[..., 0] - 1,
+            'sharpe': returns.mean(axis=-1) / np.where(return_std > 0, return_std, np.inf) * days_per_year ** 0.5,
+            'max_drawdown': (1 - total_assets / peaks).max(axis=-1),
+            'turnover': trade_values.mean(axis=-1) / total_assets.mean(axis=-1)}
+
+
+def print_backtest(backtest):
+    valid, test, chain = backtest['valid'], backtest['test'], backtest['chain']
+    print(f"| {'ID':>3}  {'Test':>11}  {'ValidR':>7}  {'TestR':>7}  {'Sharpe':>6}  {'MaxDD':>6}  {'Turnover':>8}")
+    for i, (_, _, test_days) in enumerate(backtest['windows']):
+        print(f"| {i:3}  {test_days[0]:5}-{test_days[1]:<5}  {valid['cumulative_return'][i]:7.3f}  "
+              f"{test['cumulative_return'][i]:7.3f}  {test['sharpe'][i]:6.2f}  {test['max_drawdown'][i]:6.3f}  "
+              f"{test['turnover'][i]:8.4f}")
+    print(f"| Chain: {len(backtest['chain_assets']) - 1} days, return {chain['cumulative_return']:.3f}, "
+          f"Sharpe {chain['sharpe']:.2f}, MaxDD {chain['max_drawdown']:.3f}, turnover {chain['turnover']:.4f}, "
+          f"UsedTime {backtest['used_time']:.1f}s")
+
+
+def run__walk_forward_demo(day_num=252 * 10, stock_dim=30, cwd='./backtest_demo'):
+    """a 10-year daily backtest of a (randomly initialized) PPO actor on synthetic market data"""
+    import Agent
+    from Env import FinanceMultiStockEnv, make_synthetic_market_data
+    os.makedirs(cwd, exist_ok=True)
+    npy_path = f'{cwd}/SyntheticStock.npy'
+    make_synthetic_market_data(npy_path, day_num, stock_dim)
+
+    env = FinanceMultiStockEnv(npy_path=npy_path)
+    agent = Agent.AgentPPO(2 ** 8, env.state_dim, env.action_dim)
+    torch.save(agent.act.state_dict(), f'{cwd}/actor.pth')
+
+    run__walk_forward(npy_path, actor_path=f'{cwd}/actor.pth', agent_rl=Agent.AgentPPO, net_dim=2 ** 8,
+                      train_len=252 * 2, valid_len=126, test_len=126, cwd=cwd)
+
+
+if __name__ == '__main__':
+    run__walk_forward_demo()
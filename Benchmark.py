@@ -0,0 +1,428 @@
+"""Component microbenchmark suite
+
+python3 Benchmark.py [filter]
+Each component is measured in isolation at several sizes, the seconds per call are written to
+`benchmark.json`, and compared with `benchmark_baseline.json` (copy a trusted benchmark.json to it)
+to flag the regressions slower than (1 + threshold) times the baseline.
+"""
+import os
+import sys
+import json
+import time
+import torch
+import numpy as np
+import numpy.random as rd
+from Profiler import measure
+
+
+'''components'''
+
+
+def bench__replay_buffer(results, name_filter='', state_dims=(8, 181), batch_sizes=(2 ** 7, 2 ** 10)):
+    from Main import ReplayBufferGPU, ReplayBufferCPU
+    action_dim = 4
+    for state_dim in state_dims:
+        buffer = ReplayBufferGPU(2 ** 16, state_dim, action_dim)
+        state = rd.randn(state_dim).astype(np.float32)
+        other = rd.randn(2 + action_dim).astype(np.float32)
+
+        def func():
+            buffer.append_memo(state, other)
+
+        name = f'ReplayBufferGPU/append_memo/state_dim={state_dim}'
+        if name_filter in name:
+            results[name] = measure(func)
+
+        buffer.all_state.normal_()
+        buffer.all_other.normal_()
+        buffer.if_full = True
+        buffer.update__now_len__before_sample()
+        for batch_size in batch_sizes:
+            name = f'ReplayBufferGPU/random_sample/state_dim={state_dim}/batch={batch_size}'
+            if name_filter in name:
+                results[name] = measure(lambda: buffer.random_sample(batch_size))
+
+    for max_len in (2 ** 12, 2 ** 14):
+        for state_dim in state_dims:
+            name = f'ReplayBufferCPU/sample_for_ppo/state_dim={state_dim}/max_len={max_len}'
+            if name_filter not in name:
+                continue
+            buffer = ReplayBufferCPU(max_len, state_dim, action_dim)
+            buffer.all_state[:] = rd.randn(*buffer.all_state.shape)
+            buffer.all_other[:] = rd.randn(*buffer.all_other.shape)
+            buffer.next_idx = max_len
+            buffer.update__now_len__before_sample()
+            results[name] = measure(buffer.sample_for_ppo)
+
+
+def bench__net(results, name_filter='', net_dims=(2 ** 7, 2 ** 8, 2 ** 9), batch_size=2 ** 7):
+    import Net
+    state_dim, action_dim = 24, 4
+    state = torch.randn((batch_size, state_dim))
+    action = torch.randn((batch_size, action_dim)).tanh()
+
+    for net_dim in net_dims:
+        nets = {'QNet': (Net.QNet(net_dim, state_dim, action_dim), (state,)),
+                'QNetTwin': (Net.QNetTwin(net_dim, state_dim, action_dim), (state,)),
+                'Actor': (Net.Actor(net_dim, state_dim, action_dim), (state,)),
+                'ActorSAC': (Net.ActorSAC(net_dim, state_dim, action_dim), (state,)),
+                'ActorPPO': (Net.ActorPPO(net_dim, state_dim, action_dim), (state,)),
+                'Critic': (Net.Critic(net_dim, state_dim, action_dim), (state, action)),
+                'CriticAdv': (Net.CriticAdv(state_dim, net_dim), (state,)),
+                'CriticTwin': (Net.CriticTwin(net_dim, state_dim, action_dim), (state, action))}
+        for net_name, (net, inputs) in nets.items():
+            names = (f'Net/{net_name}/forward/net_dim={net_dim}/batch={batch_size}',
+                     f'Net/{net_name}/backward/net_dim={net_dim}/batch={batch_size}')
+
+            def forward():
+                with torch.no_grad():
+                    net(*inputs)
+
+            def forward_backward():
+                net.zero_grad()
+                net(*inputs).sum().backward()
+
+            for name, func in zip(names, (forward, forward_backward)):
+                if name_filter in name:
+                    results[name] = measure(func)
+
+
+def bench__soft_target_update(results, name_filter='', net_dims=(2 ** 7, 2 ** 8, 2 ** 9)):
+    from copy import deepcopy
+    from Net import CriticTwin
+    from Agent import soft_target_update
+    for net_dim in net_dims:
+        name = f'soft_target_update/CriticTwin/net_dim={net_dim}'
+        if name_filter not in name:
+            continue
+        cri = CriticTwin(net_dim, 24, 4)
+        cri_target = deepcopy(cri)
+        results[name] = measure(lambda: soft_target_update(cri_target, cri))
+
+
+def bench__agent(results, name_filter='', net_dims=(2 ** 7, 2 ** 8), batch_size=2 ** 7):
+    import Agent
+    from Main import ReplayBufferGPU, ReplayBufferCPU
+    state_dim, action_dim = 24, 4
+    update_step = 2 ** 4  # gradient steps in one update_policy() call of off-policy agents
+
+    for agent_rl in (Agent.AgentDQN, Agent.AgentDoubleDQN, Agent.AgentDDPG, Agent.AgentTD3,
+                     Agent.AgentSAC, Agent.AgentPPO):
+        if_discrete = agent_rl.__name__ in {'AgentDQN', 'AgentDoubleDQN'}
+        if_on_policy = getattr(agent_rl, 'if_on_policy', False)
+        buffer_action_dim = 1 if if_discrete else action_dim
+
+        for net_dim in net_dims:
+            select_name = f'{agent_rl.__name__}/select_actions/net_dim={net_dim}'
+            update_name = f'{agent_rl.__name__}/update_policy/net_dim={net_dim}/max_memo={2 ** 12}' if if_on_policy \
+                else f'{agent_rl.__name__}/update_policy_step/net_dim={net_dim}/batch={batch_size}'
+            if name_filter not in select_name and name_filter not in update_name:
+                continue
+            torch.manual_seed(0)
+            agent = agent_rl(net_dim, state_dim, action_dim)
+            states = (rd.randn(state_dim).astype(np.float32),)
+            if name_filter in select_name:
+                results[select_name] = measure(lambda: agent.select_actions(states))
+            if name_filter not in update_name:
+                continue
+
+            if if_on_policy:  # one update_policy() call over a full buffer
+                buffer = ReplayBufferCPU(2 ** 12, state_dim, buffer_action_dim)
+                buffer.all_state[:] = rd.randn(*buffer.all_state.shape)
+                buffer.all_other[:] = rd.randn(*buffer.all_other.shape)
+                buffer.all_other[:, 1] = 0.99  # mask
+                buffer.next_idx = buffer.max_len
+                results[update_name] = measure(lambda: agent.update_policy(buffer, 0, 2 ** 8, 1), min_time=0, repeat=3)
+            else:  # one gradient step
+                buffer = ReplayBufferGPU(2 ** 14, state_dim, buffer_action_dim)
+                buffer.all_state.normal_()
+                buffer.all_other.normal_()
+                buffer.all_other[:, 1] = 0.99  # mask
+                if if_discrete:
+                    buffer.all_other[:, 2] = torch.randint(action_dim, size=(buffer.max_len,))
+                buffer.if_full = True
+                update_time = measure(lambda: agent.update_policy(buffer, update_step, batch_size, 1))
+                results[update_name] = update_time / update_step
+
+
+def bench__ppo_shared_trunk(results, name_filter='', net_dims=(2 ** 8, 2 ** 9), max_memo=2 ** 12, batch_size=2 ** 8):
+    """AgentPPO (separate actor and critic) vs AgentSharedPPO (ActorCriticPPO): update_policy() time and memory
+
+    The memory is of the parameters with the Adam states, and of the tensors that autograd saves for backward
+    in the forward of a minibatch (activations, and the weights that the backward needs).
+    """
+    import Agent
+    from Main import ReplayBufferCPU
+    state_dim, action_dim = 24, 4
+    buffer = ReplayBufferCPU(max_memo, state_dim, action_dim)
+    buffer.all_state[:] = rd.randn(*buffer.all_state.shape)
+    buffer.all_other[:] = rd.randn(*buffer.all_other.shape)
+    buffer.all_other[:, 1] = 0.99  # mask
+    buffer.next_idx = buffer.max_len
+
+    for net_dim in net_dims:
+        for agent_rl in (Agent.AgentPPO, Agent.AgentSharedPPO):
+            name = f'{agent_rl.__name__}/update_policy/net_dim={net_dim}/max_memo={max_memo}'
+            if name_filter not in name:
+                continue
+            torch.manual_seed(0)
+            agent = agent_rl(net_dim, state_dim, action_dim)
+            update_time = measure(lambda: agent.update_policy(buffer, 0, batch_size, 1), min_time=0, repeat=3)
+            results[name] = update_time
+
+            saved_bytes = list()
+
+            def pack_hook(tensor):
+                saved_bytes.append(tensor.numel() * tensor.element_size())
+                return tensor
+
+            state = torch.randn(batch_size, state_dim, device=agent.device)
+            action = torch.randn(batch_size, action_dim, device=agent.device)
+            with torch.autograd.graph.saved_tensors_hooks(pack_hook, lambda tensor: tensor):
+                agent.compute__log_prob_value(state, action)
+            param_num = sum(param.numel() for group in agent.optimizer.param_groups for param in group['params'])
+            print(f'| {agent_rl.__name__:<14} net_dim={net_dim:<4} update_policy: {update_time * 1e3:7.1f} ms, '
+                  f'parameters with Adam: {param_num * 4 * 3 / 2 ** 20:5.2f} MB, '
+                  f'saved for backward: {sum(saved_bytes) / 2 ** 20:5.2f} MB per minibatch of {batch_size}')
+
+
+def bench__finance_env(results, name_filter=''):
+    from Env import FinanceMultiStockEnv, FinanceMultiStockVecEnv, execute_orders, execute_orders_loop
+    if not os.path.exists('./FinanceMultiStock.npy'):
+        print('| bench__finance_env: skip, ./FinanceMultiStock.npy not found')
+        return
+
+    env = FinanceMultiStockEnv()
+    env.reset()
+    action = rd.uniform(-1, 1, size=env.action_dim)
+
+    def func():
+        if env.step(action)[2]:  # done
+            env.reset()
+
+    name = f'FinanceMultiStockEnv/step/stock_dim={env.stock_dim}'
+    if name_filter in name:
+        results[name] = measure(func)
+
+    account = env.initial_account
+    stocks = rd.randint(0, env.max_stock, size=env.stock_dim).astype(np.float32)
+    actions = rd.uniform(-1, 1, size=env.stock_dim).astype(np.float32) * env.max_stock
+    prices = env.ary[0, :env.stock_dim]
+    for name, func in ((f'execute_orders_loop/stock_dim={env.stock_dim}', execute_orders_loop),
+                       (f'execute_orders/stock_dim={env.stock_dim}', execute_orders)):
+        if name_filter in name:
+            results[name] = measure(lambda: func(account, stocks.copy(), actions, prices, env.transaction_fee_percent))
+
+    from Agent import AgentDDPG
+    agent = AgentDDPG(2 ** 8, env.state_dim, env.action_dim)
+    for env_num in (1, 2 ** 6, 2 ** 10):
+        names = (f'FinanceMultiStockVecEnv/step/env_num={env_num}',
+                 f'FinanceMultiStockVecEnv/rollout_step/env_num={env_num}')
+        if name_filter not in names[0] and name_filter not in names[1]:
+            continue
+        vec_env = FinanceMultiStockVecEnv(env_num)
+        vec_env.states = vec_env.reset()
+        actions = rd.uniform(-1, 1, size=(env_num, vec_env.action_dim)).astype(np.float32)
+
+        def rollout():  # a batched rollout step: select_actions() of the agent and step() of all portfolios
+            vec_env.states = vec_env.step(agent.select_actions(vec_env.states))[0]
+
+        used_time = measure(lambda: vec_env.step(actions))
+        rollout_time = measure(rollout)
+        results[names[0]] = used_time
+        results[names[1]] = rollout_time
+        print(f'| FinanceMultiStockVecEnv env_num={env_num:<5} env steps/s: {env_num / used_time:9.0f} '
+              f'(with {agent.__class__.__name__}.select_actions: {env_num / rollout_time:9.0f})')
+
+
+def bench__finance_env_scale(results, name_filter='', stock_dims=(30, 500, 3000), day_num=2 ** 9,
+                             cash_rates=(2 ** 6, 2 ** -6)):
+    """FinanceMultiStockEnv on synthetic universes of stock_dim stocks, with ample cash and with little cash
+
+    cash_rates: the cash is cash_rate times 1e6 per 30 stocks (the initial account of FinRL data)
+    ample cash: no buy is cut by the cash in an episode, the step cost is about linear in stock_dim.
+    little cash: it pays for about a fifth of the buys of random actions, as in most steps of an episode of random
+    actions. execute_orders() restarts its cumulative-cost pass after each buy cut by the cash, so its cost grows
+    with the number of cut buys too.
+    """
+    import shutil
+    import tempfile
+    from Env import FinanceMultiStockEnv, execute_orders, execute_orders_loop, make_synthetic_market_data
+    temp_dir = tempfile.mkdtemp()
+    for stock_dim in stock_dims:
+        names_dict = {cash_name: (f'FinanceMultiStockEnv/synthetic_step{cash_name}/stock_dim={stock_dim}',
+                                  f'execute_orders_loop/synthetic{cash_name}/stock_dim={stock_dim}',
+                                  f'execute_orders/synthetic{cash_name}/stock_dim={stock_dim}')
+                      for cash_name in ('', '_cash_limited')}
+        if not any(name_filter in name for names in names_dict.values() for name in names):
+            continue
+        npy_path = f'{temp_dir}/SyntheticStock{stock_dim}.npy'
+        make_synthetic_market_data(npy_path, day_num, stock_dim)
+
+        for cash_name, cash_rate in zip(('', '_cash_limited'), cash_rates):
+            names = names_dict[cash_name]
+            if not any(name_filter in name for name in names):
+                continue
+            initial_account = 1e6 * stock_dim / 30 * cash_rate
+            env = FinanceMultiStockEnv(initial_account=initial_account, npy_path=npy_path)
+            env.reset()
+            step_actions = rd.uniform(-1, 1, size=(2 ** 4, env.action_dim))  # so the stocks bought are sold
+            step_ids = [0]
+
+            def func():
+                step_ids[0] = (step_ids[0] + 1) % len(step_actions)
+                if env.step(step_actions[step_ids[0]])[2]:  # done
+                    env.reset()
+
+            step_time = measure(func)
+
+            account = initial_account
+            stocks = rd.randint(0, env.max_stock, size=stock_dim).astype(np.float32)
+            actions = rd.uniform(-1, 1, size=stock_dim).astype(np.float32) * env.max_stock
+            prices = env.ary[0, :stock_dim]
+            loop_time = measure(lambda: execute_orders_loop(account, stocks.copy(), actions, prices,
+                                                            env.transaction_fee_percent))
+            used_time = measure(lambda: execute_orders(account, stocks.copy(), actions, prices,
+                                                       env.transaction_fee_percent))
+            results.update(zip(names, (step_time, loop_time, used_time)))
+            print(f"| FinanceMultiStockEnv stock_dim={stock_dim:<5} {'little' if cash_name else 'ample':<6} cash "
+                  f"step: {step_time * 1e6:8.1f} us, "
+                  f"execute_orders: {used_time * 1e6:8.1f} us (loop {loop_time * 1e6:8.1f} us)")
+    shutil.rmtree(temp_dir)
+
+
+def bench__synthetic_env(results, name_filter='', env_nums=(1, 2 ** 6, 2 ** 10)):
+    """the synthetic envs: a step of the single env, and a step of the batched env of env_num envs"""
+    from Env import LQREnv, LQRVecEnv, ChainMDPEnv, ChainMDPVecEnv, PointMassEnv, PointMassVecEnv
+    for env_class, vec_env_class in ((LQREnv, LQRVecEnv), (ChainMDPEnv, ChainMDPVecEnv),
+                                     (PointMassEnv, PointMassVecEnv)):
+        name = f'{env_class.__name__}/step'
+        if name_filter in name:
+            env = env_class()
+            env.reset()
+            action = 0 if env.if_discrete else rd.uniform(-1, 1, size=env.action_dim)
+            results[name] = measure(lambda: env.step(action))
+
+        for env_num in env_nums:
+            name = f'{vec_env_class.__name__}/step/env_num={env_num}'
+            if name_filter not in name:
+                continue
+            vec_env = vec_env_class(env_num)
+            vec_env.reset()
+            actions = rd.randint(vec_env.action_dim, size=env_num) if vec_env.if_discrete \
+                else rd.uniform(-1, 1, size=(env_num, vec_env.action_dim))
+            results[name] = measure(lambda: vec_env.step(actions))
+
+
+def bench__vec_env(results, name_filter='', env_nums=(2 ** 2, 2 ** 4)):
+    """SubprocessVecEnv against stepping the same envs in a loop in this process, in env steps/s"""
+    from Env import SubprocessVecEnv, decorate_env, FinanceMultiStockEnv
+
+    def get_gym_env_func(env_name):
+        def env_func():
+            import gym
+            return decorate_env(gym.make(env_name), if_print=False)
+
+        return env_func
+
+    env_funcs = {'LunarLanderContinuous-v2': get_gym_env_func('LunarLanderContinuous-v2'),
+                 'BipedalWalker-v3': get_gym_env_func('BipedalWalker-v3'),
+                 'FinanceStock-v1': FinanceMultiStockEnv}
+    for env_name, env_func in env_funcs.items():
+        names_dict = {env_num: (f'step_in_process/{env_name}/env_num={env_num}',
+                                f'SubprocessVecEnv/step/{env_name}/env_num={env_num}') for env_num in env_nums}
+        env_nums_ = [env_num for env_num, names in names_dict.items() if any(name_filter in name for name in names)]
+        if not env_nums_:  # before gym is imported
+            continue
+        try:
+            env = env_func()
+            env.step(rd.uniform(-1, 1, size=env.action_dim).astype(np.float32) if not env.if_discrete else 0)
+        except Exception as error:  # gym, box2d-py or the data is not installed
+            print(f'| bench__vec_env: skip {env_name}, {repr(error)[:64]}')
+            continue
+
+        for env_num in env_nums_:
+            envs = [env_func() for _ in range(env_num)]
+            [env.reset() for env in envs]
+            vec_env = SubprocessVecEnv(env_func, env_num)
+            vec_env.reset()
+            actions = rd.uniform(-1, 1, size=(env_num, vec_env.action_dim)).astype(np.float32)
+
+            def step_in_process():
+                for env, action in zip(envs, actions):
+                    if env.step(action)[2]:  # done
+                        env.reset()
+
+            loop_time = measure(step_in_process)
+            used_time = measure(lambda: vec_env.step(actions))
+            worker_num = len(vec_env.workers)
+            vec_env.close()
+            results.update(zip(names_dict[env_num], (loop_time, used_time)))
+            print(f'| {env_name:<24} env_num={env_num:<3} env steps/s: in process {env_num / loop_time:9.0f}, '
+                  f'SubprocessVecEnv {env_num / used_time:9.0f} ({worker_num} workers)')
+
+
+'''suite'''
+
+
+def run__benchmark(name_filter='', json_path='./benchmark.json', baseline_path='./benchmark_baseline.json',
+                   threshold=0.25):
+    torch.set_num_threads(1)  # less noisy
+    torch.manual_seed(0)
+    rd.seed(0)
+    from Env import check__execute_orders
+    check__execute_orders()  # needs no market data, it runs before the timings of execute_orders()
+
+    results = dict()
+    for bench in (bench__replay_buffer, bench__net, bench__soft_target_update, bench__agent, bench__ppo_shared_trunk,
+                  bench__finance_env,
+                  bench__finance_env_scale, bench__synthetic_env, bench__vec_env):
+        bench_results = dict()
+        bench(bench_results, name_filter)  # a bench skips the work of the results that name_filter drops
+        results.update({name: value for name, value in bench_results.items() if name_filter in name})
+
+    meta = {'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'torch': torch.__version__,
+            'numpy': np.__version__,
+            'num_threads': torch.get_num_threads(),
+            'device': 'cuda' if torch.cuda.is_available() else 'cpu'}
+    with open(json_path, 'w') as f:
+        json.dump({'meta': meta, 'results': results}, f, indent=1)
+    print(f'| Save benchmark results in: {json_path}')
+
+    if os.path.exists(baseline_path):
+        with open(baseline_path, 'r') as f:
+            baseline = json.load(f)['results']
+        regressions = compare_with_baseline(results, baseline, threshold)
+    else:
+        print(f'| No baseline file: {baseline_path}')
+        print_results(results)
+        regressions = list()
+    return regressions
+
+
+def compare_with_baseline(results, baseline, threshold=0.25):
+    regressions = list()
+    print(f"| {'Name':<64}  {'Base(us)':>10}  {'Now(us)':>10}  {'Ratio':>6}")
+    for name, used_time in results.items():
+        if name not in baseline:
+            print(f"| {name:<64}  {'-':>10}  {used_time * 1e6:10.1f}  {'-':>6}")
+            continue
+        ratio = used_time / baseline[name]
+        if_regress = ratio > 1 + threshold
+        if if_regress:
+            regressions.append(name)
+        print(f"| {name:<64}  {baseline[name] * 1e6:10.1f}  {used_time * 1e6:10.1f}  {ratio:6.2f}"
+              + ('  REGRESSION' if if_regress else ''))
+    print(f'| Regressions (slower than {1 + threshold:.2f}x baseline): {len(regressions)}')
+    return regressions
+
+
+def print_results(results):
+    print(f"| {'Name':<64}  {'Now(us)':>10}")
+    for name, used_time in results.items():
+        print(f"| {name:<64}  {used_time * 1e6:10.1f}")
+
+
+if __name__ == '__main__':
+    sys.exit(1 if run__benchmark(name_filter=sys.argv[1] if len(sys.argv) > 1 else '') else 0)
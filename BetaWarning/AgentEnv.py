@@ -75,6 +75,77 @@ def get_gym_env_info(env, if_print) -> (str, int, int, float, bool, float):
     return env_name, state_dim, action_dim, action_max, if_discrete, target_reward
 
 
+def execute_orders(account, stocks, actions, prices, fee_percent) -> float:  # a copy of Env.execute_orders()
+    """buy or sell stocks in index order, update `stocks` in place and return the account
+
+    The same as the loop over stocks: sell `-action` (at most the held stocks) if action <= 0, and buy `action`
+    (at most `account // price`) if action > 0, with the cash left by the orders before it.
+    A cumulative-cost pass gives the cash before each order up to the first buy cut by the cash. The cut buy takes
+    what the cash pays for, then the pass restarts after it, so a cut costs a few array operations instead of a
+    loop over the stocks. Buys are cut in most steps of random actions (the cash runs out), and after a cut the
+    cash left cannot pay for one share of most buys, so that pass adds the sells only, up to the first buy it pays
+    for one share of. A pass covers 2 ** 6 orders, doubled each time it finds no cut.
+    """
+    deltas = np.maximum(actions, -stocks)  # the change of stocks if no buy is cut by the cash
+    values = np.multiply(prices, deltas, dtype=np.float64)  # float64: a rounding error may cut a buy by one share
+    costs = values + np.abs(values) * fee_percent  # buy: value * (1 + fee), sell: value * (1 - fee)
+    costs_before = np.cumsum(costs) - costs  # the costs of the orders before each order
+    if_buys = actions > 0
+
+    cut_ids = np.flatnonzero(if_buys & ((account - costs_before) // prices < actions))
+    if cut_ids.size == 0:
+        stocks += deltas
+        return account - float(costs_before[-1] + costs[-1])
+
+    stock_dim = len(actions)
+    sell_costs = np.minimum(costs, 0)
+    sell_deltas = np.minimum(deltas, 0)  # the buys of a sell-only pass get no share
+    costs_before = np.append(costs_before, costs_before[-1] + costs[-1])  # [stock_dim + 1], the last one is all
+    sells_before = np.append(0.0, np.cumsum(sell_costs))  # the costs of the sells before
+    # a pass from `start` with cash_base = account + costs_before[start] (sell-only: + sells_before[start]): the cash
+    # before order i is cash_base - costs_before[i] (sell-only: - sells_before[i]), so the buy of i is cut if
+    # cash_base < cut_cashes[i], and the cash pays for one share of it if cash_base >= one_cashes[i]
+    cut_cashes = np.where(if_buys, np.ceil(actions) * prices + costs_before[:-1], -np.inf)
+    one_cashes = np.where(if_buys, prices + sells_before[:-1], np.inf)
+    fee_rate = 1 + fee_percent
+
+    start = int(cut_ids[0])
+    account -= costs_before.item(start)
+    while start < stock_dim:  # the buy of `start` is cut, or it is the first one the cash pays for one share of
+        price = prices.item(start)
+        action = actions.item(start)
+        delta = min(account // price, action)
+        account -= price * delta * fee_rate
+        deltas[start] = delta
+        if_sell_only = delta < action and account >= 0  # the cash left is less than the price of the cut buy
+
+        start += 1
+        window = 2 ** 6
+        while start < stock_dim:
+            end = min(start + window, stock_dim)
+            if if_sell_only:
+                cash_base = account + sells_before.item(start)
+                if_cuts = one_cashes[start:end] <= cash_base
+            else:
+                cash_base = account + costs_before.item(start)
+                if_cuts = cut_cashes[start:end] > cash_base
+            cut_id = int(if_cuts.argmax())
+            if_cut = if_cuts[cut_id]
+            stop = start + cut_id if if_cut else end
+
+            if if_sell_only:
+                account = cash_base - sells_before.item(stop)
+                deltas[start:stop] = sell_deltas[start:stop]
+            else:
+                account = cash_base - costs_before.item(stop)
+            start = stop
+            if if_cut:
+                break
+            window *= 2
+    stocks += deltas
+    return account
+
+
 class FinanceMultiStockEnv:  # 2021-02-02
     """FinRL
     Paper: A Deep Reinforcement Learning Library for Automated Stock Trading in Quantitative Finance
@@ -91,6 +162,7 @@ class FinanceMultiStockEnv:  # 2021-02-02
 
         self.ary = self.load_training_data_for_multi_stock()
         assert self.ary.shape == (1699, 5 * 30)  # ary: (date, item*stock_dim), item: (adjcp, macd, rsi, cci, adx)
+        self.item_num = self.ary.shape[1] // self.stock_dim
 
         # reset
         self.day = 0
@@ -102,13 +174,14 @@ class FinanceMultiStockEnv:  # 2021-02-02
 
         '''env information'''
         self.env_name = 'FinanceStock-v1'
-        self.state_dim = 1 + (5 + 1) * self.stock_dim
+        self.state_dim = 1 + (self.item_num + 1) * self.stock_dim
         self.action_dim = self.stock_dim
         self.if_discrete = False
         self.target_reward = 15
         self.max_step = self.ary.shape[0]
 
         self.gamma_r = 0.0
+        self.state = np.zeros(self.state_dim, dtype=np.float32)  # preallocated, updated in place
 
     def reset(self):
         self.account = self.initial_account * rd.uniform(0.9, 1.0)  # notice reset()
@@ -119,42 +192,23 @@ class FinanceMultiStockEnv:  # 2021-02-02
         self.day = 0
         self.day_npy = self.ary[self.day]
         self.day += 1
-
-        state = np.hstack((self.account * 2 ** -16,
-                           self.day_npy * 2 ** -8,
-                           self.stocks * 2 ** -12,), ).astype(np.float32)
-
-        return state
+        return self.get_state()
 
     def step(self, actions):
         actions = actions * self.max_stock
 
-        """bug or sell stock"""
-        for index in range(self.stock_dim):
-            action = actions[index]
-            adj = self.day_npy[index]
-            if action > 0:  # buy_stock
-                available_amount = self.account // adj
-                delta_stock = min(available_amount, action)
-                self.account -= adj * delta_stock * (1 + self.transaction_fee_percent)
-                self.stocks[index] += delta_stock
-            elif self.stocks[index] > 0:  # sell_stock
-                delta_stock = min(-action, self.stocks[index])
-                self.account += adj * delta_stock * (1 - self.transaction_fee_percent)
-                self.stocks[index] -= delta_stock
+        """buy or sell stock"""
+        self.account = execute_orders(self.account, self.stocks, actions, self.day_npy[:self.stock_dim],
+                                      self.transaction_fee_percent)
 
         """update day"""
         self.day_npy = self.ary[self.day]
         self.day += 1
         done = self.day == self.max_step  # 2020-12-21
 
-        state = np.hstack((
-            self.account * 2 ** -16,
-            self.day_npy * 2 ** -8,
-            self.stocks * 2 ** -12,
-        ), ).astype(np.float32)
+        state = self.get_state()
 
-        next_total_asset = self.account + (self.day_npy[:self.stock_dim] * self.stocks).sum()
+        next_total_asset = self.account + np.dot(self.day_npy[:self.stock_dim], self.stocks)
         reward = (next_total_asset - self.total_asset) * 2 ** -16  # notice scaling!
         self.total_asset = next_total_asset
 
@@ -168,6 +222,12 @@ class FinanceMultiStockEnv:  # 2021-02-02
 
         return state, reward, done, None
 
+    def get_state(self):  # return a copy, the caller keeps the states of many steps
+        self.state[0] = self.account * 2 ** -16
+        np.multiply(self.day_npy, 2 ** -8, out=self.state[1:1 + self.item_num * self.stock_dim])
+        np.multiply(self.stocks, 2 ** -12, out=self.state[1 + self.item_num * self.stock_dim:])
+        return self.state.copy()
+
     @staticmethod
     def load_training_data_for_multi_stock(if_load=True):  # need more independent
         npy_path = './FinanceMultiStock.npy'
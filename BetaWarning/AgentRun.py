@@ -136,7 +136,7 @@ def train_and_evaluate(args):
     agent = agent_rl(net_dim, state_dim, action_dim)  # build AgentRL
     agent.state = env.reset()
 
-    if_on_policy = agent_rl.__name__ in {'AgentPPO', 'AgentGaePPO'}  # build ReplayBuffer
+    if_on_policy = getattr(agent_rl, 'if_on_policy', False)  # build ReplayBuffer
     if if_on_policy:
         buffer = ReplayBufferCPU(max_memo, state_dim, action_dim=1 if if_discrete else action_dim)
         steps = 0
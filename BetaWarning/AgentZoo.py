@@ -3,7 +3,7 @@ import torch
 import numpy as np
 import numpy.random as rd
 from AgentNet import QNet, QNetTwin, QNetTwinDuel
-from AgentNet import Actor, ActorSAC, ActorPPO
+from AgentNet import Actor, ActorSAC, ActorPPO, ActorCriticPPO
 from AgentNet import Critic, CriticAdv, CriticTwin
 
 
@@ -228,6 +228,8 @@ class AgentTD3(AgentDDPG):
 
 
 class AgentPPO(AgentBase):
+    if_on_policy = True  # ReplayBufferCPU and no explore_before_train(), the subclasses inherit it
+
     def __init__(self, net_dim, state_dim, action_dim, learning_rate=1e-4):
         super().__init__()
         self.clip = 0.25  # ratio.clamp(1 - clip, 1 + clip)
@@ -276,7 +278,7 @@ class AgentPPO(AgentBase):
             all_reward, all_mask, all_action, all_noise, all_state = buffer.sample_for_ppo()
 
             b_size = 2 ** 10
-            all__new_v = [self.cri(all_state[i:i + b_size]) for i in range(0, all_state.size(0), b_size)]
+            all__new_v = [self.get_value(all_state[i:i + b_size]) for i in range(0, all_state.size(0), b_size)]
             all__new_v = torch.cat(all__new_v, dim=0)
             all_log_prob = -(all_noise.pow(2).__mul__(0.5) + self.act.a_std_log + self.act.sqrt_2pi_log).sum(1)
 
@@ -302,13 +304,12 @@ class AgentPPO(AgentBase):
             old_value = all__old_v[indices]
             old_log_prob = all_log_prob[indices]
 
-            new_log_prob = self.act.compute__log_prob(state, action)  # it is obj_actor
+            new_log_prob, new_value = self.compute__log_prob_value(state, action)  # it is obj_actor
             ratio = (new_log_prob - old_log_prob).exp()
             obj_surrogate1 = advantage * ratio
             obj_surrogate2 = advantage * ratio.clamp(1 - self.clip, 1 + self.clip)
             obj_actor = -torch.min(obj_surrogate1, obj_surrogate2).mean()
 
-            new_value = self.cri(state).squeeze(1)
             obj_critic = self.criterion(new_value, old_value)
 
             obj_united = obj_actor + obj_critic / (old_value.std() + 1e-5)
@@ -318,6 +319,12 @@ class AgentPPO(AgentBase):
         self.obj_a = obj_actor.item()
         self.obj_c = obj_critic.item()
 
+    def get_value(self, state):
+        return self.cri(state)
+
+    def compute__log_prob_value(self, state, action):
+        return self.act.compute__log_prob(state, action), self.cri(state).squeeze(1)
+
 
 class AgentGaePPO(AgentPPO):
     def __init__(self, net_dim, state_dim, action_dim, learning_rate=1e-4):
@@ -335,7 +342,7 @@ class AgentGaePPO(AgentPPO):
             all_reward, all_mask, all_action, all_noise, all_state = buffer.sample_for_ppo()
 
             b_size = 2 ** 10
-            all__new_v = [self.cri(all_state[i:i + b_size]) for i in range(0, all_state.size(0), b_size)]
+            all__new_v = [self.get_value(all_state[i:i + b_size]) for i in range(0, all_state.size(0), b_size)]
             all__new_v = torch.cat(all__new_v, dim=0)
             all_log_prob = -(all_noise.pow(2).__mul__(0.5) + self.act.a_std_log + self.act.sqrt_2pi_log).sum(1)
 
@@ -365,7 +372,7 @@ class AgentGaePPO(AgentPPO):
             old_value = all__old_v[indices]
             old_log_prob = all_log_prob[indices]
 
-            new_log_prob = self.act.compute__log_prob(state, action)
+            new_log_prob, new_value = self.compute__log_prob_value(state, action)
             ratio = (new_log_prob - old_log_prob).exp()
             obj_surrogate1 = advantage * ratio
             obj_surrogate2 = advantage * ratio.clamp(1 - self.clip, 1 + self.clip)
@@ -373,7 +380,6 @@ class AgentGaePPO(AgentPPO):
             obj_entropy = (new_log_prob.exp() * new_log_prob).mean() * self.lambda_entropy  # policy entropy
             obj_actor = obj_surrogate + obj_entropy
 
-            new_value = self.cri(state).squeeze(1)
             obj_critic = self.criterion(new_value, old_value)
 
             obj_united = obj_actor + obj_critic / (old_value.std() + 1e-5)
@@ -385,6 +391,30 @@ class AgentGaePPO(AgentPPO):
         self.obj_c = obj_critic.item()
 
 
+class AgentSharedPPO(AgentPPO):  # the actor and critic share a trunk, see ActorCriticPPO
+    def __init__(self, net_dim, state_dim, action_dim, learning_rate=1e-4):
+        AgentBase.__init__(self)
+        self.clip = 0.25  # ratio.clamp(1 - clip, 1 + clip)
+        self.lambda_entropy = 0.01  # could be 0.02
+
+        self.act = ActorCriticPPO(net_dim, state_dim, action_dim).to(self.device)
+
+        self.criterion = torch.nn.SmoothL1Loss()
+        self.optimizer = torch.optim.Adam(self.act.parameters(), lr=learning_rate)
+
+    def get_value(self, state):
+        return self.act.get_value(state)
+
+    def compute__log_prob_value(self, state, action):  # one forward of the shared trunk
+        return self.act.compute__log_prob_value(state, action)
+
+
+class AgentSharedGaePPO(AgentSharedPPO, AgentGaePPO):  # update_policy() of AgentGaePPO
+    def __init__(self, net_dim, state_dim, action_dim, learning_rate=1e-4):
+        super().__init__(net_dim, state_dim, action_dim, learning_rate)
+        self.lambda_adv = 0.98  # could be 0.95~0.99
+
+
 class AgentSAC(AgentBase):
     def __init__(self, net_dim, state_dim, action_dim, learning_rate=1e-4):
         super().__init__()
@@ -437,6 +467,8 @@ class AgentSAC(AgentBase):
 
 
 class AgentModSAC(AgentSAC):  # Modify SAC
+    if_data_parallel = False  # the actor update is gated on self.obj_c, see Parallel.py
+
     def __init__(self, net_dim, state_dim, action_dim, learning_rate=1e-4):
         super().__init__(net_dim, state_dim, action_dim, learning_rate)
         self.criterion = torch.nn.SmoothL1Loss()
@@ -0,0 +1,188 @@
+import os
+import time
+import random
+import threading
+import torch
+import numpy as np
+
+
+class AsyncSaver:
+    """torch.save() on a background thread, from a snapshot taken on the training thread
+
+    At most one file is in flight: the training thread only waits when the last file is still being written.
+    The stall time (snapshot + waiting) is what the training thread pays for each save.
+    """
+
+    def __init__(self):
+        self.thread = None
+        self.save_num = 0
+        self.stall_time = 0.0
+
+    def save(self, get_snapshot, save_path):
+        start_time = time.time()
+        self.wait()  # keep one snapshot in memory at most
+        snapshot = get_snapshot()
+        self.thread = threading.Thread(target=save_atomic, args=(snapshot, save_path))
+        self.thread.start()
+        self.stall_time += time.time() - start_time
+        self.save_num += 1
+
+    def wait(self):
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def close(self, name='AsyncSaver'):
+        self.wait()
+        if self.save_num:
+            print(f'| {name}: save {self.save_num} times, the training thread stalls '
+                  f'{self.stall_time / self.save_num * 1e3:.1f} ms per save')
+
+
+def save_atomic(obj, save_path):  # a crash while writing does not break the last file
+    torch.save(obj, f'{save_path}.tmp')
+    os.replace(f'{save_path}.tmp', save_path)
+
+
+def clone_to_cpu(obj):  # a consistent snapshot: the training thread may change the tensors after this
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, np.ndarray):
+        return torch.from_numpy(obj.copy())  # only tensors, so torch.load(weights_only=True) can read it
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, dict):
+        return {key: clone_to_cpu(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(clone_to_cpu(value) for value in obj)
+    return obj
+
+
+'''full training state'''
+
+
+def get_train_state(agent, buffer, evaluator, total_step) -> dict:
+    """everything train_and_evaluate() needs to resume, except the state of the training env (it is reset)"""
+    agent_state = dict()
+    for name, value in vars(agent).items():
+        if isinstance(value, (torch.nn.Module, torch.optim.Optimizer)):  # act, cri, targets, optimizer
+            agent_state[name] = clone_to_cpu(value.state_dict())
+        elif isinstance(value, (torch.Tensor, int, float, np.generic)):  # alpha_log, obj_a, obj_c
+            agent_state[name] = clone_to_cpu(value)
+
+    data_len = buffer.max_len if buffer.if_full else buffer.next_idx
+    buffer_state = {'next_idx': buffer.next_idx,
+                    'now_len': buffer.now_len,
+                    'if_full': buffer.if_full,
+                    'all_state': clone_to_cpu(buffer.all_state[:data_len]),
+                    'all_other': clone_to_cpu(buffer.all_other[:data_len])}
+
+    evaluator.metrics.flush()  # the metrics log is truncated to record_num when resuming
+    evaluator_state = {'r_max': clone_to_cpu(evaluator.r_max),
+                       'total_step': evaluator.total_step,
+                       'used_time': evaluator.used_time,
+                       'elapsed_time': time.time() - evaluator.start_time,
+                       'record_num': evaluator.metrics.record_num,
+                       'eval_time_sum': evaluator.scheduler.eval_time_sum}
+
+    np_state = np.random.get_state()
+    rng_state = {'torch': torch.get_rng_state(),
+                 'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else [],
+                 'numpy': (np_state[0], torch.from_numpy(np_state[1].astype(np.int64)), *np_state[2:]),
+                 'random': random.getstate()}
+
+    return {'total_step': total_step, 'agent': agent_state, 'buffer': buffer_state,
+            'evaluator': evaluator_state, 'rng': rng_state}
+
+
+def load_train_state(resume_path, agent, buffer, evaluator) -> int:  # return total_step
+    train_state = torch.load(resume_path, map_location='cpu', weights_only=True)  # tensors and builtins only
+
+    for name, value in train_state['agent'].items():
+        if isinstance(getattr(agent, name), (torch.nn.Module, torch.optim.Optimizer)):
+            getattr(agent, name).load_state_dict(value)
+        elif isinstance(value, torch.Tensor):
+            with torch.no_grad():  # keep the tensor, it is a parameter of an optimizer
+                getattr(agent, name).copy_(value)
+        else:
+            setattr(agent, name, value)
+
+    buffer_state = train_state['buffer']
+    for name in ('all_state', 'all_other'):
+        data = buffer_state[name]
+        memo = getattr(buffer, name)
+        memo[:len(data)] = data.to(memo.device) if isinstance(memo, torch.Tensor) else data.numpy()
+    buffer.next_idx = buffer_state['next_idx']
+    buffer.now_len = buffer_state['now_len']
+    buffer.if_full = buffer_state['if_full']
+
+    evaluator_state = train_state['evaluator']
+    evaluator.r_max = evaluator_state['r_max']
+    evaluator.total_step = evaluator_state['total_step']
+    evaluator.used_time = evaluator_state['used_time']
+    evaluator.start_time = time.time() - evaluator_state['elapsed_time']
+    evaluator.metrics.truncate(evaluator_state['record_num'])  # drop the records after this checkpoint
+    evaluator.scheduler.eval_step = evaluator.total_step
+    evaluator.scheduler.eval_time_sum = evaluator_state.get('eval_time_sum', 0.0)
+
+    rng_state = train_state['rng']
+    torch.set_rng_state(rng_state['torch'])
+    if rng_state['cuda'] and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(rng_state['cuda'])
+    np_state = rng_state['numpy']
+    np.random.set_state((np_state[0], np_state[1].numpy().astype(np.uint32), *np_state[2:]))
+    random.setstate(rng_state['random'])
+
+    print(f"| Resume from: {resume_path}, total_step: {train_state['total_step']:.2e}")
+    return train_state['total_step']
+
+
+'''benchmark'''
+
+
+def run__checkpoint_benchmark(agent_rl=None, max_memo=2 ** 17, state_dim=24, action_dim=4, save_times=4,
+                              cwd='./checkpoint_benchmark'):
+    """the stall time of the training thread: synchronous torch.save (before) and AsyncSaver (after)"""
+    from Main import Evaluator, ReplayBufferGPU
+    if agent_rl is None:
+        import Agent
+        agent_rl = Agent.AgentSAC
+    os.makedirs(cwd, exist_ok=True)
+    save_path = f'{cwd}/checkpoint.pth'
+
+    agent = agent_rl(2 ** 8, state_dim, action_dim)
+    buffer = ReplayBufferGPU(max_memo, state_dim, action_dim)
+    buffer.all_state.normal_()  # fill the buffer with random transitions
+    buffer.all_other.normal_()
+    buffer.all_other[:, 1] = 0.99  # mask
+    buffer.if_full = True
+    buffer.update__now_len__before_sample()
+    evaluator = Evaluator(cwd, 0, 1, 2 ** 8, 0)
+
+    def train():  # the work between two checkpoints
+        agent.update_policy(buffer, 2 ** 5, 2 ** 7, 1)
+
+    stall_time = 0.0
+    for _ in range(save_times):
+        start_time = time.time()
+        save_atomic(get_train_state(agent, buffer, evaluator, 0), save_path)
+        stall_time += time.time() - start_time
+        train()
+    sync_stall = stall_time / save_times
+
+    saver = AsyncSaver()
+    for _ in range(save_times):
+        saver.save(lambda: get_train_state(agent, buffer, evaluator, 0), save_path)
+        train()
+    saver.wait()
+    async_stall = saver.stall_time / saver.save_num
+    evaluator.close()
+
+    file_size = os.path.getsize(save_path) / 2 ** 20
+    print(f"| {'Save':>6}  {'Stall(ms)':>10}  {'File(MB)':>9}\n"
+          f"| {'sync':>6}  {sync_stall * 1e3:10.1f}  {file_size:9.1f}\n"
+          f"| {'async':>6}  {async_stall * 1e3:10.1f}  {file_size:9.1f}")
+
+
+if __name__ == '__main__':
+    run__checkpoint_benchmark()
@@ -0,0 +1,212 @@
+import os
+import time
+import torch
+import numpy as np
+import numpy.random as rd
+import torch.nn as nn
+from Net import ActorDistill
+from Agent import get_actor
+from Profiler import measure
+
+
+def run__distill(env, agent_rl, net_dim, actor_path, students=((2 ** 6, 2), (2 ** 5, 2)), prune_rates=(0.5, 0.25),
+                 states_path=None, state_num=2 ** 15, action_std=0.1, dagger_times=1, repeat_times=2 ** 4,
+                 batch_size=2 ** 8, learning_rate=1e-3, eval_times=2 ** 3, cwd='./distill'):
+    """distill the saved actor (actor_path, built by agent_rl(net_dim, ...)) to smaller actors for deployment
+
+    students: (mid_dim, layer_num) of the narrower or shallower students, built by build_student()
+    prune_rates: the structured-pruned teachers, keep (1 - prune_rate) hidden units of each layer, then fine-tune
+    The states to match the actions on are loaded from states_path (a .npy [state_num, state_dim], or the replay
+    buffer in a checkpoint.pth, see Checkpoint.py), or collected by the teacher with action noise (action_std).
+    Then dagger_times rounds of DAgger: add the states the student visits, labeled by the teacher.
+    Return and print the return, the latency of one action (batch size 1, CPU) and the parameters of each actor.
+    At batch size 1 the latency is mostly the overhead of each layer, so fewer layers speed up more than pruning.
+    The students are saved to `cwd/student_{name}.pth` (torch.save of the module, load it with torch.load).
+    """
+    os.makedirs(cwd, exist_ok=True)
+    teacher = get_actor(agent_rl, net_dim, env, actor_path)
+    if_tanh = not env.if_discrete  # the QNet of a discrete env returns the q values
+
+    if states_path is None:
+        states = get_rollout_states(env, teacher, state_num, action_std)
+    else:
+        states = load_states(states_path)
+
+    student_dict = dict()
+    for mid_dim, layer_num in students:
+        student_dict[f'mlp{mid_dim}x{layer_num}'] = build_student(env.state_dim, env.action_dim, mid_dim, layer_num,
+                                                                  if_tanh)
+    for prune_rate in prune_rates:
+        net = prune_sequential(get_actor_sequential(teacher), 1 - prune_rate)
+        student_dict[f'prune{prune_rate:.2f}'] = ActorDistill(net, if_tanh)
+
+    results = {'teacher': get_actor_report(env, teacher, eval_times)}
+    for name, student in student_dict.items():
+        start_time = time.time()
+        student_states = states
+        loss = distill_actor(student, teacher, student_states, repeat_times, batch_size, learning_rate)
+        for _ in range(dagger_times):
+            student_states = np.concatenate((student_states, get_rollout_states(env, student, state_num, 0.0)))
+            loss = distill_actor(student, teacher, student_states, repeat_times, batch_size, learning_rate)
+
+        student.eval()
+        torch.save(student, f'{cwd}/student_{name}.pth')
+        results[name] = get_actor_report(env, student, eval_times)
+        results[name].update(loss=loss, used_time=time.time() - start_time)
+    print_distill(results)
+    return results
+
+
+def distill_actor(student, teacher, states, repeat_times, batch_size, learning_rate) -> float:
+    """fit student(state) to teacher(state) (MSE), repeat_times epochs of the states. Return the last epoch loss"""
+    states = torch.as_tensor(states, dtype=torch.float32)
+    with torch.no_grad():
+        targets = torch.cat([teacher(states[i:i + batch_size]) for i in range(0, len(states), batch_size)])
+
+    optimizer = torch.optim.Adam(student.parameters(), lr=learning_rate)
+    criterion = nn.MSELoss()
+    student.train()
+    loss_sum = 0.0
+    for _ in range(repeat_times):
+        loss_sum = 0.0
+        for indices in torch.randperm(len(states)).split(batch_size):
+            loss = criterion(student(states[indices]), targets[indices])
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+            loss_sum += loss.item() * len(indices)
+    student.eval()
+    return loss_sum / len(states)
+
+
+'''student'''
+
+
+def build_student(state_dim, action_dim, mid_dim, layer_num, if_tanh=True):  # layer_num hidden layers
+    dims = [state_dim] + [mid_dim] * layer_num
+    layers = list()
+    for i in range(layer_num):
+        layers.extend((nn.Linear(dims[i], dims[i + 1]), nn.ReLU()))
+    layers.append(nn.Linear(dims[-1], action_dim))
+    return ActorDistill(nn.Sequential(*layers), if_tanh)
+
+
+def get_actor_sequential(act) -> nn.Sequential:
+    """the layers of act.forward() before the tanh of action, as one nn.Sequential (the layers are shared)
+
+    Actor, ActorPPO, QNet: net; ActorSAC, ActorCriticPPO: net__state, net__a_avg; QNetTwin: net__s, net_q1
+    """
+    for names in (('net',), ('net__state', 'net__a_avg'), ('net__s', 'net_q1')):
+        if all(hasattr(act, name) for name in names):
+            layers = list()
+            for name in names:
+                module = getattr(act, name)
+                layers.extend(module if isinstance(module, nn.Sequential) else (module,))
+            return nn.Sequential(*layers)
+    raise TypeError(f'| get_actor_sequential: not support {type(act).__name__}')
+
+
+def prune_sequential(net, keep_rate) -> nn.Sequential:
+    """structured pruning: a copy of net with keep_rate of the hidden units of each nn.Linear (except the output)
+
+    The importance of a hidden unit is the L1 norm of its input weights times the L1 norm of its output weights.
+    The pruned layers are smaller dense layers, so the speed up needs no sparse kernel.
+    """
+    layers = [(i, layer) for i, layer in enumerate(net) if isinstance(layer, nn.Linear)]
+    new_layers = [layer for layer in net]
+
+    in_keep = None  # the input units kept by the last pruned layer
+    for j, (i, layer) in enumerate(layers):
+        weight = layer.weight.detach()
+        bias = layer.bias.detach()
+        if in_keep is not None:
+            weight = weight[:, in_keep]
+
+        if j < len(layers) - 1:
+            next_weight = layers[j + 1][1].weight.detach()
+            importance = weight.abs().sum(1) * next_weight.abs().sum(0)
+            keep_num = max(1, int(round(weight.shape[0] * keep_rate)))
+            in_keep = importance.topk(keep_num).indices.sort().values
+            weight = weight[in_keep]
+            bias = bias[in_keep]
+
+        new_layer = nn.Linear(weight.shape[1], weight.shape[0])
+        with torch.no_grad():
+            new_layer.weight.copy_(weight)
+            new_layer.bias.copy_(bias)
+        new_layers[i] = new_layer
+    return nn.Sequential(*new_layers)
+
+
+'''states'''
+
+
+def get_rollout_states(env, act, state_num, action_std=0.1) -> np.ndarray:
+    """the states visited by act, with Gaussian action noise (continuous) or random actions (discrete, epsilon)"""
+    states = np.empty((state_num, env.state_dim), dtype=np.float32)
+    state = env.reset()
+    with torch.no_grad():
+        for i in range(state_num):
+            states[i] = state
+            a_ary = act(torch.as_tensor(states[i]).unsqueeze(0)).numpy()[0]
+            if env.if_discrete:
+                action = rd.randint(env.action_dim) if rd.rand() < action_std else a_ary.argmax()
+            else:
+                action = (a_ary + rd.randn(env.action_dim) * action_std).clip(-1, 1)
+
+            state, _, done, _ = env.step(action)
+            if done:
+                state = env.reset()
+    return states
+
+
+def load_states(states_path) -> np.ndarray:
+    if states_path.endswith('.npy'):
+        return np.load(states_path).astype(np.float32)
+    buffer_state = torch.load(states_path, map_location='cpu', weights_only=True)['buffer']  # a checkpoint.pth
+    return np.asarray(buffer_state['all_state'], dtype=np.float32)
+
+
+'''report'''
+
+
+def get_actor_report(env, act, eval_times) -> dict:
+    from Main import get_episode_return
+    act = act.to('cpu')
+    device = torch.device('cpu')
+    with torch.no_grad():
+        episode_returns = [get_episode_return(env, act, device) for _ in range(eval_times)]
+        state = torch.zeros((1, env.state_dim), dtype=torch.float32)
+        latency = measure(lambda: act(state))
+    return {'r_avg': float(np.mean(episode_returns)),
+            'r_std': float(np.std(episode_returns)),
+            'latency_us': latency * 1e6,
+            'param_num': sum(param.numel() for param in act.parameters())}
+
+
+def print_distill(results):
+    teacher = results['teacher']
+    print(f"| {'Actor':>12}  {'avgR':>9}  {'stdR':>8}  {'Latency':>9}  {'Speedup':>7}  {'Params':>8}  {'Loss':>8}")
+    for name, result in results.items():
+        loss = f"{result['loss']:8.2e}" if 'loss' in result else f"{'':8}"
+        print(f"| {name:>12}  {result['r_avg']:9.3f}  {result['r_std']:8.3f}  {result['latency_us']:7.1f}us  "
+              f"{teacher['latency_us'] / result['latency_us']:6.2f}x  {result['param_num']:8d}  {loss}")
+
+
+def run__distill_demo(cwd='./distill_demo'):
+    """train a SAC teacher (net_dim=2**8) on PointMassEnv, then distill it to the students"""
+    import Agent
+    from Main import Arguments, train_and_evaluate
+    from Env import PointMassEnv
+
+    args = Arguments(agent_rl=Agent.AgentSAC, env=PointMassEnv(), gpu_id=0)
+    args.cwd = f'{cwd}/teacher'
+    args.net_dim = 2 ** 8
+    args.break_step = 2 ** 15
+    train_and_evaluate(args)
+
+    run__distill(PointMassEnv(), Agent.AgentSAC, args.net_dim, f'{args.cwd}/actor.pth', cwd=cwd)
+
+
+if __name__ == '__main__':
+    run__distill_demo()
@@ -1,6 +1,8 @@
 import os
+import time
 import numpy as np
 import numpy.random as rd
+from abc import ABC, abstractmethod
 
 
 def decorate_env(env, data_type=np.float32, if_print=True):
@@ -75,6 +77,129 @@ def get_gym_env_info(env, if_print) -> (str, int, int, float, bool, float):
     return env_name, state_dim, action_dim, action_max, if_discrete, target_reward
 
 
+class SubprocessVecEnv:
+    """env_num envs of env_func() (gym envs after decorate_env(), or custom envs) stepped in worker processes
+
+    Each worker steps a slice of the envs. The states, actions, rewards and dones are exchanged through
+    preallocated shared-memory arrays, and only a one-byte command goes through a pipe in each step.
+    Like FinanceMultiStockVecEnv, reset() returns states [env_num, state_dim], step(actions) returns
+    (states, rewards [env_num], dones [env_num], None), and the envs that are done are reset in the workers.
+    """
+
+    def __init__(self, env_func, env_num, worker_num=None):
+        import multiprocessing as mp
+        env = env_func()  # env information
+        self.env_name = env.env_name
+        self.state_dim = env.state_dim
+        self.action_dim = env.action_dim
+        self.if_discrete = env.if_discrete
+        self.target_reward = env.target_reward
+        self.max_step = getattr(env, 'max_step', 2 ** 10)
+        del env
+
+        self.env_num = env_num
+        if worker_num is None:
+            worker_num = min(env_num, len(os.sched_getaffinity(0)))
+
+        ctx = mp.get_context('fork')  # the workers inherit env_func, a lambda is fine
+        action_shape = (env_num,) if self.if_discrete else (env_num, self.action_dim)
+        shapes_types = {'states': ((env_num, self.state_dim), np.float32),
+                        'actions': (action_shape, np.int64 if self.if_discrete else np.float32),
+                        'rewards': ((env_num,), np.float32),
+                        'dones': ((env_num,), np.bool_),
+                        'episode_returns': ((env_num,), np.float64)}  # of the last finished episode
+        self.raw_arrays = {name: (ctx.RawArray('b', int(np.prod(shape)) * np.dtype(dtype).itemsize), shape, dtype)
+                           for name, (shape, dtype) in shapes_types.items()}
+        for name, raw_array in self.raw_arrays.items():
+            setattr(self, name, get_shared_array(*raw_array))
+
+        self.pipes = list()
+        self.workers = list()
+        for env_ids in np.array_split(np.arange(env_num), worker_num):
+            pipe, worker_pipe = ctx.Pipe()
+            worker = ctx.Process(target=mp__vec_env_worker, daemon=True,
+                                 args=(env_func, env_ids[0], env_ids[-1] + 1, self.raw_arrays, worker_pipe))
+            worker.start()
+            worker_pipe.close()  # the worker holds the only copy, so recv_bytes() raises EOFError if it dies
+            self.pipes.append(pipe)
+            self.workers.append(worker)
+
+    def reset(self):
+        self.run_workers(b'r')
+        return self.states.copy()
+
+    def step(self, actions):
+        self.actions[:] = actions
+        self.run_workers(b's')
+        return self.states.copy(), self.rewards.copy(), self.dones.copy(), None
+
+    def run_workers(self, command):
+        for pipe in self.pipes:
+            try:
+                pipe.send_bytes(command)
+            except OSError:  # BrokenPipeError of a dead worker, reported by recv_bytes()
+                pass
+
+        errors = list()
+        for pipe, worker in zip(self.pipes, self.workers):
+            try:
+                message = pipe.recv_bytes()
+            except (EOFError, OSError):  # EOFError, or ConnectionResetError after a command to the dead worker
+                worker.join(timeout=1)
+                message = f'e| worker pid={worker.pid} died, exitcode={worker.exitcode}'.encode()
+            if message:  # b'e' + the traceback of the worker
+                errors.append(message[1:].decode())
+        if errors:
+            raise RuntimeError('| SubprocessVecEnv: a worker failed\n' + '\n'.join(errors))
+
+    def close(self):
+        for pipe in self.pipes:
+            try:
+                pipe.send_bytes(b'c')
+            except OSError:  # BrokenPipeError, the worker has died
+                pass
+        for worker in self.workers:
+            worker.join()
+        self.pipes = list()
+        self.workers = list()
+
+
+def get_shared_array(raw_array, shape, dtype):  # a numpy view of the shared memory
+    return np.frombuffer(raw_array, dtype=dtype).reshape(shape)
+
+
+def mp__vec_env_worker(env_func, beg, end, raw_arrays, pipe):
+    import traceback
+    try:
+        states, actions, rewards, dones, episode_returns = (get_shared_array(*raw_arrays[name]) for name in (
+            'states', 'actions', 'rewards', 'dones', 'episode_returns'))
+        envs = [env_func() for _ in range(beg, end)]
+        running_returns = np.zeros(end - beg)
+
+        while True:
+            command = pipe.recv_bytes()
+            if command == b's':
+                for i, env in enumerate(envs, start=beg):
+                    state, reward, done, _ = env.step(actions[i])
+                    running_returns[i - beg] += reward
+                    if done:
+                        episode_returns[i] = getattr(env, 'episode_return', running_returns[i - beg])
+                        running_returns[i - beg] = 0.0
+                        state = env.reset()
+                    states[i] = state
+                    rewards[i] = reward
+                    dones[i] = done
+            elif command == b'r':
+                for i, env in enumerate(envs, start=beg):
+                    states[i] = env.reset()
+                running_returns[:] = 0.0
+            else:  # b'c': close
+                break
+            pipe.send_bytes(b'')
+    except Exception:  # send the traceback to run_workers(), then exit
+        pipe.send_bytes(b'e' + traceback.format_exc().encode())
+
+
 class FinanceMultiStockEnv:  # 2021-02-02
     """FinRL
     Paper: A Deep Reinforcement Learning Library for Automated Stock Trading in Quantitative Finance
@@ -83,78 +208,64 @@ class FinanceMultiStockEnv:  # 2021-02-02
     Modify: Github Yonv1943 ElegantRL
     """
 
-    def __init__(self, initial_account=1e6, transaction_fee_percent=1e-3, max_stock=100):
-        self.stock_dim = 30
+    def __init__(self, initial_account=1e6, transaction_fee_percent=1e-3, max_stock=100,
+                 npy_path='./FinanceMultiStock.npy'):
         self.initial_account = initial_account
         self.transaction_fee_percent = transaction_fee_percent
         self.max_stock = max_stock
 
-        self.ary = self.load_training_data_for_multi_stock()
-        assert self.ary.shape == (1699, 5 * 30)  # ary: (date, item*stock_dim), item: (adjcp, macd, rsi, cci, adx)
+        self.ary, self.state_ary = self.load_training_data_for_multi_stock(npy_path=npy_path)  # read-only memory maps
+        self.item_num, self.stock_dim = get_market_data_info(npy_path)
+        assert self.ary.shape[1] == self.item_num * self.stock_dim  # ary: (date, item*stock_dim), item 0: adjcp
 
         # reset
         self.day = 0
         self.account = self.initial_account
         self.day_npy = self.ary[self.day]
+        self.day_state = self.state_ary[self.day]  # day_npy * 2 ** -8, precomputed
         self.stocks = np.zeros(self.stock_dim, dtype=np.float32)  # multi-stack
         self.total_asset = self.account + (self.day_npy[:self.stock_dim] * self.stocks).sum()
         self.episode_return = 0.0  # Compatibility for ElegantRL 2020-12-21
 
         '''env information'''
         self.env_name = 'FinanceStock-v1'
-        self.state_dim = 1 + (5 + 1) * self.stock_dim
+        self.state_dim = 1 + (self.item_num + 1) * self.stock_dim
         self.action_dim = self.stock_dim
         self.if_discrete = False
         self.target_reward = 15
         self.max_step = self.ary.shape[0]
 
         self.gamma_r = 0.0
+        self.state = np.zeros(self.state_dim, dtype=np.float32)  # preallocated, updated in place
 
-    def reset(self):
-        self.account = self.initial_account * rd.uniform(0.9, 1.0)  # notice reset()
+    def reset(self, day=0, account=None):  # a backtest starts on a given day with a given account
+        self.account = self.initial_account * rd.uniform(0.9, 1.0) if account is None else account  # notice reset()
         self.stocks = np.zeros(self.stock_dim, dtype=np.float32)
         self.total_asset = self.account + (self.day_npy[:self.stock_dim] * self.stocks).sum()
         # total_asset = account + (adjcp * stocks).sum()
 
-        self.day = 0
+        self.day = day
         self.day_npy = self.ary[self.day]
+        self.day_state = self.state_ary[self.day]
         self.day += 1
-
-        state = np.hstack((self.account * 2 ** -16,
-                           self.day_npy * 2 ** -8,
-                           self.stocks * 2 ** -12,), ).astype(np.float32)
-
-        return state
+        return self.get_state()
 
     def step(self, actions):
         actions = actions * self.max_stock
 
-        """bug or sell stock"""
-        for index in range(self.stock_dim):
-            action = actions[index]
-            adj = self.day_npy[index]
-            if action > 0:  # buy_stock
-                available_amount = self.account // adj
-                delta_stock = min(available_amount, action)
-                self.account -= adj * delta_stock * (1 + self.transaction_fee_percent)
-                self.stocks[index] += delta_stock
-            elif self.stocks[index] > 0:  # sell_stock
-                delta_stock = min(-action, self.stocks[index])
-                self.account += adj * delta_stock * (1 - self.transaction_fee_percent)
-                self.stocks[index] -= delta_stock
+        """buy or sell stock"""
+        self.account = execute_orders(self.account, self.stocks, actions, self.day_npy[:self.stock_dim],
+                                      self.transaction_fee_percent)
 
         """update day"""
         self.day_npy = self.ary[self.day]
+        self.day_state = self.state_ary[self.day]
         self.day += 1
         done = self.day == self.max_step  # 2020-12-21
 
-        state = np.hstack((
-            self.account * 2 ** -16,
-            self.day_npy * 2 ** -8,
-            self.stocks * 2 ** -12,
-        ), ).astype(np.float32)
+        state = self.get_state()
 
-        next_total_asset = self.account + (self.day_npy[:self.stock_dim] * self.stocks).sum()
+        next_total_asset = self.account + np.dot(self.day_npy[:self.stock_dim], self.stocks)
         reward = (next_total_asset - self.total_asset) * 2 ** -16  # notice scaling!
         self.total_asset = next_total_asset
 
@@ -168,13 +279,26 @@ class FinanceMultiStockEnv:  # 2021-02-02
 
         return state, reward, done, None
 
+    def get_state(self):  # return a copy, the caller keeps the states of many steps
+        self.state[0] = self.account * 2 ** -16
+        self.state[1:1 + self.item_num * self.stock_dim] = self.day_state
+        np.multiply(self.stocks, 2 ** -12, out=self.state[1 + self.item_num * self.stock_dim:])
+        return self.state.copy()
+
+    def __deepcopy__(self, memo):  # the copies (such as env_eval) share the read-only market data
+        from copy import deepcopy
+        memo[id(self.ary)] = self.ary
+        memo[id(self.state_ary)] = self.state_ary
+        env = self.__class__.__new__(self.__class__)
+        memo[id(self)] = env
+        for name, value in vars(self).items():
+            setattr(env, name, deepcopy(value, memo))
+        return env
+
     @staticmethod
-    def load_training_data_for_multi_stock(if_load=True):  # need more independent
-        npy_path = './FinanceMultiStock.npy'
+    def load_training_data_for_multi_stock(if_load=True, npy_path='./FinanceMultiStock.npy'):
         if if_load and os.path.exists(npy_path):
-            data_ary = np.load(npy_path).astype(np.float32)
-            assert data_ary.shape[1] == 5 * 30
-            return data_ary
+            return load_market_data(npy_path, state_scale=2 ** -8)
         else:
             raise RuntimeError(
                 f'| FinanceMultiStockEnv(): Can you download and put it into: {npy_path}\n'
@@ -226,3 +350,520 @@ class FinanceMultiStockEnv:  # 2021-02-02
         # np.save(npy_path, data_ary.astype(np.float16))  # save as float16 (0.5 MB), float32 (1.0 MB)
         # print('| FinanceMultiStockEnv(): save in:', npy_path)
         # return data_ary
+
+
+class FinanceMultiStockVecEnv:
+    """many independent portfolios of FinanceMultiStockEnv over the same price array, in arrays
+
+    reset() returns states [env_num, state_dim], step(actions [env_num, action_dim]) returns
+    (states, rewards [env_num], dones [env_num], None), and resets the portfolios that are done.
+    Each portfolio starts on a random day with its own cash (initial_account can be an array [env_num])
+    and trades for episode_len days at most. The actions of a batched rollout are agent.select_actions(states).
+    """
+
+    def __init__(self, env_num, initial_account=1e6, transaction_fee_percent=1e-3, max_stock=100,
+                 episode_len=2 ** 8, npy_path='./FinanceMultiStock.npy'):
+        self.env_num = env_num
+        self.initial_account = np.broadcast_to(np.asarray(initial_account, dtype=np.float64), (env_num,))
+        self.transaction_fee_percent = transaction_fee_percent
+        self.max_stock = max_stock
+
+        self.ary, self.state_ary = FinanceMultiStockEnv.load_training_data_for_multi_stock(npy_path=npy_path)
+        self.item_num, self.stock_dim = get_market_data_info(npy_path)
+        assert self.ary.shape[1] == self.item_num * self.stock_dim  # ary: (date, item*stock_dim), item 0: adjcp
+        episode_len = min(episode_len, self.ary.shape[0])
+
+        '''env information'''
+        self.env_name = 'FinanceStockVec-v1'
+        self.state_dim = 1 + (self.item_num + 1) * self.stock_dim
+        self.action_dim = self.stock_dim
+        self.if_discrete = False
+        self.target_reward = 15
+        self.max_step = episode_len
+
+        # reset
+        self.accounts = np.zeros(env_num, dtype=np.float64)
+        self.stocks = np.zeros((env_num, self.stock_dim), dtype=np.float32)
+        self.total_assets = np.zeros(env_num, dtype=np.float64)
+        self.days = np.zeros(env_num, dtype=np.int64)  # the index of the next day
+        self.end_days = np.zeros(env_num, dtype=np.int64)
+        self.day_npys = np.zeros((env_num, self.item_num * self.stock_dim), dtype=np.float32)
+        self.gamma_rs = np.zeros(env_num, dtype=np.float64)
+        self.episode_returns = np.zeros(env_num, dtype=np.float64)  # of the last finished episode
+        self.states = np.zeros((env_num, self.state_dim), dtype=np.float32)  # preallocated, updated in place
+
+    def reset(self):
+        self.reset_envs(np.arange(self.env_num))
+        return self.get_states()
+
+    def reset_envs(self, env_ids):
+        env_num = len(env_ids)
+        self.accounts[env_ids] = self.initial_account[env_ids] * rd.uniform(0.9, 1.0, size=env_num)
+        self.stocks[env_ids] = 0
+        self.total_assets[env_ids] = self.accounts[env_ids]
+        self.gamma_rs[env_ids] = 0.0
+
+        start_days = rd.randint(0, self.ary.shape[0] - self.max_step + 1, size=env_num)
+        self.day_npys[env_ids] = self.ary[start_days]
+        self.days[env_ids] = start_days + 1
+        self.end_days[env_ids] = start_days + self.max_step
+
+    def step(self, actions):
+        actions = actions * self.max_stock
+
+        """buy or sell stock"""
+        execute_orders_vec(self.accounts, self.stocks, actions, self.day_npys[:, :self.stock_dim],
+                           self.transaction_fee_percent)
+
+        """update day"""
+        self.day_npys[:] = self.ary[self.days]
+        self.days += 1
+        dones = self.days == self.end_days
+
+        next_total_assets = self.accounts + np.einsum('ij,ij->i', self.day_npys[:, :self.stock_dim], self.stocks)
+        rewards = (next_total_assets - self.total_assets) * 2 ** -16  # notice scaling!
+        self.total_assets = next_total_assets
+
+        self.gamma_rs = self.gamma_rs * 0.99 + rewards
+        done_ids = np.flatnonzero(dones)
+        if done_ids.size:
+            rewards[done_ids] += self.gamma_rs[done_ids]
+            self.episode_returns[done_ids] = next_total_assets[done_ids] / self.initial_account[done_ids]
+            self.reset_envs(done_ids)  # auto-reset, the states of these portfolios are the states after reset
+
+        return self.get_states(), rewards.astype(np.float32), dones, None
+
+    def get_states(self):
+        self.states[:, 0] = self.accounts * 2 ** -16
+        self.states[:, 1:1 + self.item_num * self.stock_dim] = self.state_ary[self.days - 1]  # days: the next day
+        np.multiply(self.stocks, 2 ** -12, out=self.states[:, 1 + self.item_num * self.stock_dim:])
+        return self.states.copy()
+
+
+def load_market_data(npy_path, state_scale=2 ** -8):
+    """read-only memory maps of the market data in float32, and of its scaled copy in the state
+
+    Both are computed once and cached on disk next to npy_path (rebuilt when npy_path is newer), so all the env
+    copies and worker processes share the same pages of the OS page cache instead of holding their own arrays.
+    """
+    cache_paths = (f'{npy_path[:-4]}_float32.npy', f'{npy_path[:-4]}_state.npy')
+    if not all(os.path.exists(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(npy_path)
+               for cache_path in cache_paths):
+        data_ary = np.load(npy_path).astype(np.float32)
+        data_ary = data_ary.reshape((data_ary.shape[0], -1))  # (date, item, stock_dim) to (date, item*stock_dim)
+        for cache_path, cache_ary in zip(cache_paths, (data_ary, data_ary * state_scale)):
+            temp_path = f'{cache_path}.{os.getpid()}.tmp'  # other processes may be building the same cache
+            with open(temp_path, 'wb') as f:
+                np.save(f, cache_ary)
+            os.replace(temp_path, cache_path)
+    return tuple(np.load(cache_path, mmap_mode='r').view(np.ndarray)  # np.memmap slicing is slower
+                 for cache_path in cache_paths)
+
+
+def make_synthetic_market_data(npy_path, day_num, stock_dim, item_num=5):  # for benchmarks and backtest demos
+    data_ary = rd.normal(0, 1, size=(day_num, item_num, stock_dim))  # (date, item, stock_dim), item 0: adjcp
+    data_ary[:, 0] = rd.uniform(10, 200, size=stock_dim) * np.exp(np.cumsum(data_ary[:, 0] * 0.01, axis=0))
+    np.save(npy_path, data_ary.astype(np.float16))
+
+
+def get_market_data_info(npy_path) -> tuple:  # (item_num, stock_dim) of the market data
+    """the metadata of the market data: `{npy_path[:-4]}.json` such as {"item_num": 5, "stock_dim": 3000},
+    or the shape of a (date, item, stock_dim) array. The items of a stock are (adjcp, ...), and the first is the price.
+    A (date, item*stock_dim) array without metadata is the FinRL data, item: (adjcp, macd, rsi, cci, adx)
+    """
+    info_path = f'{npy_path[:-4]}.json'
+    if os.path.exists(info_path):
+        import json
+        with open(info_path) as f:
+            info = json.load(f)
+        return info['item_num'], info['stock_dim']
+
+    shape = np.load(npy_path, mmap_mode='r').shape  # only read the header
+    if len(shape) == 3:
+        return shape[1], shape[2]
+    return 5, shape[1] // 5
+
+
+def execute_orders(account, stocks, actions, prices, fee_percent) -> float:
+    """buy or sell stocks in index order, update `stocks` in place and return the account
+
+    The same as the loop over stocks: sell `-action` (at most the held stocks) if action <= 0, and buy `action`
+    (at most `account // price`) if action > 0, with the cash left by the orders before it.
+    A cumulative-cost pass gives the cash before each order up to the first buy cut by the cash. The cut buy takes
+    what the cash pays for, then the pass restarts after it, so a cut costs a few array operations instead of a
+    loop over the stocks. Buys are cut in most steps of random actions (the cash runs out), and after a cut the
+    cash left cannot pay for one share of most buys, so that pass adds the sells only, up to the first buy it pays
+    for one share of. A pass covers 2 ** 6 orders, doubled each time it finds no cut.
+    """
+    deltas = np.maximum(actions, -stocks)  # the change of stocks if no buy is cut by the cash
+    values = np.multiply(prices, deltas, dtype=np.float64)  # float64: a rounding error may cut a buy by one share
+    costs = values + np.abs(values) * fee_percent  # buy: value * (1 + fee), sell: value * (1 - fee)
+    costs_before = np.cumsum(costs) - costs  # the costs of the orders before each order
+    if_buys = actions > 0
+
+    cut_ids = np.flatnonzero(if_buys & ((account - costs_before) // prices < actions))
+    if cut_ids.size == 0:
+        stocks += deltas
+        return account - float(costs_before[-1] + costs[-1])
+
+    stock_dim = len(actions)
+    sell_costs = np.minimum(costs, 0)
+    sell_deltas = np.minimum(deltas, 0)  # the buys of a sell-only pass get no share
+    costs_before = np.append(costs_before, costs_before[-1] + costs[-1])  # [stock_dim + 1], the last one is all
+    sells_before = np.append(0.0, np.cumsum(sell_costs))  # the costs of the sells before
+    # a pass from `start` with cash_base = account + costs_before[start] (sell-only: + sells_before[start]): the cash
+    # before order i is cash_base - costs_before[i] (sell-only: - sells_before[i]), so the buy of i is cut if
+    # cash_base < cut_cashes[i], and the cash pays for one share of it if cash_base >= one_cashes[i]
+    cut_cashes = np.where(if_buys, np.ceil(actions) * prices + costs_before[:-1], -np.inf)
+    one_cashes = np.where(if_buys, prices + sells_before[:-1], np.inf)
+    fee_rate = 1 + fee_percent
+
+    start = int(cut_ids[0])
+    account -= costs_before.item(start)
+    while start < stock_dim:  # the buy of `start` is cut, or it is the first one the cash pays for one share of
+        price = prices.item(start)
+        action = actions.item(start)
+        delta = min(account // price, action)
+        account -= price * delta * fee_rate
+        deltas[start] = delta
+        if_sell_only = delta < action and account >= 0  # the cash left is less than the price of the cut buy
+
+        start += 1
+        window = 2 ** 6
+        while start < stock_dim:
+            end = min(start + window, stock_dim)
+            if if_sell_only:
+                cash_base = account + sells_before.item(start)
+                if_cuts = one_cashes[start:end] <= cash_base
+            else:
+                cash_base = account + costs_before.item(start)
+                if_cuts = cut_cashes[start:end] > cash_base
+            cut_id = int(if_cuts.argmax())
+            if_cut = if_cuts[cut_id]
+            stop = start + cut_id if if_cut else end
+
+            if if_sell_only:
+                account = cash_base - sells_before.item(stop)
+                deltas[start:stop] = sell_deltas[start:stop]
+            else:
+                account = cash_base - costs_before.item(stop)
+            start = stop
+            if if_cut:
+                break
+            window *= 2
+    stocks += deltas
+    return account
+
+
+def execute_orders_vec(accounts, stocks, actions, prices, fee_percent):
+    """execute_orders() of many portfolios [env_num, stock_dim], update `accounts` and `stocks` in place
+
+    The portfolios without a buy cut by the cash take the cumulative-cost pass only. For the others, the orders
+    before their first cut buy are applied at once, and the rest run in a loop over the stocks
+    (from the first cut stock on), vectorized over these portfolios.
+    """
+    deltas = np.maximum(actions, -stocks)
+    values = np.multiply(prices, deltas, dtype=np.float64)
+    costs = values + np.abs(values) * fee_percent
+    cash_before = accounts[:, None] - (np.cumsum(costs, axis=1) - costs)
+
+    if_cut = (actions > 0) & (cash_before // prices < actions)
+    if_cut_env = if_cut.any(axis=1)
+    if not if_cut_env.any():
+        stocks += deltas
+        accounts -= costs.sum(axis=1)
+        return
+
+    stocks[~if_cut_env] += deltas[~if_cut_env]
+    accounts[~if_cut_env] -= costs[~if_cut_env].sum(axis=1)
+    env_ids = np.flatnonzero(if_cut_env)
+    if len(env_ids) <= 2 ** 4:  # for a few cut portfolios, the scalar loop of execute_orders() is faster
+        for env_id in env_ids:
+            accounts[env_id] = execute_orders(accounts[env_id], stocks[env_id], actions[env_id], prices[env_id],
+                                              fee_percent)
+        return
+
+    cut_ids = if_cut[env_ids].argmax(axis=1)  # the first cut stock of each cut portfolio
+    if_after_cut = np.arange(stocks.shape[1]) >= cut_ids[:, None]
+    sub_stocks = stocks[env_ids] + deltas[env_ids] * ~if_after_cut
+    sub_accounts = cash_before[env_ids, cut_ids]
+    sub_actions = actions[env_ids]
+    sub_prices = prices[env_ids]
+    fee_rates = np.where(sub_actions > 0, 1 + fee_percent, 1 - fee_percent)
+    for index in range(cut_ids.min(), stocks.shape[1]):
+        action = sub_actions[:, index]
+        adj = sub_prices[:, index]
+        delta_stock = np.where(action > 0, np.minimum(sub_accounts // adj, action),
+                               np.maximum(action, -sub_stocks[:, index]))
+        delta_stock *= if_after_cut[:, index]  # the orders before the cut stock are applied
+        sub_accounts -= adj * delta_stock * fee_rates[:, index]
+        sub_stocks[:, index] += delta_stock
+    accounts[env_ids] = sub_accounts
+    stocks[env_ids] = sub_stocks
+
+
+def execute_orders_loop(account, stocks, actions, prices, fee_percent):  # the loop in the old env.step()
+    for index in range(len(actions)):
+        action = actions[index]
+        adj = prices[index]
+        if action > 0:  # buy_stock
+            available_amount = account // adj
+            delta_stock = min(available_amount, action)
+            account -= adj * delta_stock * (1 + fee_percent)
+            stocks[index] += delta_stock
+        elif stocks[index] > 0:  # sell_stock
+            delta_stock = min(-action, stocks[index])
+            account += adj * delta_stock * (1 - fee_percent)
+            stocks[index] -= delta_stock
+    return account
+
+
+def check__execute_orders(cases=((30, 2 ** 12), (2 ** 10, 2 ** 6)), fee_percent=1e-3):
+    """execute_orders() and execute_orders_vec() give the same account and stocks as the loop, cash cut or not
+
+    cases: (stock_dim, check_times). The loop runs in float64 as execute_orders() does: the rounding of the costs to
+    float32 (the old env.step()) cuts a buy by one share now and then, and the orders after it differ.
+    """
+    for stock_dim, check_times in cases:
+        for i in range(check_times):
+            account = float(rd.choice((1e6, 1e4, 1e2)))  # less cash: more buys are cut by the cash
+            stocks = rd.randint(0, 100, size=stock_dim).astype(np.float32) * rd.randint(0, 2, size=stock_dim)
+            actions = rd.uniform(-1, 1, size=stock_dim).astype(np.float32) * 100
+            prices = rd.uniform(1, 500, size=stock_dim).astype(np.float32)
+
+            stocks0 = stocks.astype(np.float64)
+            account0 = execute_orders_loop(account, stocks0, actions.astype(np.float64), prices.astype(np.float64),
+                                           fee_percent)
+            stocks1 = stocks.copy()
+            account1 = execute_orders(account, stocks1, actions, prices, fee_percent)
+            turnover = float(np.abs(prices * actions).sum())  # the sum of the costs is in another order
+            assert np.isclose(account0, account1, rtol=0, atol=turnover * 1e-9), (stock_dim, i, account0, account1)
+            assert np.allclose(stocks0, stocks1), (stock_dim, i, stocks0, stocks1)
+        print(f'| check__execute_orders: the same as the loop in {check_times} random cases of {stock_dim} stocks')
+
+        env_num = 2 ** 6  # execute_orders_vec() of portfolios with different cash, cut or not
+        accounts = rd.choice((1e6, 1e4, 1e2), size=env_num)
+        stocks = rd.randint(0, 100, size=(env_num, stock_dim)).astype(np.float32)
+        actions = rd.uniform(-1, 1, size=(env_num, stock_dim)).astype(np.float32) * 100
+        prices = rd.uniform(1, 500, size=(env_num, stock_dim)).astype(np.float32)
+
+        stocks0 = stocks.astype(np.float64)
+        accounts0 = [execute_orders_loop(accounts[i], stocks0[i], actions[i].astype(np.float64),
+                                         prices[i].astype(np.float64), fee_percent) for i in range(env_num)]
+        stocks1 = stocks.copy()
+        accounts1 = accounts.copy()
+        execute_orders_vec(accounts1, stocks1, actions, prices, fee_percent)
+        turnovers = np.abs(prices * actions).sum(axis=1)
+        assert np.allclose(accounts0, accounts1, rtol=0, atol=turnovers.max() * 1e-9), (accounts0, accounts1)
+        assert np.allclose(stocks0, stocks1), (stocks0, stocks1)
+        print(f'| check__execute_orders: execute_orders_vec() is the same as the loop in {env_num} portfolios '
+              f'of {stock_dim} stocks')
+
+
+'''synthetic envs: pure NumPy and CPU-only, to benchmark the replay buffer, learner and rollout on their own'''
+
+
+class SyntheticVecEnv(ABC):
+    """the base of the batched synthetic envs, in the form of FinanceMultiStockVecEnv
+
+    reset() returns states [env_num, state_dim], step(actions) returns (states, rewards [env_num], dones [env_num],
+    None) and resets the envs that are done (a terminal state, or max_step steps).
+    A subclass sets self.states in reset_envs(env_ids), and updates self.states and returns (rewards, dones)
+    in transit(actions). step_cost: the seconds of busy CPU work per env step, to play a slow simulator.
+    """
+
+    def __init__(self, env_num, state_dim, action_dim, max_step, step_cost):
+        self.env_num = env_num
+        self.state_dim = state_dim
+        self.action_dim = action_dim
+        self.max_step = max_step
+        self.step_cost = step_cost
+
+        self.states = np.zeros((env_num, state_dim), dtype=np.float32)
+        self.steps = np.zeros(env_num, dtype=np.int64)
+        self.running_returns = np.zeros(env_num, dtype=np.float64)
+        self.episode_returns = np.zeros(env_num, dtype=np.float64)  # of the last finished episode
+
+    def reset(self):
+        self.steps[:] = 0
+        self.running_returns[:] = 0.0
+        self.reset_envs(np.arange(self.env_num))
+        return self.states.copy()
+
+    def step(self, actions):
+        if self.step_cost:
+            spin(self.step_cost * self.env_num)
+        rewards, dones = self.transit(actions)
+        self.steps += 1
+        dones |= self.steps == self.max_step
+        self.running_returns += rewards
+
+        done_ids = np.flatnonzero(dones)
+        if done_ids.size:
+            self.episode_returns[done_ids] = self.running_returns[done_ids]
+            self.running_returns[done_ids] = 0.0
+            self.steps[done_ids] = 0
+            self.reset_envs(done_ids)  # auto-reset, the states of these envs are the states after reset
+        return self.states.copy(), rewards.astype(np.float32), dones, None
+
+    @abstractmethod
+    def reset_envs(self, env_ids):
+        pass
+
+    @abstractmethod
+    def transit(self, actions) -> (np.ndarray, np.ndarray):
+        pass
+
+
+class SyntheticEnv:
+    """a synthetic env of the batched one with env_num=1, in the form of a gym env after decorate_env()
+
+    For example: class LQREnv(SyntheticEnv, LQRVecEnv)
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(1, *args, **kwargs)
+
+    def reset(self):
+        return super().reset()[0]
+
+    def step(self, action):
+        states, rewards, dones, _ = super().step(np.expand_dims(action, 0))
+        return states[0], float(rewards[0]), bool(dones[0]), None
+
+
+def spin(seconds):  # busy CPU work (not sleep), it holds the CPU and the GIL like a Python simulator
+    end_time = time.perf_counter() + seconds
+    while time.perf_counter() < end_time:
+        pass
+
+
+class LQRVecEnv(SyntheticVecEnv):
+    """linear-quadratic regulator: state' = A state + B action + noise, reward = -(state'^2 + 0.1 action^2) / state_dim
+
+    A is a random rotation (marginally stable, the noise accumulates without control), the actions are in [-1, 1].
+    target_reward is the return of the optimal linear controller (from the Riccati equation) plus a margin.
+    """
+
+    def __init__(self, env_num, state_dim=2 ** 3, action_dim=2 ** 2, max_step=2 ** 8, step_cost=0.0, seed=0,
+                 noise_std=0.1, action_cost=0.1):
+        super().__init__(env_num, state_dim, action_dim, max_step, step_cost)
+        rs = np.random.RandomState(seed)  # the same system in all the processes
+        self.mat_a = np.linalg.qr(rs.normal(0, 1, size=(state_dim, state_dim)))[0]
+        self.mat_b = rs.normal(0, 1, size=(state_dim, action_dim)) * action_dim ** -0.5
+        self.noise_std = noise_std
+        self.action_cost = action_cost
+
+        '''env information'''
+        self.env_name = 'LQR-v0'
+        self.if_discrete = False
+        self.target_reward = get_lqr_optimal_return(self.mat_a, self.mat_b, action_cost, noise_std, max_step) * 1.25
+
+    def reset_envs(self, env_ids):
+        self.states[env_ids] = rd.normal(0, 1, size=(len(env_ids), self.state_dim))
+
+    def transit(self, actions):
+        actions = np.clip(actions, -1, 1)
+        states = self.states @ self.mat_a.T + actions @ self.mat_b.T
+        states += rd.normal(0, self.noise_std, size=states.shape)
+        self.states[:] = states
+        rewards = -((states ** 2).sum(axis=1) + self.action_cost * (actions ** 2).sum(axis=1)) / self.state_dim
+        return rewards, np.zeros(self.env_num, dtype=np.bool_)
+
+
+def get_lqr_optimal_return(mat_a, mat_b, action_cost, noise_std, max_step, iter_num=2 ** 10) -> float:
+    """the expected return of the optimal linear controller of LQRVecEnv (without the action bound),
+    from the Riccati equation of the cost-to-go matrix P (the reward is the negative cost)"""
+    state_dim, action_dim = mat_b.shape
+    mat_p = np.zeros((state_dim, state_dim))
+    for _ in range(iter_num):  # V(x) = x'Px = min_a E[(Ax + Ba + w)'(I + P)(Ax + Ba + w)] + action_cost * a'a
+        mat_m = np.eye(state_dim) + mat_p
+        mat_k = np.linalg.solve(action_cost * np.eye(action_dim) + mat_b.T @ mat_m @ mat_b, mat_b.T @ mat_m @ mat_a)
+        mat_ab = mat_a - mat_b @ mat_k
+        mat_p = mat_ab.T @ mat_m @ mat_ab + action_cost * mat_k.T @ mat_k
+    noise_cost = np.trace(np.eye(state_dim) + mat_p) * noise_std ** 2  # E[w'(I + P)w] of each step
+    return -(np.trace(mat_p) + noise_cost * max_step) / state_dim  # the initial state ~ N(0, I)
+
+
+class ChainMDPVecEnv(SyntheticVecEnv):
+    """a chain of state_dim states (one-hot), a deep exploration task with discrete actions
+
+    Start at the left end. Action 0 moves right and the other action_dim - 1 actions move left. Staying at
+    the left end gives a small reward 1e-3, and reaching the right end gives 1 (a terminal state).
+    """
+
+    def __init__(self, env_num, state_dim=2 ** 5, action_dim=2, max_step=None, step_cost=0.0):
+        max_step = state_dim * 2 if max_step is None else max_step
+        super().__init__(env_num, state_dim, action_dim, max_step, step_cost)
+        self.positions = np.zeros(env_num, dtype=np.int64)
+
+        '''env information'''
+        self.env_name = 'ChainMDP-v0'
+        self.if_discrete = True
+        self.target_reward = 0.9
+
+    def reset_envs(self, env_ids):
+        self.positions[env_ids] = 0
+        self.states[env_ids] = 0
+        self.states[env_ids, 0] = 1
+
+    def transit(self, actions):
+        env_ids = np.arange(self.env_num)
+        self.states[env_ids, self.positions] = 0
+        self.positions = np.clip(self.positions + np.where(actions == 0, 1, -1), 0, self.state_dim - 1)
+        self.states[env_ids, self.positions] = 1
+
+        dones = self.positions == self.state_dim - 1
+        rewards = np.where(dones, 1.0, np.where(self.positions == 0, 1e-3, 0.0))
+        return rewards, dones
+
+
+class PointMassVecEnv(SyntheticVecEnv):
+    """a point mass in action_dim dimensions (state: position and velocity, state_dim = 2 * action_dim)
+
+    velocity' = 0.9 velocity + 0.1 action, position' = position + 0.1 velocity', the actions are in [-1, 1].
+    The reward is the progress towards the origin, the return is about 1 when the point mass reaches it.
+    """
+
+    def __init__(self, env_num, action_dim=2 ** 6, max_step=2 ** 8, step_cost=0.0):
+        super().__init__(env_num, action_dim * 2, action_dim, max_step, step_cost)
+        self.distances = np.zeros(env_num, dtype=np.float64)
+        self.reward_scale = (action_dim / 3) ** -0.5  # 1 / the expected initial distance
+
+        '''env information'''
+        self.env_name = 'PointMass-v0'
+        self.if_discrete = False
+        self.target_reward = 0.8
+
+    def reset_envs(self, env_ids):
+        self.states[env_ids, :self.action_dim] = rd.uniform(-1, 1, size=(len(env_ids), self.action_dim))
+        self.states[env_ids, self.action_dim:] = 0
+        self.distances[env_ids] = np.linalg.norm(self.states[env_ids, :self.action_dim], axis=1)
+
+    def transit(self, actions):
+        positions = self.states[:, :self.action_dim]
+        velocities = self.states[:, self.action_dim:]
+        velocities *= 0.9
+        velocities += np.clip(actions, -1, 1) * 0.1
+        positions += velocities * 0.1
+
+        distances = np.linalg.norm(positions, axis=1)
+        rewards = (self.distances - distances) * self.reward_scale
+        self.distances = distances
+        return rewards, np.zeros(self.env_num, dtype=np.bool_)
+
+
+class LQREnv(SyntheticEnv, LQRVecEnv):
+    pass
+
+
+class ChainMDPEnv(SyntheticEnv, ChainMDPVecEnv):
+    pass
+
+
+class PointMassEnv(SyntheticEnv, PointMassVecEnv):
+    pass
+
+
+if __name__ == '__main__':
+    check__execute_orders()
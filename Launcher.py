@@ -0,0 +1,289 @@
+import os
+import time
+import numpy as np
+import multiprocessing as mp
+from Metrics import read_metrics
+
+
+def launch_runs(args_list, cpus_per_run=None):
+    """run many train_and_evaluate() jobs (seeds, envs, algorithms) on one machine
+
+    A persistent pool of worker processes is forked once. Each worker is pinned to a disjoint set of
+    CPU cores (os.sched_setaffinity), sets `args.num_threads` to the size of its core set,
+    and runs the configurations it takes from the task queue one by one.
+    Return the summary of all runs, with each run's metrics loaded from `cwd/metrics.bin`.
+    """
+    cpu_ids = sorted(os.sched_getaffinity(0))
+    if cpus_per_run is None:
+        cpus_per_run = max(1, len(cpu_ids) // len(args_list))
+    cpus_per_run = min(cpus_per_run, len(cpu_ids))
+    worker_num = min(len(args_list), len(cpu_ids) // cpus_per_run)
+    cpu_sets = [cpu_ids[i * cpus_per_run:(i + 1) * cpus_per_run] for i in range(worker_num)]
+
+    for run_id, args in enumerate(args_list):  # not derive the run id from sys.argv
+        args.gpu_id = 0 if args.gpu_id is None else args.gpu_id
+        if args.cwd is None:
+            args.cwd = f'./{args.agent_rl.__name__}/{args.env.env_name}_run{run_id}'
+
+    ctx = mp.get_context('fork')  # the workers inherit args_list, the env in args is not always picklable
+    task_queue = ctx.SimpleQueue()
+    result_queue = ctx.SimpleQueue()
+    workers = [ctx.Process(target=mp__launcher_worker, args=(args_list, cpu_set, task_queue, result_queue))
+               for cpu_set in cpu_sets]
+    [worker.start() for worker in workers]
+
+    for run_id in range(len(args_list)):
+        task_queue.put(run_id)
+    for _ in workers:
+        task_queue.put(None)  # stop signal
+
+    summary = [result_queue.get() for _ in args_list]
+    [worker.join() for worker in workers]
+    summary.sort(key=lambda run: run['run_id'])
+
+    print_summary(summary)
+    return summary
+
+
+def mp__launcher_worker(args_list, cpu_set, task_queue, result_queue):
+    os.sched_setaffinity(0, cpu_set)
+    from Main import train_and_evaluate
+
+    while True:
+        run_id = task_queue.get()
+        if run_id is None:
+            break
+
+        args = args_list[run_id]
+        args.num_threads = len(cpu_set)
+
+        start_time = time.time()
+        try:
+            train_and_evaluate(args)
+            error = None
+        except Exception as exception:  # keep the other runs going
+            error = repr(exception)
+        used_time = time.time() - start_time
+        result_queue.put(get_run_summary(run_id, args, cpu_set, used_time, error))
+
+
+def get_run_summary(run_id, args, cpu_set, used_time, error=None):
+    metrics = read_metrics(args.cwd)
+    total_step = int(metrics['total_step'][-1]) if len(metrics) else 0
+
+    return {'run_id': run_id,
+            'agent': args.agent_rl.__name__,
+            'env_name': args.env.env_name,
+            'cwd': args.cwd,
+            'cpu_set': list(cpu_set),
+            'total_step': total_step,
+            'r_max': float(metrics['r_avg'].max()) if len(metrics) else -np.inf,
+            'used_time': used_time,
+            'step_per_sec': total_step / used_time,
+            'metrics': metrics,
+            'error': error}
+
+
+def print_summary(summary):
+    print(f"| {'ID':>3}  {'Agent':>12}  {'Env':>24}  {'CPUs':>5}  {'Step':>8}  {'MaxR':>8}  "
+          f"{'UsedTime':>8}  {'Step/s':>8}")
+    for run in summary:
+        print(f"| {run['run_id']:3}  {run['agent']:>12}  {run['env_name']:>24}  {len(run['cpu_set']):5}  "
+              f"{run['total_step']:8.2e}  {run['r_max']:8.2f}  {run['used_time']:8.0f}  {run['step_per_sec']:8.1f}"
+              + (f"  {run['error']}" if run['error'] else ''))
+
+
+def sweep_asha(args, search_space, trial_num=None, cpus_per_trial=1, min_step=2 ** 14, eta=3,
+               cwd='./sweep', poll_gap=2.0, if_early_stop=True):
+    """hyper-parameter sweep with Asynchronous Successive Halving (ASHA)
+
+    `search_space` maps the attribute names of Arguments to candidate values, such as
+    {'net_dim': (2 ** 7, 2 ** 8), 'gamma': (0.95, 0.99)}. The full grid is swept if `trial_num` is None,
+    otherwise `trial_num` configurations are sampled from the grid.
+
+    The trials run in parallel, each one pinned to its own `cpus_per_trial` cores. When a trial crosses
+    a rung budget `min_step * eta ** k` (env steps, below args.break_step), its best evaluation return
+    so far is compared with the trials that crossed the same rung before: unless it is in the top 1/eta,
+    it is stopped by `cwd/stop`. The freed cores start the next trial at once, without waiting for
+    the other trials of the rung. `if_early_stop=False` runs the full grid to args.break_step.
+    Return the result table (numpy structured array), also saved in `cwd/sweep_table.npy`.
+    """
+    import itertools
+    from copy import deepcopy
+
+    names = list(search_space.keys())
+    configs = list(itertools.product(*[search_space[name] for name in names]))
+    if trial_num is not None and trial_num < len(configs):
+        configs = [configs[i] for i in np.random.permutation(len(configs))[:trial_num]]
+
+    rungs = [min_step * eta ** k for k in range(64) if min_step * eta ** k < args.break_step]
+    rung_r_maxs = [list() for _ in rungs]  # the best return of the trials when they cross the rung
+
+    cpu_ids = sorted(os.sched_getaffinity(0))
+    cpus_per_trial = min(cpus_per_trial, len(cpu_ids))
+    free_cpu_sets = [cpu_ids[i * cpus_per_trial:(i + 1) * cpus_per_trial]
+                     for i in range(len(cpu_ids) // cpus_per_trial)]
+
+    trials = list()
+    for trial_id, config in enumerate(configs):
+        trial_args = deepcopy(args)
+        for name, value in zip(names, config):
+            setattr(trial_args, name, value)
+        trial_args.gpu_id = 0 if trial_args.gpu_id is None else trial_args.gpu_id
+        trial_args.cwd = f'{cwd}/trial_{trial_id:04}'
+        trial_args.if_remove = True
+        trials.append({'trial_id': trial_id, 'config': config, 'args': trial_args, 'process': None,
+                       'cpu_set': None, 'rung': 0, 'if_stopped': False, 'start_time': 0.0, 'used_time': 0.0,
+                       'total_step': 0, 'r_max': -np.inf})
+    os.makedirs(cwd, exist_ok=True)
+
+    ctx = mp.get_context('fork')
+    pending = list(reversed(trials))
+    running = list()
+    while pending or running:
+        while pending and free_cpu_sets:  # reallocate the freed cores to new trials
+            trial = pending.pop()
+            trial['cpu_set'] = free_cpu_sets.pop()
+            trial['process'] = ctx.Process(target=mp__sweep_trial, args=(trial['args'], trial['cpu_set']))
+            trial['start_time'] = time.time()
+            trial['process'].start()
+            running.append(trial)
+
+        time.sleep(poll_gap)
+        for trial in list(running):
+            if_alive = trial['process'].is_alive()  # check it before reading the final metrics
+
+            metrics = read_metrics(trial['args'].cwd)
+            if len(metrics):
+                trial['total_step'] = int(metrics['total_step'][-1])
+                trial['r_max'] = float(metrics['r_avg'].max())
+
+            while trial['rung'] < len(rungs) and trial['total_step'] >= rungs[trial['rung']]:
+                rung = trial['rung']
+                r_max = float(metrics['r_avg'][metrics['total_step'] <= rungs[rung]].max(initial=-np.inf))
+                rung_r_maxs[rung].append(r_max)
+                trial['rung'] += 1
+
+                cutoff = np.percentile(rung_r_maxs[rung], (1 - 1 / eta) * 100)
+                if if_early_stop and if_alive and not trial['if_stopped'] and r_max < cutoff:
+                    trial['if_stopped'] = True
+                    open(f"{trial['args'].cwd}/stop", 'w').close()  # train_and_evaluate() breaks the loop
+
+            if not if_alive:
+                trial['process'].join()
+                trial['used_time'] = time.time() - trial['start_time']
+                free_cpu_sets.append(trial['cpu_set'])
+                running.remove(trial)
+                print(f"| Trial {trial['trial_id']:4}  {'stopped' if trial['if_stopped'] else 'finished':>8}  "
+                      f"Step {trial['total_step']:8.2e}  MaxR {trial['r_max']:8.2f}")
+
+    dtype = [('trial_id', np.int32)] + [(name, np.float64) for name in names] + [
+        ('rung', np.int32), ('total_step', np.int64), ('r_max', np.float32), ('used_time', np.float32),
+        ('if_stopped', np.bool_)]
+    table = np.array([(trial['trial_id'], *trial['config'], trial['rung'], trial['total_step'], trial['r_max'],
+                       trial['used_time'], trial['if_stopped']) for trial in trials], dtype=dtype)
+    np.save(f'{cwd}/sweep_table.npy', table)
+
+    print(f"| {'ID':>4}  " + ''.join(f"{name:>12}  " for name in names) + f"{'Rung':>4}  {'Step':>8}  {'MaxR':>8}")
+    for row in np.sort(table, order='r_max')[::-1]:
+        print(f"| {row['trial_id']:4}  " + ''.join(f"{row[name]:12.4g}  " for name in names) +
+              f"{row['rung']:4}  {row['total_step']:8.2e}  {row['r_max']:8.2f}")
+    return table
+
+
+def mp__sweep_trial(args, cpu_set):
+    os.sched_setaffinity(0, cpu_set)
+    args.num_threads = len(cpu_set)
+    from Main import train_and_evaluate
+    train_and_evaluate(args)
+
+
+'''benchmark'''
+
+
+def run__launcher_benchmark(args_list):
+    """aggregate throughput (env steps per second of all runs): launch_runs() vs launching runs by hand
+
+    By hand means one process per run, all started at once, without core pinning,
+    each one with the default `args.num_threads`.
+    """
+    from copy import deepcopy
+    from Main import train_and_evaluate
+
+    args_list_by_hand = deepcopy(args_list)
+    for run_id, args in enumerate(args_list_by_hand):
+        args.gpu_id = 0 if args.gpu_id is None else args.gpu_id
+        args.cwd = f'./{args.agent_rl.__name__}/{args.env.env_name}_hand{run_id}'
+
+    ctx = mp.get_context('fork')
+    start_time = time.time()
+    processes = [ctx.Process(target=train_and_evaluate, args=(args,)) for args in args_list_by_hand]
+    [process.start() for process in processes]
+    [process.join() for process in processes]
+    used_time_by_hand = time.time() - start_time
+    step_by_hand = sum(get_run_summary(run_id, args, (), used_time_by_hand)['total_step']
+                       for run_id, args in enumerate(args_list_by_hand))
+
+    start_time = time.time()
+    summary = launch_runs(args_list)
+    used_time = time.time() - start_time
+    step = sum(run['total_step'] for run in summary)
+
+    print(f"| {'Launch':>8}  {'Step':>8}  {'UsedTime':>8}  {'Step/s':>8}\n"
+          f"| {'by hand':>8}  {step_by_hand:8.2e}  {used_time_by_hand:8.0f}  {step_by_hand / used_time_by_hand:8.1f}\n"
+          f"| {'launcher':>8}  {step:8.2e}  {used_time:8.0f}  {step / used_time:8.1f}")
+
+
+def run__sweep_benchmark(args, search_space, **kwargs):
+    """wall-clock time of the ASHA sweep vs the full grid (every trial runs to args.break_step)"""
+    start_time = time.time()
+    table_grid = sweep_asha(args, search_space, cwd='./sweep_grid', if_early_stop=False, **kwargs)
+    used_time_grid = time.time() - start_time
+
+    start_time = time.time()
+    table_asha = sweep_asha(args, search_space, cwd='./sweep_asha', if_early_stop=True, **kwargs)
+    used_time_asha = time.time() - start_time
+
+    print(f"| {'Sweep':>6}  {'UsedTime':>8}  {'TotalStep':>9}  {'BestR':>8}\n"
+          f"| {'grid':>6}  {used_time_grid:8.0f}  {table_grid['total_step'].sum():9.2e}  "
+          f"{table_grid['r_max'].max():8.2f}\n"
+          f"| {'ASHA':>6}  {used_time_asha:8.0f}  {table_asha['total_step'].sum():9.2e}  "
+          f"{table_asha['r_max'].max():8.2f}\n"
+          f"| Wall-clock saving: {1 - used_time_asha / used_time_grid:.1%}")
+
+
+def run__sweep_demo():
+    import Agent
+    from Env import FinanceMultiStockEnv
+    from Main import Arguments
+
+    args = Arguments(agent_rl=Agent.AgentPPO, env=FinanceMultiStockEnv(), if_on_policy=True)
+    args.max_step = 1699
+    args.max_memo = (args.max_step - 1) * 16
+    args.break_step = int(2 ** 22)
+    args.if_break_early = False
+    search_space = {'net_dim': (2 ** 7, 2 ** 8, 2 ** 9),
+                    'batch_size': (2 ** 9, 2 ** 11),
+                    'repeat_times': (2 ** 3, 2 ** 4),
+                    'reward_scale': (2 ** -2, 2 ** 0),
+                    'gamma': (0.95, 0.99)}
+    sweep_asha(args, search_space, trial_num=32, min_step=2 ** 17, eta=3)
+
+
+def run__launcher_demo():
+    import gym
+    import Agent
+    from Env import decorate_env
+    from Main import Arguments
+
+    args_list = list()
+    for random_seed in range(4):
+        args = Arguments(agent_rl=Agent.AgentSAC, env=decorate_env(gym.make('LunarLanderContinuous-v2')))
+        args.random_seed = random_seed
+        args.break_step = 2 ** 16
+        args_list.append(args)
+    run__launcher_benchmark(args_list)
+
+
+if __name__ == '__main__':
+    run__launcher_demo()
@@ -3,6 +3,10 @@ import time
 import torch
 import numpy as np
 import numpy.random as rd
+from Profiler import timer, alloc_tracker, OpProfiler
+from Metrics import MetricsLog
+from Checkpoint import AsyncSaver, clone_to_cpu, get_train_state, load_train_state
+from Monitor import LiveMetrics
 
 
 class Arguments:
@@ -17,6 +21,7 @@ class Arguments:
         self.batch_size = 2 ** 7  # num of transitions sampled from replay buffer.
         self.repeat_times = 2 ** 0  # repeatedly update network to keep critic's loss small
         self.max_memo = 2 ** 17  # capacity of replay buffer
+        self.memory_budget = None  # bytes or '6GB': fit max_memo (batch_size, net_dim) to it, see Planner.py
         if if_on_policy:
             self.net_dim = 2 ** 9
             self.batch_size = 2 ** 8
@@ -27,13 +32,26 @@ class Arguments:
         self.gamma = 0.99  # discount factor of future rewards
         self.rollout_num = 2  # the number of rollout workers (larger is not always faster)
         self.num_threads = 4  # cpu_num for evaluate model, torch.set_num_threads(self.num_threads)
+        self.learner_num = 1  # the number of data-parallel learner processes (torch.distributed), see Parallel.py
+        self.if_hogwild = False  # learners update the parameters in shared memory without lock (A3C style)
+        self.seed_num = 1  # train seed_num copies (random_seed + i) in one process with vmap, see MultiSeed.py
 
         '''Arguments for evaluate'''
         self.if_remove = True  # remove the cwd folder? (True, False, None:ask me)
         self.if_break_early = True  # break training after 'eval_reward > target reward'
         self.break_step = 2 ** 20  # break training after 'total_step > break_step'
         self.eval_times = 2 ** 3  # evaluation times if 'eval_reward > target_reward'
+        self.eval_gap_step = 0  # evaluate after eval_gap_step env steps (0: not by step), see EvalScheduler
+        self.eval_gap_time = 0  # evaluate after eval_gap_time seconds (0: not by time), both 0: every round
+        self.eval_time_ratio = None  # cap the evaluation time to this fraction of the elapsed time (None: no cap)
+        self.if_eval_sequential = False  # stop the evaluation episodes once it is clear whether r_avg > r_max
         self.show_gap = 2 ** 8  # show the Reward and Loss value per show_gap seconds
+        self.if_timer = False  # show per-phase timers per show_gap seconds, save a Chrome trace in cwd/trace.json
+        self.if_alloc = False  # count the allocations, gc pauses and peak RSS of each phase (slow), see AllocTracker
+        self.profile_window = None  # (round_id, beg_iter, end_iter): torch.profiler on these updates, see OpProfiler
+        self.metrics_port = 0  # serve live metrics on http://127.0.0.1:metrics_port/metrics (0: off), see Monitor.py
+        self.checkpoint_gap = 0  # save the full training state in cwd/checkpoint.pth per checkpoint_gap seconds, 0: off
+        self.resume_path = None  # resume training from a checkpoint.pth, see Checkpoint.py
         self.random_seed = 0  # initialize random seed in self.init_before_training(
 
     def init_before_training(self):
@@ -43,6 +61,8 @@ class Arguments:
         print(f'| GPU id: {self.gpu_id}, cwd: {self.cwd}')
 
         import shutil  # remove history according to bool(if_remove)
+        if self.resume_path is not None:
+            self.if_remove = False  # keep the metrics log and actor.pth of the run to resume
         if self.if_remove is None:
             self.if_remove = bool(input("PRESS 'y' to REMOVE: {}? ".format(self.cwd)) == 'y')
         if self.if_remove:
@@ -103,7 +123,19 @@ def run__demo():
 
 
 def train_and_evaluate(args):
+    if args.seed_num > 1:  # vectorized multi-seed training in a single process
+        from MultiSeed import train_and_evaluate__multi_seed
+        return train_and_evaluate__multi_seed(args)
+    if args.learner_num > 1 and args.if_hogwild:  # lock-free learners on shared parameters
+        from Parallel import train_and_evaluate__hogwild
+        return train_and_evaluate__hogwild(args)
+    if args.learner_num > 1:  # data-parallel learners in K processes
+        from Parallel import train_and_evaluate__data_parallel
+        return train_and_evaluate__data_parallel(args)
     args.init_before_training()
+    if args.memory_budget is not None:  # set max_memo, batch_size and net_dim, or raise MemoryError before allocation
+        from Planner import plan_memory
+        plan_memory(args)
 
     agent_rl = args.agent_rl  # basic arguments
     agent_id = args.gpu_id
@@ -120,8 +152,16 @@ def train_and_evaluate(args):
 
     show_gap = args.show_gap  # evaluate arguments
     eval_times = args.eval_times
+    scheduler = EvalScheduler(args.eval_gap_step, args.eval_gap_time, args.eval_time_ratio)
+    if_eval_sequential = args.if_eval_sequential
     break_step = args.break_step
     if_break_early = args.if_break_early
+    if_timer = args.if_timer
+    if_alloc = args.if_alloc
+    profile_window = args.profile_window
+    metrics_port = args.metrics_port
+    checkpoint_gap = args.checkpoint_gap
+    resume_path = args.resume_path
     del args  # In order to show these hyper-parameters clearly, I put them above.
 
     '''init: env'''
@@ -133,38 +173,90 @@ def train_and_evaluate(args):
     env_eval = deepcopy(env)
     del deepcopy
 
-    evaluator = Evaluator(cwd, agent_id, eval_times, show_gap, target_reward)  # build Evaluator
+    evaluator = Evaluator(cwd, agent_id, eval_times, show_gap, target_reward,
+                          if_append=resume_path is not None, scheduler=scheduler,
+                          if_sequential=if_eval_sequential)  # build Evaluator
     agent = agent_rl(net_dim, state_dim, action_dim)  # build AgentRL
     agent.state = env.reset()
 
-    if_on_policy = agent_rl.__name__ in {'AgentPPO', 'AgentGaePPO'}  # build ReplayBuffer
+    if_on_policy = getattr(agent_rl, 'if_on_policy', False)  # build ReplayBuffer
     if if_on_policy:
         buffer = ReplayBufferCPU(max_memo, state_dim, action_dim=1 if if_discrete else action_dim)
-        steps = 0
     else:
         buffer = ReplayBufferGPU(max_memo, state_dim, action_dim=1 if if_discrete else action_dim)
+    if if_timer:  # nothing is wrapped when if_timer is False, so the timers cost nothing
+        timer.instrument(env, agent, buffer, evaluator)
+    if if_alloc:  # before OpProfiler, it restores the methods it wraps to the wrappers of AllocTracker
+        alloc_tracker.instrument(cwd, env, agent, buffer, evaluator)
+    if profile_window is not None:  # nothing is wrapped outside the window of gradient updates
+        op_profiler = OpProfiler(*profile_window)
+        op_profiler.instrument(agent, cwd)
+    live_metrics = LiveMetrics(metrics_port)
+    if metrics_port:  # nothing is wrapped and no thread is started when metrics_port is 0
+        live_metrics.start(agent, buffer, evaluator)
+
+    if resume_path is not None:  # the training env is reset, the others are restored
+        steps = load_train_state(resume_path, agent, buffer, evaluator)
+    elif if_on_policy:
+        steps = 0
+    else:
         with torch.no_grad():  # update replay buffer
             steps = explore_before_train(env, buffer, max_step, reward_scale, gamma)
         agent.update_policy(buffer, max_step, batch_size, repeat_times)  # pre-training and hard update
         agent.act_target.load_state_dict(agent.act.state_dict()) if 'act_target' in dir(agent) else None
     total_step = steps
+    live_metrics.total_step = total_step
+
+    saver = AsyncSaver()  # write the checkpoint on a background thread
+    checkpoint_time = time.time()
 
     if_solve = False
     while not ((if_break_early and if_solve) or total_step > break_step or os.path.exists(f'{cwd}/stop')):
         with torch.no_grad():  # speed up running
             steps = agent.update_buffer(env, buffer, max_step, reward_scale, gamma)
         total_step += steps
+        live_metrics.total_step = total_step  # read by the metrics server thread, no lock
 
         buffer.update__now_len__before_sample()
         agent.update_policy(buffer, max_step, batch_size, repeat_times)
 
         with torch.no_grad():  # speed up running
             evaluator.evaluate_and_save(env_eval, agent.act, agent.device, steps, agent.obj_a, agent.obj_c)
+        if_solve = evaluator.used_time is not None  # used_time is set when r_max > target_reward
+
+        if checkpoint_gap and time.time() - checkpoint_time > checkpoint_gap:
+            checkpoint_time = time.time()
+            saver.save(lambda: get_train_state(agent, buffer, evaluator, total_step), f'{cwd}/checkpoint.pth')
+
+    if evaluator.scheduler.eval_step < evaluator.total_step:  # the last rounds were not evaluated
+        with torch.no_grad():
+            evaluator.evaluate_and_save(env_eval, agent.act, agent.device, 0, agent.obj_a, agent.obj_c, if_force=True)
+    if checkpoint_gap:  # the last checkpoint, for training more steps later
+        saver.save(lambda: get_train_state(agent, buffer, evaluator, total_step), f'{cwd}/checkpoint.pth')
+    saver.close('Checkpoint')
+    evaluator.close()
+    live_metrics.close()
+    op_profiler.close() if profile_window is not None else None
+    alloc_tracker.close(cwd)
+    timer.close(cwd)
 
 
 '''utils'''
 
 
+def check_single_process_args(args, mode):
+    """raise ValueError if args set an option that only the single-process loop of train_and_evaluate() has
+
+    mode: the name of the multi-process or multi-seed training, such as 'learner_num=4', for the message
+    """
+    defaults = {'memory_budget': None, 'if_timer': False, 'if_alloc': False, 'profile_window': None,
+                'metrics_port': 0, 'checkpoint_gap': 0, 'resume_path': None}
+    names = [name for name, default in defaults.items() if getattr(args, name) != default]
+    if names:
+        raise ValueError(f'| train_and_evaluate: {", ".join(names)} not supported with {mode}, '
+                         f'unset them or train in a single process')
+
+
 def explore_before_train(env, buffer, target_step, reward_scale, gamma):
     # just for off-policy. Because on-policy don't explore before training.
     if_discrete = env.if_discrete
@@ -267,9 +359,53 @@ class ReplayBufferGPU(ReplayBufferBase):
                 self.all_state[indices + 1])  # next_state
 
 
+class EvalScheduler:
+    """when Evaluator evaluates: after eval_gap_step env steps or eval_gap_time seconds since the last evaluation
+
+    The gaps grow from 1 time (the last r_avg is near r_max or target_reward) to gap_scale times (it is far from
+    both, in the range of r_avg seen so far), so the evaluations are dense where a new best or the target is near.
+    eval_time_ratio: no evaluation while the evaluations have used more than this fraction of the elapsed time.
+    None (or >= 1) is no cap. Both gaps are 0 and no cap (the default): evaluate after each training round.
+    """
+
+    def __init__(self, eval_gap_step=0, eval_gap_time=0, eval_time_ratio=None, gap_scale=2 ** 3):
+        self.eval_gap_step = eval_gap_step
+        self.eval_gap_time = eval_gap_time
+        self.eval_time_ratio = eval_time_ratio
+        self.gap_scale = gap_scale
+
+        self.gap_rate = 1.0  # the gaps are multiplied by gap_rate in [1, gap_scale]
+        self.r_min = np.inf
+        self.eval_step = 0  # total_step of the last evaluation
+        self.eval_time = time.time()  # the end time of the last evaluation
+        self.eval_time_sum = 0.0
+
+    def if_evaluate(self, total_step, elapsed_time) -> bool:
+        if self.eval_time_ratio is not None and self.eval_time_sum > self.eval_time_ratio * elapsed_time:
+            return False
+        if not (self.eval_gap_step or self.eval_gap_time):
+            return True
+        if_step = self.eval_gap_step and total_step - self.eval_step >= self.eval_gap_step * self.gap_rate
+        if_time = self.eval_gap_time and time.time() - self.eval_time >= self.eval_gap_time * self.gap_rate
+        return bool(if_step or if_time)
+
+    def update(self, total_step, eval_time, r_avg, r_max, target_reward):
+        self.eval_step = total_step
+        self.eval_time = time.time()
+        self.eval_time_sum += eval_time
+
+        self.r_min = min(self.r_min, r_avg)
+        r_range = r_max - self.r_min
+        distance = min(r_max - r_avg, abs(target_reward - r_avg))  # to a new best, or to the target
+        self.gap_rate = self.gap_scale ** min(distance / r_range, 1.0) if r_range > 0 else 1.0
+
+
 class Evaluator:
-    def __init__(self, cwd, agent_id, eval_times, show_gap, target_reward):
-        self.recorder = [(0., -np.inf, 0., 0., 0.), ]  # total_step, r_avg, r_std, obj_a, obj_c
+    def __init__(self, cwd, agent_id, eval_times, show_gap, target_reward, if_append=False, scheduler=None,
+                 if_sequential=False):
+        self.metrics = MetricsLog(cwd, if_append=if_append)  # total_step, r_avg, r_std, obj_a, obj_c and timing
+        self.saver = AsyncSaver()  # save actor.pth on a background thread
+        self.scheduler = EvalScheduler() if scheduler is None else scheduler  # evaluate or not
         self.r_max = -np.inf
         self.total_step = 0
 
@@ -278,15 +414,26 @@ class Evaluator:
         self.show_gap = show_gap
         self.eva_times = eval_times
         self.target_reward = target_reward
+        self.if_sequential = if_sequential  # see get_reward_list()
+        self.episode_num = 0  # the number of evaluation episodes
+        self.eval_num = 0
 
         self.used_time = None
         self.start_time = time.time()
         self.print_time = time.time()
         print(f"{'ID':>2}  {'Step':>8}  {'MaxR':>8} |{'avgR':>8}  {'stdR':>8}   {'objA':>8}  {'objC':>8}")
 
-    def evaluate_and_save(self, env, act, device, steps, obj_a, obj_c):
+    def evaluate_and_save(self, env, act, device, steps, obj_a, obj_c, if_force=False):
+        self.total_step += steps
+        if not (if_force or self.scheduler.if_evaluate(self.total_step, time.time() - self.start_time)):
+            return False
+
         if_save = False
-        reward_list = [get_episode_return(env, act, device) for _ in range(self.eva_times)]
+        start_time = time.time()
+        reward_list = self.get_reward_list(env, act, device)
+        eval_time = time.time() - start_time
+        self.episode_num += len(reward_list)
+        self.eval_num += 1
 
         r_avg = np.average(reward_list)  # episode return average
         if r_avg > self.r_max:  # check final
@@ -294,8 +441,11 @@ class Evaluator:
             if_save = True
         r_std = float(np.std(reward_list))  # episode return std
 
-        self.total_step += steps
-        self.recorder.append((self.total_step, r_avg, r_std, obj_a, obj_c))  # update recorder
+        scheduler = self.scheduler  # env steps per second of training since the last evaluation
+        step_per_sec = (self.total_step - scheduler.eval_step) / max(start_time - scheduler.eval_time, 1e-6)
+        scheduler.update(self.total_step, eval_time, r_avg, self.r_max, self.target_reward)
+        self.metrics.append(self.total_step, r_avg, r_std, obj_a, obj_c,
+                            scheduler.eval_time - self.start_time, step_per_sec, eval_time)
 
         if_solve = bool(self.r_max > self.target_reward)  # check if_solve
         if if_solve and self.used_time is None:
@@ -309,13 +459,48 @@ class Evaluator:
             self.print_time = time.time()
             print(f"{self.agent_id:<2}  {self.total_step:8.2e}  {self.r_max:8.2f} |"
                   f"{r_avg:8.2f}  {r_std:8.2f}   {obj_a:8.2f}  {obj_c:8.2f}")
+            print(timer.get_summary()) if timer.if_enable else None
+            print(alloc_tracker.get_summary()) if alloc_tracker.if_enable else None
 
         if if_save:  # save checkpoint with highest episode return
-            act_save_path = f'{self.cwd}/actor.pth'
-            torch.save(act.state_dict(), act_save_path)
+            self.saver.save(lambda: clone_to_cpu(act.state_dict()), f'{self.cwd}/actor.pth')
             print(f"{self.agent_id:<2}  {self.total_step:8.2e}  {self.r_max:8.2f} |")
         return if_save
 
+    def get_reward_list(self, env, act, device) -> list:
+        """the returns of eval_times episodes. In the sequential mode, stop as soon as the confidence interval
+        of r_avg (95%, Student's t) is not above r_max (not a new best). A new best is claimed when r_avg > r_max
+        after eval_times episodes, then run extra episodes (up to 2 * eval_times) until the interval is above r_max.
+        """
+        if not self.if_sequential:
+            return [get_episode_return(env, act, device) for _ in range(self.eva_times)]
+
+        reward_list = list()
+        while len(reward_list) < self.eva_times * 2:
+            reward_list.append(get_episode_return(env, act, device))
+            episode_num = len(reward_list)
+            if episode_num < 2:
+                continue
+            r_avg = np.average(reward_list)
+            r_err = get_t_value(episode_num - 1) * np.std(reward_list, ddof=1) / episode_num ** 0.5
+            if r_avg + r_err <= self.r_max:  # not a new best
+                break
+            if episode_num >= self.eva_times and (r_avg <= self.r_max or r_avg - r_err > self.r_max):
+                break  # no new best is claimed, or the new best is confirmed
+        return reward_list
+
+    def close(self):
+        self.saver.wait()
+        self.metrics.close()
+        if self.if_sequential and self.eval_num:
+            episode_num = self.episode_num / self.eval_num
+            print(f'| Evaluator: {episode_num:.1f} episodes per evaluation, eval_times={self.eva_times} '
+                  f'(saved {1 - episode_num / self.eva_times:.0%})')
+
+
+def get_t_value(df) -> float:  # the 97.5% quantile of Student's t distribution with df degrees of freedom
+    return (12.71, 4.30, 3.18, 2.78, 2.57, 2.45, 2.36, 2.31, 2.26, 2.23)[df - 1] if df <= 10 else 1.96 + 2.4 / df
+
 
 def get_episode_return(env, act, device) -> float:
     episode_return = 0.0  # sum of rewards in an episode
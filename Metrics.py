@@ -0,0 +1,78 @@
+import os
+import time
+from collections import deque
+import numpy as np
+
+# the record of each evaluation, appended to `cwd/metrics.bin` as raw bytes (36 bytes per record)
+# total_step: the number of env steps, r_avg, r_std: episode return average and std, obj_a, obj_c: objectives,
+# used_time: seconds since the start of training, step_per_sec: env steps per second since the last evaluation,
+# eval_time: seconds used by this evaluation
+METRICS_DTYPE = np.dtype([('total_step', '<i8'), ('r_avg', '<f4'), ('r_std', '<f4'), ('obj_a', '<f4'),
+                          ('obj_c', '<f4'), ('used_time', '<f4'), ('step_per_sec', '<f4'), ('eval_time', '<f4')])
+
+
+class MetricsLog:
+    """append-only metrics log with batched flushing and a bounded in-memory tail
+
+    The records are kept in a small buffer and written to `cwd/metrics.bin` every `flush_num` records
+    or `flush_gap` seconds, so a crash loses at most one batch. A file without a header is a plain array
+    of METRICS_DTYPE, and read_metrics() drops a partly written record at the end.
+    """
+
+    def __init__(self, cwd, flush_num=2 ** 4, flush_gap=8.0, tail_len=2 ** 10, if_append=False):
+        self.log_path = f'{cwd}/metrics.bin'
+        self.log_file = open(self.log_path, 'ab' if if_append else 'wb')
+        self.record_num = self.log_file.tell() // METRICS_DTYPE.itemsize  # records in the log, written or not
+        self.tail = deque(maxlen=tail_len)  # the latest records, for printing and checking
+
+        self.flush_num = flush_num
+        self.flush_gap = flush_gap
+        self.flush_time = time.time()
+        self.buffer = np.empty(flush_num, dtype=METRICS_DTYPE)
+        self.buffer_len = 0
+
+    def append(self, total_step, r_avg, r_std, obj_a, obj_c, used_time, step_per_sec, eval_time):
+        record = (total_step, r_avg, r_std, obj_a, obj_c, used_time, step_per_sec, eval_time)
+        self.buffer[self.buffer_len] = record
+        self.buffer_len += 1
+        self.record_num += 1
+        self.tail.append(record)
+
+        if self.buffer_len == self.flush_num or time.time() - self.flush_time > self.flush_gap:
+            self.flush()
+
+    def flush(self):
+        if self.buffer_len:
+            self.log_file.write(self.buffer[:self.buffer_len].tobytes())
+            self.buffer_len = 0
+        self.log_file.flush()
+        self.flush_time = time.time()
+
+    def truncate(self, record_num):  # drop the records after record_num, for resuming from a checkpoint
+        self.flush()
+        self.log_file.truncate(record_num * METRICS_DTYPE.itemsize)
+        self.record_num = record_num
+        self.tail.clear()
+
+    def close(self):
+        if not self.log_file.closed:
+            self.flush()
+            self.log_file.close()
+
+
+def read_metrics(cwd) -> np.ndarray:  # a structured array of METRICS_DTYPE, empty if no log
+    log_path = f'{cwd}/metrics.bin'
+    if not os.path.exists(log_path):
+        return np.zeros(0, dtype=METRICS_DTYPE)
+    with open(log_path, 'rb') as f:
+        data = f.read()
+    record_num = len(data) // METRICS_DTYPE.itemsize  # a training process may be writing the last record
+    return np.frombuffer(data, dtype=METRICS_DTYPE, count=record_num)
+
+
+def read_metrics_many(root='.', thread_num=16) -> dict:
+    """{cwd: metrics} of all the `metrics.bin` files under root, read by a thread pool for thousands of runs"""
+    from concurrent.futures import ThreadPoolExecutor
+    cwds = [dir_path for dir_path, _, file_names in os.walk(root) if 'metrics.bin' in file_names]
+    with ThreadPoolExecutor(thread_num) as executor:
+        return dict(zip(cwds, executor.map(read_metrics, cwds)))
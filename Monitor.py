@@ -0,0 +1,146 @@
+import os
+import time
+import threading
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from Profiler import timer, get_resident_memory_bytes
+
+
+class LiveMetrics:
+    """live metrics of train_and_evaluate() on http://host:port/metrics in the Prometheus text format
+
+    The server runs on a daemon thread and the training thread never takes a lock: it only sets total_step and
+    increments update_num (agent.optimizer.step is wrapped, like PhaseTimer.wrap), and the server thread reads
+    the attributes of agent, buffer and evaluator when it is scraped (reading an attribute is atomic under the GIL).
+    The rates are per second since the last scrape, the counters (*_total) are for rate() of Prometheus.
+    The phase timings are exported when the timer of Profiler.py is enabled (Arguments.if_timer).
+    """
+
+    def __init__(self, port, host='127.0.0.1'):
+        self.port = port
+        self.host = host  # localhost only, set host='0.0.0.0' to be scraped from other machines
+        self.start_time = time.time()
+        self.total_step = 0  # the number of env steps, written by the training thread only
+        self.update_num = 0  # the number of optimizer.step(), written by the training thread only
+        self.agent = None
+        self.buffer = None
+        self.evaluator = None
+        self.wrapped = None  # (optimizer, step, if_own_attr), to restore optimizer.step
+        self.server = None
+
+        self.scrape_time = self.start_time  # written by the server thread only
+        self.scrape_step = 0
+        self.scrape_update_num = 0
+
+    def start(self, agent, buffer, evaluator):
+        self.agent = agent
+        self.buffer = buffer
+        self.evaluator = evaluator
+
+        optimizer = agent.optimizer
+        step = optimizer.step
+
+        def new_step(*args, **kwargs):
+            self.update_num += 1
+            return step(*args, **kwargs)
+
+        self.wrapped = (optimizer, step, 'step' in vars(optimizer))
+        optimizer.step = new_step
+
+        live_metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                text = live_metrics.get_text().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(text)))
+                self.end_headers()
+                self.wfile.write(text)
+
+            def log_message(self, *args):  # no line per scrape in the training log
+                pass
+
+        self.server = HTTPServer((self.host, self.port), Handler)
+        self.port = self.server.server_address[1]  # the port chosen by the system when port=0
+        threading.Thread(target=self.server.serve_forever, name='LiveMetrics', daemon=True).start()
+        print(f'| LiveMetrics: http://{self.host}:{self.port}/metrics')
+
+    def get_text(self) -> str:
+        agent, buffer, evaluator = self.agent, self.buffer, self.evaluator
+        now_time = time.time()
+        total_step = self.total_step
+        update_num = self.update_num
+        gap_time = max(now_time - self.scrape_time, 1e-6)
+        step_per_sec = (total_step - self.scrape_step) / gap_time
+        update_per_sec = (update_num - self.scrape_update_num) / gap_time
+        self.scrape_time, self.scrape_step, self.scrape_update_num = now_time, total_step, update_num
+
+        metrics = [('env_steps_total', 'counter', 'env steps of training', total_step),
+                   ('env_steps_per_second', 'gauge', 'env steps per second since the last scrape', step_per_sec),
+                   ('updates_total', 'counter', 'gradient updates (optimizer.step)', update_num),
+                   ('updates_per_second', 'gauge', 'gradient updates per second since the last scrape',
+                    update_per_sec),
+                   ('buffer_len', 'gauge', 'transitions in the replay buffer (now_len)', buffer.now_len),
+                   ('buffer_max_len', 'gauge', 'capacity of the replay buffer (max_len)', buffer.max_len),
+                   ('obj_a', 'gauge', 'the latest objective of the actor', agent.obj_a),
+                   ('obj_c', 'gauge', 'the latest objective of the critic', agent.obj_c),
+                   ('evaluations_total', 'counter', 'evaluations', evaluator.eval_num),
+                   ('eval_r_max', 'gauge', 'the max average episode return of the evaluations', evaluator.r_max),
+                   ('uptime_seconds', 'gauge', 'seconds since the metrics server started',
+                    now_time - self.start_time)]
+        tail = evaluator.metrics.tail
+        if tail:
+            record = tail[-1]  # (total_step, r_avg, r_std, obj_a, obj_c, used_time, step_per_sec, eval_time)
+            metrics.extend((('eval_r_avg', 'gauge', 'average episode return of the latest evaluation', record[1]),
+                            ('eval_r_std', 'gauge', 'std of episode return of the latest evaluation', record[2]),
+                            ('eval_seconds', 'gauge', 'seconds used by the latest evaluation', record[7])))
+
+        lines = list()
+        for name, metric_type, doc, value in metrics:
+            lines.extend((f'# HELP elegantrl_{name} {doc}',
+                          f'# TYPE elegantrl_{name} {metric_type}',
+                          f'elegantrl_{name} {format_value(value)}'))
+
+        rss = get_resident_memory_bytes()
+        lines.extend(('# HELP process_resident_memory_bytes resident memory size in bytes',
+                      '# TYPE process_resident_memory_bytes gauge',
+                      f'process_resident_memory_bytes {rss}'))
+
+        if timer.if_enable:
+            totals = timer.totals.copy()  # copy() does not release the GIL, the training thread may add phases
+            counts = timer.counts.copy()
+            lines.extend(('# HELP elegantrl_phase_seconds_total seconds in each phase, see Profiler.py',
+                          '# TYPE elegantrl_phase_seconds_total counter'))
+            lines.extend(f'elegantrl_phase_seconds_total{{phase="{phase_name}"}} {total!r}'
+                         for phase_name, total in totals.items())
+            lines.extend(('# HELP elegantrl_phase_calls_total calls of each phase',
+                          '# TYPE elegantrl_phase_calls_total counter'))
+            lines.extend(f'elegantrl_phase_calls_total{{phase="{phase_name}"}} {count}'
+                         for phase_name, count in counts.items() if phase_name in totals)
+        return '\n'.join(lines) + '\n'
+
+    def close(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+        if self.wrapped is not None:
+            optimizer, step, if_own_attr = self.wrapped
+            if if_own_attr:
+                optimizer.step = step
+            else:
+                del optimizer.step  # the method of the class comes back
+            self.wrapped = None
+
+
+def format_value(value) -> str:  # the Prometheus text format writes +Inf, -Inf and NaN
+    value = float(value)
+    if value != value:
+        return 'NaN'
+    if value in (float('inf'), float('-inf')):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(value)
+
@@ -0,0 +1,333 @@
+import os
+import time
+import torch
+import numpy as np
+from copy import deepcopy
+from torch.func import functional_call, stack_module_state, vmap
+from Main import Evaluator, EvalScheduler, check_single_process_args
+
+
+class ReplayBufferVec:  # seed_num buffer slices in one tensor, for AgentMultiSeed
+    def __init__(self, seed_num, max_len, state_dim, action_dim, device):
+        self.device = device
+        self.max_len = max_len
+        self.now_len = 0
+        self.next_idx = 0
+        self.if_full = False
+
+        other_dim = 1 + 1 + action_dim
+        self.all_other = torch.empty((seed_num, max_len, other_dim), dtype=torch.float32, device=self.device)
+        self.all_state = torch.empty((seed_num, max_len, state_dim), dtype=torch.float32, device=self.device)
+        self.seed_idx = torch.arange(seed_num, device=self.device).unsqueeze(1)
+
+    def append_memo(self, states, others):  # states.shape == (seed_num, state_dim)
+        self.all_state[:, self.next_idx] = torch.as_tensor(states, device=self.device)
+        self.all_other[:, self.next_idx] = torch.as_tensor(others, device=self.device)
+
+        self.next_idx += 1
+        if self.next_idx >= self.max_len:
+            self.if_full = True
+            self.next_idx = 0
+
+    def update__now_len__before_sample(self):
+        self.now_len = self.max_len if self.if_full else self.next_idx
+
+    def random_sample(self, batch_size, generators):  # each buffer slice uses the RNG stream of its copy
+        indices = torch.stack([torch.randint(self.now_len - 1, size=(batch_size,), device=self.device,
+                                             generator=generator) for generator in generators])
+        r_m_a = self.all_other[self.seed_idx, indices]
+        return (r_m_a[:, :, 0:1],  # reward
+                r_m_a[:, :, 1:2],  # mask = 0.0 if done else gamma
+                r_m_a[:, :, 2:],  # action
+                self.all_state[self.seed_idx, indices],  # state
+                self.all_state[self.seed_idx, indices + 1])  # next_state
+
+
+class AgentMultiSeed:
+    """Vectorized multi-seed training in a single process (torch.func.vmap over stacked parameters)
+
+    K = len(random_seeds) independent copies of an off-policy agent (AgentDDPG, AgentTD3, AgentSAC) are
+    trained together: the parameters of the K copies of each network are stacked along a new first dim,
+    so that one vmap call runs K small matmuls as one batched matmul. Adam and soft_target_update
+    are element-wise, so a single optimizer over the stacked parameters keeps K independent states.
+    Each copy has its own env, buffer slice, RNG stream (torch.Generator), Evaluator and actor.pth.
+    """
+
+    def __init__(self, agent_rl, net_dim, state_dim, action_dim, random_seeds, learning_rate=1e-4):
+        assert agent_rl.__name__ in {'AgentDDPG', 'AgentTD3', 'AgentSAC'}
+        self.agent_name = agent_rl.__name__
+        self.action_dim = action_dim
+        self.seed_num = len(random_seeds)
+
+        self.agents = list()  # keep the K agents as the holders of nn.Module for Evaluator
+        for random_seed in random_seeds:
+            torch.manual_seed(random_seed)  # each copy has its own initial parameters
+            self.agents.append(agent_rl(net_dim, state_dim, action_dim, learning_rate))
+        agent = self.agents[0]
+        self.device = agent.device
+        self.criterion = agent.criterion
+        self.explore_noise = getattr(agent, 'explore_noise', None)  # DDPG, TD3
+        self.policy_noise = getattr(agent, 'policy_noise', None)  # TD3
+        self.update_freq = getattr(agent, 'update_freq', 1)  # TD3
+        self.target_entropy = getattr(agent, 'target_entropy', None)  # SAC
+
+        self.generators = [torch.Generator(device=self.device).manual_seed(random_seed)
+                           for random_seed in random_seeds]  # the RNG stream of each copy
+        self.rngs = [np.random.default_rng(random_seed) for random_seed in random_seeds]
+        self.states = None  # (seed_num, state_dim)
+        self.obj_a = np.zeros(self.seed_num)
+        self.obj_c = np.zeros(self.seed_num)
+
+        self.nets = dict()  # the network structure (on meta device) for torch.func.functional_call
+        self.params = dict()  # the stacked parameters, param.shape == (seed_num, *shape)
+        for name in ('act', 'act_target', 'cri', 'cri_target'):
+            modules = [getattr(agent, name) for agent in self.agents]
+            self.params[name] = stack_module_state(modules)[0]
+            self.nets[name] = deepcopy(modules[0]).to('meta')
+        for param in (*self.params['act_target'].values(), *self.params['cri_target'].values()):
+            param.requires_grad_(False)
+        params = [*self.params['act'].values(), *self.params['cri'].values()]
+        if self.agent_name == 'AgentSAC':
+            self.params['alpha_log'] = torch.stack([agent.alpha_log.detach() for agent in self.agents])
+            self.params['alpha_log'].requires_grad_(True)
+            params.append(self.params['alpha_log'])
+        self.optimizer = torch.optim.Adam(params, lr=learning_rate)
+
+        self.a_avg_name = 'net__a_avg' if hasattr(agent.act, 'net__a_avg') else 'net_action'  # AgentZoo
+        self.sqrt_2pi_log = 0.9189385332046727  # =np.log(np.sqrt(2 * np.pi))
+
+    def randn(self, shape):  # shape == (seed_num, *shape), each copy draws from its own RNG stream
+        return torch.stack([torch.randn(shape, device=self.device, generator=generator)
+                            for generator in self.generators])
+
+    def select_actions(self, states):  # states.shape == (seed_num, state_dim)
+        states = torch.as_tensor(states, dtype=torch.float32, device=self.device).unsqueeze(1)
+        noise = self.randn((1, self.action_dim))
+        actions = vmap(self.get_explore_action)(self.params['act'], states, noise)
+        return actions.squeeze(1).detach().cpu().numpy()
+
+    def explore_before_train(self, envs, buffer, target_step, reward_scale, gamma):
+        for _ in range(target_step):
+            actions = np.stack([rng.uniform(-1, 1, size=self.action_dim) for rng in self.rngs])
+            self.step_envs(envs, buffer, actions, reward_scale, gamma)
+        return target_step
+
+    def update_buffer(self, envs, buffer, max_step, reward_scale, gamma):
+        for _ in range(max_step):
+            actions = self.select_actions(self.states)
+            self.step_envs(envs, buffer, actions, reward_scale, gamma)
+        return max_step
+
+    def step_envs(self, envs, buffer, actions, reward_scale, gamma):
+        others = np.empty((self.seed_num, 2 + self.action_dim), dtype=np.float32)
+        next_states = np.empty_like(self.states)
+        for i, env in enumerate(envs):
+            next_s, reward, done, _ = env.step(actions[i])
+            others[i] = (reward * reward_scale, 0.0 if done else gamma, *actions[i])
+            next_states[i] = env.reset() if done else next_s
+        buffer.append_memo(self.states, others)
+        self.states = next_states
+
+    def update_policy(self, buffer, max_step, batch_size, repeat_times):
+        buffer.update__now_len__before_sample()
+
+        obj_actor = obj_critic = None
+        for i in range(int(max_step * repeat_times)):
+            batch = buffer.random_sample(batch_size, self.generators)
+            noise = self.randn((2, batch_size, self.action_dim))  # for next_state and state
+            obj_united, obj_actor, obj_critic = vmap(self.compute_objectives)(self.params, *batch, noise)
+
+            self.optimizer.zero_grad()
+            obj_united.sum().backward()  # the K copies are independent, so the sum gives the K gradients
+            self.optimizer.step()
+
+            if i % self.update_freq == 0:  # delay update for TD3
+                soft_target_update(self.params['cri_target'], self.params['cri'])
+                soft_target_update(self.params['act_target'], self.params['act'])
+
+        self.obj_a = obj_actor.detach().cpu().numpy()
+        self.obj_c = obj_critic.detach().cpu().numpy()
+
+    def hard_target_update(self):
+        for name in ('act', 'cri'):
+            for key, param in self.params[name].items():
+                self.params[f'{name}_target'][key].data.copy_(param.data)
+
+    def get_act(self, i):  # load the parameters of the i-th copy into its actor, for Evaluator
+        act = self.agents[i].act
+        with torch.no_grad():
+            for key, param in act.named_parameters():
+                param.copy_(self.params['act'][key][i])
+        return act
+
+    '''the functions of one copy, vectorized by vmap'''
+
+    def call(self, net_name, params, sub_name, *inputs):  # call a sub-network with the parameters of one copy
+        sub_params = {key[len(sub_name) + 1:]: value for key, value in params.items()
+                      if key.startswith(f'{sub_name}.')}
+        return functional_call(getattr(self.nets[net_name], sub_name), sub_params, inputs)
+
+    def get_q1_q2(self, net_name, params, state, action):  # CriticTwin.get__q1_q2()
+        tmp = self.call(net_name, params, 'net_sa', torch.cat((state, action), dim=1))
+        return self.call(net_name, params, 'net_q1', tmp), self.call(net_name, params, 'net_q2', tmp)
+
+    def get_action_log_prob(self, net_name, params, state, noise):  # ActorSAC.get__action__log_prob()
+        t_tmp = self.call(net_name, params, 'net__state', state)
+        a_avg = self.call(net_name, params, self.a_avg_name, t_tmp)
+        a_std_log = self.call(net_name, params, 'net__a_std', t_tmp).clamp(-16, 2)
+        a_tan = (a_avg + a_std_log.exp() * noise).tanh()
+
+        log_prob = a_std_log + self.sqrt_2pi_log + noise.pow(2).__mul__(0.5)
+        log_prob = log_prob + (-a_tan.pow(2) + 1.000001).log()
+        return a_tan, log_prob.sum(1, keepdim=True)
+
+    def get_explore_action(self, act_params, state, noise):
+        if self.agent_name == 'AgentSAC':  # ActorSAC.get_action()
+            t_tmp = self.call('act', act_params, 'net__state', state)
+            a_avg = self.call('act', act_params, self.a_avg_name, t_tmp)
+            a_std = self.call('act', act_params, 'net__a_std', t_tmp).clamp(-16, 2).exp()
+            return (a_avg + a_std * noise).tanh()
+        action = functional_call(self.nets['act'], act_params, (state,))
+        return (action + noise * self.explore_noise).clamp(-1, 1)
+
+    def compute_objectives(self, params, reward, mask, action, state, next_s, noise):
+        act, act_target = params['act'], params['act_target']
+        cri, cri_target = params['cri'], params['cri_target']
+
+        if self.agent_name == 'AgentSAC':
+            alpha_log = params['alpha_log']
+            alpha = alpha_log.exp().detach()
+            with torch.no_grad():
+                next_a, next_log_prob = self.get_action_log_prob('act_target', act_target, next_s, noise[0])
+                next_q = torch.min(*self.get_q1_q2('cri_target', cri_target, next_s, next_a))
+                q_label = reward + mask * (next_q + next_log_prob * alpha)
+            q1, q2 = self.get_q1_q2('cri', cri, state, action)
+            obj_critic = self.criterion(q1, q_label) + self.criterion(q2, q_label)
+
+            action_pg, log_prob = self.get_action_log_prob('act', act, state, noise[1])  # policy gradient
+            obj_alpha = (alpha_log * (log_prob - self.target_entropy).detach()).mean()
+            obj_actor = -(torch.min(*self.get_q1_q2('cri_target', cri_target, state, action_pg))
+                          + log_prob * alpha).mean()
+            return obj_critic + obj_alpha + obj_actor, obj_actor, obj_critic
+
+        with torch.no_grad():
+            next_a = functional_call(self.nets['act_target'], act_target, (next_s,))
+            if self.agent_name == 'AgentTD3':  # Actor.get_action(), policy noise
+                next_a = (next_a + (noise[0] * self.policy_noise).clamp(-0.5, 0.5)).clamp(-1.0, 1.0)
+                next_q = torch.min(*self.get_q1_q2('cri_target', cri_target, next_s, next_a))  # twin critics
+            else:
+                next_q = functional_call(self.nets['cri_target'], cri_target, (next_s, next_a))
+            q_label = reward + mask * next_q
+
+        if self.agent_name == 'AgentTD3':
+            q1, q2 = self.get_q1_q2('cri', cri, state, action)
+            obj_critic = self.criterion(q1, q_label) + self.criterion(q2, q_label)
+        else:
+            q_value = functional_call(self.nets['cri'], cri, (state, action))
+            obj_critic = self.criterion(q_value, q_label)
+
+        q_value_pg = functional_call(self.nets['act'], act, (state,))  # policy gradient
+        obj_actor = -functional_call(self.nets['cri_target'], cri_target, (state, q_value_pg)).mean()
+        return obj_actor + obj_critic, obj_actor, obj_critic
+
+
+def soft_target_update(target, current, tau=5e-3):  # for the stacked parameters in dict
+    for key, target_param in target.items():
+        target_param.data.copy_(tau * current[key].data + (1.0 - tau) * target_param.data)
+
+
+def train_and_evaluate__multi_seed(args):
+    check_single_process_args(args, f'seed_num={args.seed_num}')
+    args.init_before_training()
+
+    agent_rl = args.agent_rl  # basic arguments
+    env = args.env
+    cwd = args.cwd
+    seed_num = args.seed_num
+    random_seeds = [args.random_seed + i for i in range(seed_num)]
+
+    gamma = args.gamma  # training arguments
+    net_dim = args.net_dim
+    max_memo = args.max_memo
+    max_step = args.max_step
+    batch_size = args.batch_size
+    repeat_times = args.repeat_times
+    reward_scale = args.reward_scale
+
+    show_gap = args.show_gap  # evaluate arguments
+    eval_times = args.eval_times
+    eval_gaps = (args.eval_gap_step, args.eval_gap_time, args.eval_time_ratio)
+    if_eval_sequential = args.if_eval_sequential
+    break_step = args.break_step
+    if_break_early = args.if_break_early
+    del args
+
+    '''init: env'''
+    state_dim = env.state_dim
+    action_dim = env.action_dim
+    target_reward = env.target_reward
+    assert not env.if_discrete
+    envs = [deepcopy(env) for _ in random_seeds]
+    env_evals = [deepcopy(env) for _ in random_seeds]
+
+    evaluators = list()  # one actor.pth and metrics.bin for each copy
+    for i, random_seed in enumerate(random_seeds):
+        os.makedirs(f'{cwd}/seed_{random_seed}', exist_ok=True)
+        evaluators.append(Evaluator(f'{cwd}/seed_{random_seed}', i, eval_times, show_gap, target_reward,
+                                    scheduler=EvalScheduler(*eval_gaps), if_sequential=if_eval_sequential))
+    agent = AgentMultiSeed(agent_rl, net_dim, state_dim, action_dim, random_seeds)
+    agent.states = np.stack([env.reset() for env in envs])
+
+    buffer = ReplayBufferVec(seed_num, max_memo, state_dim, action_dim, agent.device)
+    with torch.no_grad():  # update replay buffer
+        steps = agent.explore_before_train(envs, buffer, max_step, reward_scale, gamma)
+    agent.update_policy(buffer, max_step, batch_size, repeat_times)  # pre-training and hard update
+    agent.hard_target_update()
+    total_step = steps
+
+    if_solve = False
+    while not ((if_break_early and if_solve) or total_step > break_step or os.path.exists(f'{cwd}/stop')):
+        with torch.no_grad():  # speed up running
+            steps = agent.update_buffer(envs, buffer, max_step, reward_scale, gamma)
+        total_step += steps
+
+        agent.update_policy(buffer, max_step, batch_size, repeat_times)
+
+        with torch.no_grad():  # speed up running
+            for i, evaluator in enumerate(evaluators):
+                evaluator.evaluate_and_save(env_evals[i], agent.get_act(i), agent.device, steps,
+                                            agent.obj_a[i], agent.obj_c[i])
+        if_solve = all(evaluator.used_time is not None for evaluator in evaluators)
+    [evaluator.close() for evaluator in evaluators]
+
+
+'''benchmark'''
+
+
+def run__multi_seed_benchmark(agent_rl=None, seed_nums=(1, 2, 4, 8, 16), update_times=2):
+    """total throughput (gradient steps of all copies per second) for K copies in one process"""
+    if agent_rl is None:
+        import Agent
+        agent_rl = Agent.AgentSAC
+    state_dim, action_dim = 24, 4  # BipedalWalker-v3 like
+    net_dim, max_memo, max_step, batch_size = 2 ** 8, 2 ** 14, 2 ** 7, 2 ** 7
+
+    print(f"| {'Agent':>10}  {'SeedNum':>8}  {'UsedTime':>8}  {'Update/s':>9}")
+    for seed_num in seed_nums:
+        agent = AgentMultiSeed(agent_rl, net_dim, state_dim, action_dim, list(range(seed_num)))
+        buffer = ReplayBufferVec(seed_num, max_memo, state_dim, action_dim, agent.device)
+        buffer.all_state.normal_()  # fill the buffer with random transitions
+        buffer.all_other.normal_()
+        buffer.all_other[:, :, 1] = 0.99  # mask
+        buffer.if_full = True
+
+        agent.update_policy(buffer, 2 ** 2, batch_size, 1)  # warm up
+        start_time = time.time()
+        for _ in range(update_times):
+            agent.update_policy(buffer, max_step, batch_size, 1)
+        used_time = (time.time() - start_time) / update_times
+        print(f"| {agent_rl.__name__:>10}  {seed_num:8}  {used_time:8.3f}  {seed_num * max_step / used_time:9.1f}")
+
+
+if __name__ == '__main__':
+    run__multi_seed_benchmark()
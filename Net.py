@@ -81,6 +81,40 @@ class ActorPPO(nn.Module):
         return log_prob.sum(1)
 
 
+class ActorCriticPPO(nn.Module):  # the actor and critic of PPO on a shared trunk
+    def __init__(self, mid_dim, state_dim, action_dim):
+        super().__init__()
+        self.net__state = nn.Sequential(nn.Linear(state_dim, mid_dim), nn.ReLU(),
+                                        nn.Linear(mid_dim, mid_dim), nn.ReLU(),
+                                        nn.Linear(mid_dim, mid_dim), nn.ReLU())  # shared by the two heads
+        self.net__a_avg = nn.Linear(mid_dim, action_dim)  # the average of action
+        self.net__value = nn.Linear(mid_dim, 1)  # the value of state, same as CriticAdv
+        self.a_std_log = nn.Parameter(torch.zeros((1, action_dim)) - 0.5, requires_grad=True)  # trainable parameter
+        self.sqrt_2pi_log = 0.9189385332046727  # =np.log(np.sqrt(2 * np.pi))
+
+    def forward(self, state):
+        return self.net__a_avg(self.net__state(state)).tanh()  # action
+
+    def get__action_noise(self, state):
+        a_avg = self.net__a_avg(self.net__state(state))
+        a_std = self.a_std_log.exp()
+
+        noise = torch.randn_like(a_avg)
+        action = a_avg + noise * a_std
+        return action, noise
+
+    def get_value(self, state):
+        return self.net__value(self.net__state(state))
+
+    def compute__log_prob_value(self, state, action):  # one forward of the trunk
+        tmp = self.net__state(state)
+        a_avg = self.net__a_avg(tmp)
+        a_std = self.a_std_log.exp()
+        delta = ((a_avg - action) / a_std).pow(2).__mul__(0.5)  # __mul__(0.5) is * 0.5
+        log_prob = -(self.a_std_log + self.sqrt_2pi_log + delta)
+        return log_prob.sum(1), self.net__value(tmp).squeeze(1)
+
+
 class ActorSAC(nn.Module):
     def __init__(self, mid_dim, state_dim, action_dim):
         super().__init__()
@@ -116,6 +150,17 @@ class ActorSAC(nn.Module):
         return a_tan, log_prob.sum(1, keepdim=True)
 
 
+class ActorDistill(nn.Module):  # a small actor for deployment, trained to match the actions of a large actor
+    def __init__(self, net, if_tanh=True):
+        super().__init__()
+        self.net = net  # nn.Sequential, see Distill.py: build_student() and prune_sequential()
+        self.if_tanh = if_tanh  # False for the q value of QNet, the action of discrete env is argmax
+
+    def forward(self, state):
+        action = self.net(state)
+        return action.tanh() if self.if_tanh else action
+
+
 class Critic(nn.Module):
     def __init__(self, mid_dim, state_dim, action_dim):
         super().__init__()
@@ -0,0 +1,365 @@
+import os
+import time
+import socket
+import torch
+import numpy as np
+import numpy.random as rd
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from Main import Evaluator, EvalScheduler, ReplayBufferCPU, ReplayBufferGPU, explore_before_train
+from Main import check_single_process_args
+
+
+def train_and_evaluate__data_parallel(args):
+    """Data-parallel learners across CPU processes (torch.distributed, gloo backend)
+
+    K learner processes are forked from the main process. Each learner owns an env and a buffer shard,
+    explores with its own (differently seeded) agent copy, samples its own minibatch and all-reduces
+    the gradients before each optimizer step, so that act, cri, alpha_log and the soft-updated target
+    networks stay identical in all learners. It holds when the update does not branch on the local
+    minibatches: an agent with `if_data_parallel = False` (AgentModSAC, its actor update and act_target
+    soft update are gated on the running obj_c of the local minibatches) is rejected.
+    The global batch size is kept: each learner samples `batch_size // K` transitions, explores
+    `max_step // K` steps (off-policy, also before training) and stores `max_memo // K` transitions.
+    Learner 0 evaluates and saves, just like train_and_evaluate().
+    """
+    assert getattr(args.agent_rl, 'if_data_parallel', True), \
+        f'| {args.agent_rl.__name__} branches on the local minibatches, use learner_num=1 or if_hogwild=True'
+    check_single_process_args(args, f'learner_num={args.learner_num}')
+    args.init_before_training()
+    learner_num = args.learner_num
+
+    init_method = f'tcp://127.0.0.1:{get_free_port()}'
+    mp.start_processes(mp__learner, args=(args, init_method), nprocs=learner_num, start_method='fork')
+
+
+def mp__learner(rank, args, init_method):
+    learner_num = args.learner_num
+    dist.init_process_group('gloo', init_method=init_method, rank=rank, world_size=learner_num)
+    torch.set_num_threads(max(1, args.num_threads // learner_num))
+    torch.manual_seed(args.random_seed + rank)  # each learner samples different minibatch
+    np.random.seed(args.random_seed + rank)
+
+    agent_rl = args.agent_rl  # basic arguments
+    agent_id = args.gpu_id
+    env = args.env
+    cwd = args.cwd
+
+    gamma = args.gamma  # training arguments
+    net_dim = args.net_dim
+    max_memo = args.max_memo // learner_num  # buffer shard
+    max_step = args.max_step
+    batch_size = max(1, args.batch_size // learner_num)  # keep the global batch size
+    repeat_times = args.repeat_times
+    reward_scale = args.reward_scale
+
+    show_gap = args.show_gap  # evaluate arguments
+    eval_times = args.eval_times
+    eval_gaps = (args.eval_gap_step, args.eval_gap_time, args.eval_time_ratio)
+    if_eval_sequential = args.if_eval_sequential
+    break_step = args.break_step
+    if_break_early = args.if_break_early
+    del args
+
+    '''init: env'''
+    state_dim = env.state_dim
+    action_dim = env.action_dim
+    if_discrete = env.if_discrete
+    target_reward = env.target_reward
+    from copy import deepcopy  # built-in library of Python
+    env_eval = deepcopy(env) if rank == 0 else None
+    del deepcopy
+
+    evaluator = Evaluator(cwd, agent_id, eval_times, show_gap, target_reward,
+                          scheduler=EvalScheduler(*eval_gaps),
+                          if_sequential=if_eval_sequential) if rank == 0 else None
+    agent = agent_rl(net_dim, state_dim, action_dim)  # build AgentRL
+    agent.state = env.reset()
+    broadcast_agent(agent)  # the same initial parameters in all learners
+    all_reduce_gradients_before_step(agent.optimizer, learner_num)
+
+    if_on_policy = getattr(agent_rl, 'if_on_policy', False)  # build ReplayBuffer
+    if if_on_policy:
+        assert max_memo > max_step, f'| max_memo // learner_num should be larger than max_step={max_step}'
+        buffer = ReplayBufferCPU(max_memo, state_dim, action_dim=1 if if_discrete else action_dim)
+        explore_step = max_step  # PPO use max_step as the max steps of an episode
+        steps = 0
+    else:
+        buffer = ReplayBufferGPU(max_memo, state_dim, action_dim=1 if if_discrete else action_dim)
+        explore_step = max(1, max_step // learner_num)
+        with torch.no_grad():  # update replay buffer
+            steps = explore_before_train(env, buffer, explore_step, reward_scale, gamma)
+        agent.update_policy(buffer, max_step, batch_size, repeat_times)  # pre-training and hard update
+        agent.act_target.load_state_dict(agent.act.state_dict()) if 'act_target' in dir(agent) else None
+    total_step = steps * learner_num
+
+    if_stop = False
+    while not if_stop:
+        with torch.no_grad():  # speed up running
+            steps = agent.update_buffer(env, buffer, explore_step, reward_scale, gamma)
+        if if_on_policy:  # the learners must run the same number of gradient steps
+            buffer.next_idx = all_reduce_int(buffer.next_idx, op=dist.ReduceOp.MIN)
+        total_step += all_reduce_int(steps)
+
+        buffer.update__now_len__before_sample()
+        agent.update_policy(buffer, max_step, batch_size, repeat_times)
+
+        if rank == 0:
+            with torch.no_grad():  # speed up running
+                evaluator.evaluate_and_save(env_eval, agent.act, agent.device, total_step - evaluator.total_step,
+                                            agent.obj_a, agent.obj_c)
+            if_solve = evaluator.used_time is not None
+            if_stop = (if_break_early and if_solve) or total_step > break_step or os.path.exists(f'{cwd}/stop')
+        if_stop = bool(broadcast_int(int(if_stop)))
+
+    evaluator.close() if rank == 0 else None
+    dist.destroy_process_group()
+
+
+def train_and_evaluate__hogwild(args):
+    """Hogwild! (A3C style) learners across CPU processes, without lock
+
+    The networks of one agent (act, cri, their targets and alpha_log) are put in shared memory
+    before K learner processes are forked. Each learner has its own env, replay buffer, optimizer
+    state and gradients, and writes its optimizer step directly into the shared parameters.
+    It fits the small MLPs in Net.py, where synchronization costs more than the computation.
+    Learner 0 evaluates the shared actor and saves, just like train_and_evaluate().
+    """
+    check_single_process_args(args, f'learner_num={args.learner_num}, if_hogwild=True')
+    args.init_before_training()
+    learner_num = args.learner_num
+    env = args.env
+
+    agent = args.agent_rl(args.net_dim, env.state_dim, env.action_dim)
+    assert agent.device.type == 'cpu', '| Hogwild learners share the parameters in CPU memory.'
+    share_agent_memory(agent)
+
+    learner_steps = mp.Array('q', learner_num, lock=False)  # each learner writes its own slot, no lock
+    if_stop = mp.Value('b', False, lock=False)  # only written by learner 0
+    mp.start_processes(mp__hogwild_learner, args=(args, agent, learner_steps, if_stop),
+                       nprocs=learner_num, start_method='fork')
+
+
+def mp__hogwild_learner(rank, args, agent, learner_steps, if_stop):
+    torch.set_num_threads(max(1, args.num_threads // args.learner_num))
+    torch.manual_seed(args.random_seed + rank)
+    np.random.seed(args.random_seed + rank)
+
+    agent_rl = args.agent_rl  # basic arguments
+    agent_id = args.gpu_id
+    env = args.env
+    cwd = args.cwd
+
+    gamma = args.gamma  # training arguments
+    max_memo = args.max_memo
+    max_step = args.max_step
+    batch_size = args.batch_size
+    repeat_times = args.repeat_times
+    reward_scale = args.reward_scale
+
+    show_gap = args.show_gap  # evaluate arguments
+    eval_times = args.eval_times
+    eval_gaps = (args.eval_gap_step, args.eval_gap_time, args.eval_time_ratio)
+    if_eval_sequential = args.if_eval_sequential
+    break_step = args.break_step
+    if_break_early = args.if_break_early
+    del args
+
+    '''init: env'''
+    state_dim = env.state_dim
+    action_dim = env.action_dim
+    if_discrete = env.if_discrete
+    target_reward = env.target_reward
+    from copy import deepcopy  # built-in library of Python
+    env_eval = deepcopy(env) if rank == 0 else None
+    del deepcopy
+
+    evaluator = Evaluator(cwd, agent_id, eval_times, show_gap, target_reward,
+                          scheduler=EvalScheduler(*eval_gaps),
+                          if_sequential=if_eval_sequential) if rank == 0 else None
+    agent.state = env.reset()
+
+    if_on_policy = getattr(agent_rl, 'if_on_policy', False)  # build ReplayBuffer
+    if if_on_policy:
+        buffer = ReplayBufferCPU(max_memo, state_dim, action_dim=1 if if_discrete else action_dim)
+        learner_steps[rank] = 0
+    else:
+        buffer = ReplayBufferGPU(max_memo, state_dim, action_dim=1 if if_discrete else action_dim)
+        with torch.no_grad():  # update replay buffer
+            learner_steps[rank] = explore_before_train(env, buffer, max_step, reward_scale, gamma)
+        agent.update_policy(buffer, max_step, batch_size, repeat_times)  # pre-training and hard update
+        agent.act_target.load_state_dict(agent.act.state_dict()) if 'act_target' in dir(agent) else None
+
+    while not if_stop.value:
+        with torch.no_grad():  # speed up running
+            learner_steps[rank] += agent.update_buffer(env, buffer, max_step, reward_scale, gamma)
+
+        buffer.update__now_len__before_sample()
+        agent.update_policy(buffer, max_step, batch_size, repeat_times)
+
+        if rank == 0:
+            total_step = sum(learner_steps)
+            with torch.no_grad():  # speed up running
+                evaluator.evaluate_and_save(env_eval, agent.act, agent.device, total_step - evaluator.total_step,
+                                            agent.obj_a, agent.obj_c)
+            if_solve = evaluator.used_time is not None
+            if_stop.value = (if_break_early and if_solve) or total_step > break_step or os.path.exists(f'{cwd}/stop')
+    evaluator.close() if rank == 0 else None
+
+
+'''utils'''
+
+
+def get_free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def all_reduce_int(value, op=dist.ReduceOp.SUM):
+    tensor = torch.tensor((value,), dtype=torch.int64)
+    dist.all_reduce(tensor, op=op)
+    return int(tensor[0])
+
+
+def broadcast_int(value, src=0):
+    tensor = torch.tensor((value,), dtype=torch.int64)
+    dist.broadcast(tensor, src=src)
+    return int(tensor[0])
+
+
+def broadcast_agent(agent, src=0):
+    for value in vars(agent).values():  # the same attribute order in all learners
+        if isinstance(value, torch.nn.Module):  # act, act_target, cri, cri_target
+            for tensor in value.state_dict().values():
+                dist.broadcast(tensor, src=src)
+        elif isinstance(value, torch.Tensor):  # alpha_log
+            dist.broadcast(value.data, src=src)
+
+
+def share_agent_memory(agent):
+    for value in vars(agent).values():
+        if isinstance(value, torch.nn.Module):  # act, act_target, cri, cri_target
+            value.share_memory()
+        elif isinstance(value, torch.Tensor):  # alpha_log
+            value.share_memory_()
+
+
+def all_reduce_gradients_before_step(optimizer, learner_num):
+    """average the gradients of all learners in one flat all-reduce before optimizer.step()
+
+    A parameter without gradient (e.g. AgentModSAC skips the actor update) is treated as zero,
+    and keeps `grad=None` only if it has no gradient in all learners, like single-process training.
+    """
+    params = [param for param_group in optimizer.param_groups for param in param_group['params']]
+    sizes = [param.numel() for param in params]
+    optimizer_step = optimizer.step
+
+    def new_optimizer_step(*args, **kwargs):
+        flat = torch.cat([param.grad.reshape(-1) if param.grad is not None
+                          else torch.zeros(param.numel(), device=param.device) for param in params]
+                         + [torch.tensor([float(param.grad is not None) for param in params],
+                                         device=params[0].device), ])
+        dist.all_reduce(flat)
+        grads = flat[:-len(params)].div_(learner_num).split(sizes)
+        if_grads = flat[-len(params):].tolist()
+
+        for param, grad, if_grad in zip(params, grads, if_grads):
+            param.grad = grad.view_as(param) if if_grad > 0 else None
+        return optimizer_step(*args, **kwargs)
+
+    optimizer.step = new_optimizer_step
+
+
+'''benchmark'''
+
+
+def run__data_parallel_benchmark(learner_nums=(1, 2, 4, 8), update_times=4):
+    import Agent
+    state_dim, action_dim = 24, 4  # BipedalWalker-v3 like
+    print(f"| {'Agent':>10}  {'Learner':>8}  {'UsedTime':>10}  {'Speedup':>8}")
+    for agent_rl in (Agent.AgentSAC, Agent.AgentPPO):
+        used_times = list()
+        for learner_num in learner_nums:
+            used_time = mp.Value('d', 0.0)
+            init_method = f'tcp://127.0.0.1:{get_free_port()}'
+            mp.start_processes(mp__benchmark_learner, nprocs=learner_num, start_method='fork',
+                               args=(learner_num, init_method, agent_rl, state_dim, action_dim,
+                                     update_times, used_time))
+            used_times.append(used_time.value)
+            print(f"| {agent_rl.__name__:>10}  {learner_num:8}  {used_time.value:10.3f}  "
+                  f"{used_times[0] / used_time.value:8.2f}")
+
+
+def mp__benchmark_learner(rank, learner_num, init_method, agent_rl, state_dim, action_dim,
+                          update_times, used_time):
+    dist.init_process_group('gloo', init_method=init_method, rank=rank, world_size=learner_num)
+    torch.set_num_threads(1)
+    torch.manual_seed(rank)
+    rd.seed(rank)
+
+    if_on_policy = getattr(agent_rl, 'if_on_policy', False)
+    net_dim = 2 ** 8
+    max_step = 2 ** 8
+    max_memo = (2 ** 12 if if_on_policy else 2 ** 17) // learner_num
+    batch_size = (2 ** 8 if if_on_policy else 2 ** 7) // learner_num
+    repeat_times = 2 ** 2 if if_on_policy else 2 ** 0
+
+    agent = agent_rl(net_dim, state_dim, action_dim)
+    broadcast_agent(agent)
+    all_reduce_gradients_before_step(agent.optimizer, learner_num)
+
+    if if_on_policy:  # fill the buffer with random transitions
+        buffer = ReplayBufferCPU(max_memo, state_dim, action_dim)
+        buffer.all_state[:] = rd.randn(*buffer.all_state.shape)
+        buffer.all_other[:] = rd.randn(*buffer.all_other.shape)
+        buffer.all_other[:, 1] = 0.99  # mask
+        buffer.next_idx = max_memo
+    else:
+        buffer = ReplayBufferGPU(max_memo, state_dim, action_dim)
+        buffer.all_state.normal_()
+        buffer.all_other.normal_()
+        buffer.all_other[:, 1] = 0.99  # mask
+        buffer.if_full = True
+    buffer.update__now_len__before_sample()
+
+    agent.update_policy(buffer, max_step, batch_size, repeat_times)  # warm up
+    dist.barrier()
+    start_time = time.time()
+    for _ in range(update_times):
+        agent.update_policy(buffer, max_step, batch_size, repeat_times)
+    dist.barrier()
+    if rank == 0:
+        used_time.value = (time.time() - start_time) / update_times
+    dist.destroy_process_group()
+
+
+def run__hogwild_benchmark(env=None, agent_rl=None, learner_nums=(1, 2, 4)):
+    """measure the wall time to reach target_reward, single-process (learner_num=1) vs Hogwild learners"""
+    from Main import Arguments, train_and_evaluate
+    if env is None:
+        import gym
+        from Env import decorate_env
+        env = decorate_env(gym.make('CartPole-v0'))
+    if agent_rl is None:
+        import Agent
+        agent_rl = Agent.AgentDoubleDQN
+
+    used_times = list()
+    for learner_num in learner_nums:
+        args = Arguments(agent_rl, env, gpu_id=0)
+        args.cwd = f'./{agent_rl.__name__}/{env.env_name}_hogwild_{learner_num}'
+        args.learner_num = learner_num
+        args.if_hogwild = True
+
+        start_time = time.time()
+        train_and_evaluate(args)
+        used_times.append(time.time() - start_time)
+
+    print(f"| {'Learner':>8}  {'TimeToTarget':>12}")
+    for learner_num, used_time in zip(learner_nums, used_times):
+        print(f"| {learner_num:8}  {used_time:12.1f}")
+
+
+if __name__ == '__main__':
+    run__data_parallel_benchmark()
@@ -0,0 +1,142 @@
+import re
+import numpy as np
+import torch
+
+
+def plan_memory(args, memory_budget=None, state_dtype=np.float32, other_dtype=np.float32,
+                min_batch_size=2 ** 6, min_net_dim=2 ** 6, if_print=True) -> dict:
+    """size args.max_memo (and args.batch_size, args.net_dim if they do not fit) to a memory budget,
+    before train_and_evaluate() allocates anything, or raise MemoryError early
+
+    memory_budget: bytes or a str such as '6GB' (args.memory_budget by default). It is the memory of one
+    train_and_evaluate() on host and device together, set it to the smaller one when they are separate.
+    state_dtype, other_dtype: the dtypes of the replay buffer (ReplayBufferCPU and ReplayBufferGPU use float32)
+    The memory that does not scale with max_memo (networks, gradients, optimizer, activations, eval copies) is
+    reduced by halving batch_size, then net_dim, down to the minimums. The rest of the budget goes to the buffer:
+    max_memo is reduced (never increased) to fit, and it must be larger than max_step + batch_size.
+    Return the plan: the bytes of each item, see get_memory_plan()
+    """
+    memory_budget = parse_bytes(args.memory_budget if memory_budget is None else memory_budget)
+    env = args.env
+    if_on_policy = getattr(args.agent_rl, 'if_on_policy', False)  # ReplayBufferCPU
+    net_dim, batch_size, max_memo = args.net_dim, args.batch_size, args.max_memo
+    min_memo = args.max_step + batch_size  # explore_before_train() and AgentPPO.update_buffer() need max_step
+
+    while True:
+        plan = get_memory_plan(args.agent_rl, env.state_dim, env.action_dim, env.if_discrete, if_on_policy,
+                               net_dim, batch_size, max_memo, env, state_dtype, other_dtype, args.checkpoint_gap)
+        free_bytes = memory_budget - plan['fixed']
+        memo_num = int(free_bytes // plan['transition']) if free_bytes > 0 else 0
+        if memo_num >= min(max_memo, min_memo):
+            break
+        if batch_size > min_batch_size:
+            batch_size //= 2
+        elif net_dim > min_net_dim:
+            net_dim //= 2
+        else:
+            print_memory_plan(plan, memory_budget)
+            raise MemoryError(f'| plan_memory: the budget {memory_budget / 2 ** 20:.0f} MB is not enough for '
+                              f'max_memo={min_memo} with net_dim={net_dim}, batch_size={batch_size}')
+
+    if memo_num < max_memo:
+        max_memo = max(memo_num // 2 ** 10 * 2 ** 10, min_memo)  # round down to 1024 transitions
+        plan = get_memory_plan(args.agent_rl, env.state_dim, env.action_dim, env.if_discrete, if_on_policy,
+                               net_dim, batch_size, max_memo, env, state_dtype, other_dtype, args.checkpoint_gap)
+
+    if if_print:
+        for name, value in (('net_dim', net_dim), ('batch_size', batch_size), ('max_memo', max_memo)):
+            if getattr(args, name) != value:
+                print(f'| plan_memory: {name} {getattr(args, name)} -> {value}')
+        print_memory_plan(plan, memory_budget)
+    args.net_dim, args.batch_size, args.max_memo = net_dim, batch_size, max_memo
+    return plan
+
+
+def get_memory_plan(agent_rl, state_dim, action_dim, if_discrete, if_on_policy, net_dim, batch_size, max_memo,
+                    env=None, state_dtype=np.float32, other_dtype=np.float32, checkpoint_gap=0) -> dict:
+    """the bytes of each item of train_and_evaluate(), an estimation before anything is allocated
+
+    buffer: max_memo * transition. A transition is the state and other (reward, mask, action (, noise)) of
+    ReplayBuffer, plus the tensors of the whole buffer in AgentPPO.update_policy() (on-policy), plus the copy
+    of the buffer in get_train_state() (checkpoint_gap)
+    networks, gradients, optimizer: all modules of the agent (with the targets), the gradients and the two
+    moments of Adam for the optimized parameters
+    activations: the outputs of each layer saved for backward, and their gradients, of one batch
+    eval_env: the arrays of env_eval = deepcopy(env), the memory maps are shared
+    snapshots: the copy of act for actor.pth, and the copy of the agent for checkpoint.pth (checkpoint_gap)
+    """
+    buf_action_dim = 1 if if_discrete else action_dim  # the action index of discrete env
+    other_dim = 1 + 1 + buf_action_dim * 2 if if_on_policy else 1 + 1 + buf_action_dim
+    state_bytes = np.dtype(state_dtype).itemsize
+    other_bytes = np.dtype(other_dtype).itemsize
+    transition = state_dim * state_bytes + other_dim * other_bytes
+
+    param_num, optim_num, act_num, hidden_num = get_agent_numel(agent_rl, net_dim, state_dim, action_dim)
+    float_bytes = 4  # float32 of torch.set_default_dtype()
+    plan = {'networks': param_num * float_bytes,
+            'gradients': optim_num * float_bytes,
+            'optimizer': optim_num * 2 * float_bytes,
+            'activations': batch_size * hidden_num * 3 * float_bytes,  # linear, activation, gradient
+            'eval_env': get_env_bytes(env) if env is not None else 0,
+            'snapshots': act_num * float_bytes}
+    if if_on_policy:  # the state and other on device, then buf_r_sum, buf_log_prob, buf_advantage, buf_value
+        transition += (state_dim + other_dim + 4) * float_bytes
+    if checkpoint_gap:  # get_train_state() clones the buffer and the agent
+        transition += state_dim * state_bytes + other_dim * other_bytes
+        plan['snapshots'] += (param_num + optim_num * 2) * float_bytes
+
+    plan['fixed'] = sum(plan.values())
+    plan['transition'] = transition
+    plan['buffer'] = max_memo * transition
+    plan['total'] = plan['fixed'] + plan['buffer']
+    return plan
+
+
+def get_agent_numel(agent_rl, net_dim, state_dim, action_dim, fit_dims=(2 ** 3, 2 ** 4, 2 ** 5)) -> tuple:
+    """(parameters of all modules, optimized parameters, parameters of act, output units of nn.Linear)
+
+    The networks are built at the small fit_dims, and the numbers of net_dim are fitted (a parameter number is
+    quadratic in net_dim, an output unit number is linear), so nothing large is allocated.
+    """
+    numels = list()
+    for fit_dim in fit_dims:
+        agent = agent_rl(fit_dim, state_dim, action_dim)
+        modules = [value for value in vars(agent).values() if isinstance(value, torch.nn.Module)]
+        param_num = sum(param.numel() for module in modules for param in module.parameters())
+        optim_params = {id(param): param for group in agent.optimizer.param_groups for param in group['params']}
+        optim_num = sum(param.numel() for param in optim_params.values())
+        act_num = sum(param.numel() for param in agent.act.parameters())
+        hidden_num = sum(layer.out_features for module in modules for layer in module.modules()
+                         if isinstance(layer, torch.nn.Linear))
+        numels.append((param_num, optim_num, act_num, hidden_num))
+        del agent
+
+    numels = np.array(numels, dtype=np.float64)  # [len(fit_dims), 4]
+    return tuple(int(round(np.polyval(np.polyfit(fit_dims, numels[:, i], deg=2), net_dim))) for i in range(4))
+
+
+def get_env_bytes(env) -> int:  # the arrays of env, except the memory maps shared by its copies
+    env_bytes = 0
+    for value in vars(env).values():
+        if isinstance(value, np.ndarray):
+            base = value
+            while isinstance(base, np.ndarray) and not isinstance(base, np.memmap):
+                base = base.base
+            env_bytes += 0 if isinstance(base, np.memmap) else value.nbytes
+    return env_bytes
+
+
+def parse_bytes(memory) -> int:  # 2 ** 30, '1GB', '512 MB', '1.5G'
+    if isinstance(memory, str):
+        match = re.fullmatch(r'\s*([\d.]+)\s*([KMGT]?)I?B?\s*', memory.upper())
+        assert match, f"| parse_bytes: {memory}, use bytes or a str such as '6GB'"
+        return int(float(match.group(1)) * 2 ** (10 * ' KMGT'.index(match.group(2) or ' ')))
+    return int(memory)
+
+
+def print_memory_plan(plan, memory_budget):
+    names = ('buffer', 'networks', 'gradients', 'optimizer', 'activations', 'eval_env', 'snapshots', 'total')
+    print(f"| {'Memory':<12}  {'MB':>10}  {'Ratio':>6}")
+    for name in names:
+        print(f"| {name:<12}  {plan[name] / 2 ** 20:10.2f}  {plan[name] / memory_budget:6.1%}")
+    print(f"| {'budget':<12}  {memory_budget / 2 ** 20:10.2f}  (bytes per transition: {plan['transition']})")
@@ -0,0 +1,447 @@
+import os
+import gc
+import sys
+import json
+import time
+import tracemalloc
+import torch
+import numpy as np
+from torch.utils._python_dispatch import TorchDispatchMode
+
+TORCH_DIR = os.path.dirname(torch.__file__)
+
+
+class PhaseTimer:
+    """Per-phase timers of the training loop (monotonic clock, aggregated counters)
+
+    instrument() wraps the methods of env, agent, buffer and evaluator, like decorate_env() wraps env.step,
+    so there is no cost at all when the timer is disabled. The phases are nested: update_buffer includes
+    select_actions, env.step and append_memo; update_policy includes sample, backward, optimizer.step
+    and soft_target_update. The events are also kept (up to max_event_num) for a Chrome trace file,
+    see chrome://tracing or https://ui.perfetto.dev
+    """
+
+    def __init__(self, max_event_num=2 ** 20):
+        self.if_enable = False
+        self.max_event_num = max_event_num
+        self.start_time = time.perf_counter()
+        self.totals = dict()  # phase_name: total seconds
+        self.counts = dict()  # phase_name: number of calls
+        self.events = list()  # (phase_name, start, duration), for Chrome trace
+        self.wrapped = list()  # (obj, func_name, func, if_own_attr), to restore the methods
+
+    def add(self, phase_name, start, stop):
+        self.totals[phase_name] = self.totals.get(phase_name, 0.0) + (stop - start)
+        self.counts[phase_name] = self.counts.get(phase_name, 0) + 1
+        if len(self.events) < self.max_event_num:
+            self.events.append((phase_name, start, stop - start))
+
+    def wrap(self, obj, func_name, phase_name):
+        func = getattr(obj, func_name, None)
+        if func is None:
+            return
+
+        def new_func(*args, **kwargs):
+            start = time.perf_counter()
+            output = func(*args, **kwargs)
+            self.add(phase_name, start, time.perf_counter())
+            return output
+
+        if_own_attr = func_name in vars(obj)  # instance attribute, such as env.step after decorate_env()
+        setattr(obj, func_name, new_func)
+        self.wrapped.append((obj, func_name, func, if_own_attr))
+
+    def instrument(self, env=None, agent=None, buffer=None, evaluator=None):
+        self.if_enable = True
+        self.start_time = time.perf_counter()
+        self.totals.clear()
+        self.counts.clear()
+        self.events.clear()
+
+        for obj, func_name, phase_name in get_phase_methods(env, agent, buffer, evaluator):
+            self.wrap(obj, func_name, phase_name)
+
+    def close(self, cwd=None):
+        if not self.if_enable:
+            return
+        for obj, func_name, func, if_own_attr in reversed(self.wrapped):
+            if if_own_attr or isinstance(obj, type) or type(obj).__name__ == 'module':
+                setattr(obj, func_name, func)
+            else:
+                delattr(obj, func_name)  # the method of the class comes back
+        self.wrapped.clear()
+        self.if_enable = False
+
+        print(self.get_summary())
+        if cwd is not None:
+            self.save_chrome_trace(f'{cwd}/trace.json')
+
+    def get_summary(self):
+        used_time = time.perf_counter() - self.start_time
+        lines = [f"| {'Phase':<20}  {'Time(s)':>9}  {'Ratio':>6}  {'Count':>9}  {'Avg(us)':>9}"]
+        for phase_name, total in sorted(self.totals.items(), key=lambda item: -item[1]):
+            count = self.counts[phase_name]
+            lines.append(f"| {phase_name:<20}  {total:9.2f}  {total / used_time:6.1%}  {count:9}  "
+                         f"{total / count * 1e6:9.1f}")
+        return '\n'.join(lines)
+
+    def save_chrome_trace(self, trace_path):
+        pid = os.getpid()
+        trace_events = [{'name': phase_name, 'ph': 'X', 'pid': pid, 'tid': 0,
+                         'ts': (start - self.start_time) * 1e6, 'dur': duration * 1e6}
+                        for phase_name, start, duration in self.events]
+        with open(trace_path, 'w') as f:
+            json.dump({'traceEvents': trace_events, 'displayTimeUnit': 'ms'}, f)
+        print(f'| Save Chrome trace ({len(trace_events)} events) in: {trace_path}')
+
+
+def get_phase_methods(env=None, agent=None, buffer=None, evaluator=None) -> list:
+    """the methods of the training loop to wrap, (obj, func_name, phase_name), for PhaseTimer and AllocTracker"""
+    methods = list()
+    if env is not None:
+        methods.extend(((env, 'step', 'env.step'), (env, 'reset', 'env.reset')))
+    if agent is not None:
+        methods.extend(((agent, 'update_buffer', 'update_buffer'),
+                        (agent, 'update_policy', 'update_policy'),
+                        (agent, 'select_actions', 'select_actions'),
+                        (agent.optimizer, 'step', 'optimizer.step'),
+                        (sys.modules[type(agent).__module__], 'soft_target_update', 'soft_target_update')))
+    if buffer is not None:
+        methods.extend(((buffer, 'append_memo', 'append_memo'),
+                        (buffer, 'random_sample', 'sample'),
+                        (buffer, 'sample_for_ppo', 'sample')))
+    if evaluator is not None:
+        methods.append((evaluator, 'evaluate_and_save', 'evaluate_and_save'))
+    methods.append((torch.Tensor, 'backward', 'backward'))
+    return methods
+
+
+timer = PhaseTimer()  # the timer shared by train_and_evaluate(), Evaluator and the agents
+
+
+class AllocTracker:
+    """allocations, bytes, gc pauses and peak RSS of each phase of the training loop (the phases of PhaseTimer)
+
+    torch: a TorchDispatchMode counts the tensors each op allocates (the outputs on a new storage, not the views
+    and in-place outputs) and their bytes, by phase and by site (the op and the line of its caller outside torch).
+    Python and NumPy: tracemalloc gives the bytes retained by a phase (net) and its transient peak (above the start
+    of the phase), and at the end of each round (evaluator.evaluate_and_save) the top sites of the memory growth
+    since the last round. gc: the number and seconds of the collections in each phase. RSS: the peak RSS read at
+    the end of each phase. An allocation belongs to the innermost phase (the outer phases do not include it).
+    It is slow (tracemalloc and a Python call per torch op, about 8 times slower for SAC with net_dim=2**7),
+    a mode to find the allocations, not to measure speed, and the gc counts include its own Python objects.
+    Nothing is wrapped when it is disabled. The top sites of each round are appended to cwd/alloc.log
+    """
+
+    def __init__(self, top_num=2 ** 3, nframe=1):
+        self.if_enable = False
+        self.top_num = top_num  # the number of top sites of each round
+        self.nframe = nframe  # the frames of each traceback of tracemalloc
+        self.stats = dict()  # phase_name: dict of calls, tensor_num, tensor_bytes, net_bytes, peak_bytes, ...
+        self.stack = list()  # [phase_name, traced memory at the start, peak traced memory], the innermost last
+        self.round_sites = dict()  # (op_name, file:line): [tensor_num, tensor_bytes], of this round
+        self.round_num = 0
+        self.snapshot = None  # tracemalloc snapshot at the end of the last round
+        self.gc_start = 0.0
+        self.mode = None
+        self.log_file = None
+        self.wrapped = list()  # (obj, func_name, func, if_own_attr), to restore the methods
+
+    def get_stat(self, phase_name) -> dict:
+        stat = self.stats.get(phase_name)
+        if stat is None:
+            stat = self.stats[phase_name] = {'calls': 0, 'tensor_num': 0, 'tensor_bytes': 0, 'net_bytes': 0,
+                                             'peak_bytes': 0, 'gc_num': 0, 'gc_time': 0.0, 'rss_peak': 0}
+        return stat
+
+    def enter(self, phase_name):
+        current, peak = tracemalloc.get_traced_memory()
+        if self.stack:  # reset_peak() below, so keep the peak of the outer phase
+            self.stack[-1][2] = max(self.stack[-1][2], peak)
+        tracemalloc.reset_peak()
+        self.stack.append([phase_name, current, current])
+
+    def exit(self):
+        phase_name, start_current, start_peak = self.stack.pop()
+        current, peak = tracemalloc.get_traced_memory()
+        peak = max(start_peak, peak)
+        if self.stack:
+            self.stack[-1][2] = max(self.stack[-1][2], peak)
+
+        stat = self.get_stat(phase_name)
+        stat['calls'] += 1
+        stat['net_bytes'] += current - start_current
+        stat['peak_bytes'] = max(stat['peak_bytes'], peak - start_current)
+        stat['rss_peak'] = max(stat['rss_peak'], get_resident_memory_bytes())
+
+    def wrap(self, obj, func_name, phase_name, if_round_end=False):
+        func = getattr(obj, func_name, None)
+        if func is None:
+            return
+
+        def new_func(*args, **kwargs):
+            self.enter(phase_name)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.exit()
+                self.end_round() if if_round_end else None
+
+        if_own_attr = func_name in vars(obj)
+        setattr(obj, func_name, new_func)
+        self.wrapped.append((obj, func_name, func, if_own_attr))
+
+    def add_tensor(self, op_name, nbytes):
+        phase_name = self.stack[-1][0] if self.stack else 'other'
+        stat = self.get_stat(phase_name)
+        stat['tensor_num'] += 1
+        stat['tensor_bytes'] += nbytes
+
+        frame = sys._getframe(2)  # the caller of the op, outside torch and this file
+        while frame is not None and (frame.f_code.co_filename.startswith(TORCH_DIR)
+                                     or frame.f_code.co_filename == __file__):
+            frame = frame.f_back
+        site = (op_name, 'unknown' if frame is None
+                else f'{os.path.basename(frame.f_code.co_filename)}:{frame.f_lineno}')
+        site_stat = self.round_sites.get(site)
+        if site_stat is None:
+            site_stat = self.round_sites[site] = [0, 0]
+        site_stat[0] += 1
+        site_stat[1] += nbytes
+
+    def on_gc(self, phase, _info):
+        if phase == 'start':
+            self.gc_start = time.perf_counter()
+            return
+        stat = self.get_stat(self.stack[-1][0] if self.stack else 'other')
+        stat['gc_num'] += 1
+        stat['gc_time'] += time.perf_counter() - self.gc_start
+
+    def instrument(self, cwd, env=None, agent=None, buffer=None, evaluator=None):
+        self.if_enable = True
+        self.stats.clear()
+        self.stack.clear()
+        self.round_sites.clear()
+        self.round_num = 0
+
+        tracemalloc.start(self.nframe)
+        self.snapshot = self.take_snapshot()
+        gc.callbacks.append(self.on_gc)
+        self.mode = AllocDispatchMode(self)
+        self.mode.__enter__()  # on the training thread only, the dispatch modes are thread local
+        self.log_file = open(f'{cwd}/alloc.log', 'w')
+
+        for obj, func_name, phase_name in get_phase_methods(env, agent, buffer, evaluator):
+            self.wrap(obj, func_name, phase_name, if_round_end=func_name == 'evaluate_and_save')
+
+    def take_snapshot(self):
+        return tracemalloc.take_snapshot().filter_traces((tracemalloc.Filter(False, tracemalloc.__file__),
+                                                          tracemalloc.Filter(False, __file__)))
+
+    def end_round(self):
+        self.round_num += 1
+        snapshot = self.take_snapshot()
+        growths = snapshot.compare_to(self.snapshot, 'lineno')[:self.top_num]
+        self.snapshot = snapshot
+        sites = sorted(self.round_sites.items(), key=lambda item: -item[1][1])[:self.top_num]
+        self.round_sites.clear()
+
+        lines = [f'| Round {self.round_num}, RSS {get_resident_memory_bytes() / 2 ** 20:.1f} MB',
+                 f"| {'torch op':<28}  {'Site':<28}  {'Tensors':>9}  {'MB':>9}"]
+        lines.extend(f'| {op_name:<28}  {site:<28}  {num:9}  {nbytes / 2 ** 20:9.3f}'
+                     for (op_name, site), (num, nbytes) in sites)
+        lines.append(f"| {'tracemalloc growth':<58}  {'Blocks':>9}  {'MB':>9}")
+        lines.extend(f'| {str(stat.traceback):<58}  {stat.count_diff:9}  {stat.size_diff / 2 ** 20:9.3f}'
+                     for stat in growths)
+        self.log_file.write('\n'.join(lines) + '\n')
+
+    def get_summary(self):
+        lines = [f"| {'Phase':<20}  {'Calls':>9}  {'Tensors':>9}  {'TensorMB':>9}  {'NetMB':>8}  {'PeakMB':>8}  "
+                 f"{'GC':>6}  {'GC(s)':>7}  {'PeakRSS':>8}"]
+        for phase_name, stat in sorted(self.stats.items(), key=lambda item: -item[1]['tensor_bytes']):
+            lines.append(f"| {phase_name:<20}  {stat['calls']:9}  {stat['tensor_num']:9}  "
+                         f"{stat['tensor_bytes'] / 2 ** 20:9.1f}  {stat['net_bytes'] / 2 ** 20:8.2f}  "
+                         f"{stat['peak_bytes'] / 2 ** 20:8.2f}  {stat['gc_num']:6}  {stat['gc_time']:7.3f}  "
+                         f"{stat['rss_peak'] / 2 ** 20:6.0f}MB")
+        return '\n'.join(lines)
+
+    def close(self, cwd=None):
+        if not self.if_enable:
+            return
+        for obj, func_name, func, if_own_attr in reversed(self.wrapped):
+            if if_own_attr or isinstance(obj, type) or type(obj).__name__ == 'module':
+                setattr(obj, func_name, func)
+            else:
+                delattr(obj, func_name)  # the method of the class comes back
+        self.wrapped.clear()
+        self.mode.__exit__(None, None, None)
+        gc.callbacks.remove(self.on_gc)
+        tracemalloc.stop()
+        self.log_file.close()
+        self.if_enable = False
+
+        print(self.get_summary())
+        print(f'| Save the top allocation sites of {self.round_num} rounds in: {cwd}/alloc.log')
+
+
+class AllocDispatchMode(TorchDispatchMode):  # the tensors allocated by each torch op, for AllocTracker
+    def __init__(self, tracker):
+        super().__init__()
+        self.tracker = tracker
+
+    def __torch_dispatch__(self, func, types, args=(), kwargs=None):
+        output = func(*args, **(kwargs or {}))
+        outputs = output if isinstance(output, (tuple, list)) else (output,)
+        if not any(isinstance(tensor, torch.Tensor) for tensor in outputs):
+            return output
+
+        storages = set()  # the storages of the inputs, the views and in-place outputs are not allocations
+        for arg in (*args, *kwargs.values()) if kwargs else args:
+            for tensor in (arg if isinstance(arg, (tuple, list)) else (arg,)):
+                if isinstance(tensor, torch.Tensor):
+                    storages.add(tensor.untyped_storage().data_ptr())
+        for tensor in outputs:
+            if isinstance(tensor, torch.Tensor):
+                storage = tensor.untyped_storage()
+                if storage.data_ptr() not in storages and storage.nbytes():
+                    self.tracker.add_tensor(func.__name__, storage.nbytes())
+        return output
+
+
+def get_resident_memory_bytes() -> int:
+    try:
+        with open('/proc/self/statm') as f:  # Linux: size resident shared ... (pages)
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        import resource  # the peak resident size on other systems (bytes on macOS)
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def measure(func, min_time=0.02, repeat=5) -> float:  # seconds per call, the median of repeats
+    func()  # warm up
+    number = 1
+    while True:  # calibrate the number of calls in one measurement
+        start_time = time.perf_counter()
+        for _ in range(number):
+            func()
+        if time.perf_counter() - start_time > min_time:
+            break
+        number *= 2
+
+    used_times = list()
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        for _ in range(number):
+            func()
+        used_times.append((time.perf_counter() - start_time) / number)
+    return float(np.median(used_times))
+
+
+alloc_tracker = AllocTracker()  # shared by train_and_evaluate() and Evaluator, like timer
+
+
+class OpProfiler:
+    """torch.profiler (operator level) on a window of gradient updates: the iterations [beg_iter, end_iter)
+    of the round_id-th call of agent.update_policy() (1 is the first, the pre-training update of off-policy counts)
+
+    An iteration is a call of agent.optimizer.step(), every agent of Agent.py and AgentZoo.py has one optimizer.
+    Before the round, only agent.update_policy is wrapped (one counter per round). In the round, optimizer.step
+    is wrapped to count the iterations, and all wrappers are removed after the round, so there is no overhead
+    outside the window. The shapes and memory are recorded. Save a Chrome trace in cwd/op_trace.json and the
+    top ops (by self time and by memory, grouped by input shapes) in cwd/op_summary.txt
+    The dispatch mode of AllocTracker (if_alloc) is suspended in the window, or each op would have a row of it,
+    so AllocTracker does not count the tensors of the window.
+    """
+
+    def __init__(self, round_id=3, beg_iter=100, end_iter=200, row_limit=2 ** 5):
+        self.round_id = round_id
+        self.beg_iter = beg_iter
+        self.end_iter = end_iter
+        self.row_limit = row_limit
+        self.round_num = 0
+        self.iter_num = 0
+        self.cwd = None
+        self.prof = None
+        self.if_done = False
+        self.if_alloc_paused = False  # the dispatch mode of alloc_tracker is suspended in the window
+        self.wrapped = list()  # (obj, func_name, func, if_own_attr), to restore the methods
+
+    def wrap(self, obj, func_name, new_func):
+        self.wrapped.append((obj, func_name, getattr(obj, func_name), func_name in vars(obj)))
+        setattr(obj, func_name, new_func)
+
+    def restore(self):
+        for obj, func_name, func, if_own_attr in reversed(self.wrapped):
+            if if_own_attr:  # such as the wrapper of PhaseTimer
+                setattr(obj, func_name, func)
+            else:
+                delattr(obj, func_name)  # the method of the class comes back
+        self.wrapped.clear()
+
+    def instrument(self, agent, cwd):
+        self.cwd = cwd
+        update_policy = agent.update_policy
+
+        def new_update_policy(*args, **kwargs):
+            self.round_num += 1
+            if self.round_num != self.round_id:
+                return update_policy(*args, **kwargs)
+
+            step = agent.optimizer.step  # the wrappers of PhaseTimer or LiveMetrics are called as well
+
+            def new_step(*step_args, **step_kwargs):
+                output = step(*step_args, **step_kwargs)
+                self.iter_num += 1
+                if self.iter_num == self.beg_iter:
+                    self.start()
+                elif self.iter_num == self.end_iter:
+                    self.stop()
+                return output
+
+            self.wrap(agent.optimizer, 'step', new_step)
+            self.start() if self.beg_iter == 0 else None
+            try:
+                return update_policy(*args, **kwargs)
+            finally:
+                self.stop()  # the round has less than end_iter iterations
+                self.restore()
+
+        self.wrap(agent, 'update_policy', new_update_policy)
+
+    def start(self):
+        from torch.profiler import profile, ProfilerActivity
+        activities = [ProfilerActivity.CPU] + ([ProfilerActivity.CUDA] if torch.cuda.is_available() else [])
+        if alloc_tracker.if_enable:
+            alloc_tracker.mode.__exit__(None, None, None)
+            self.if_alloc_paused = True
+        self.prof = profile(activities=activities, record_shapes=True, profile_memory=True)
+        self.prof.start()
+
+    def stop(self):
+        if self.prof is None:
+            return
+        self.prof.stop()
+        prof = self.prof
+        self.prof = None
+        self.if_done = True
+        if self.if_alloc_paused:
+            alloc_tracker.mode.__enter__()
+            self.if_alloc_paused = False
+
+        sort_by = 'self_cuda_time_total' if torch.cuda.is_available() else 'self_cpu_time_total'
+        averages = prof.key_averages(group_by_input_shape=True)
+        summary = (f'| OpProfiler: round {self.round_id}, iterations [{self.beg_iter}, '
+                   f'{min(self.iter_num, self.end_iter)})\n'
+                   f'{averages.table(sort_by=sort_by, row_limit=self.row_limit)}\n'
+                   f'{averages.table(sort_by="self_cpu_memory_usage", row_limit=self.row_limit)}\n')
+        with open(f'{self.cwd}/op_summary.txt', 'w') as f:
+            f.write(summary)
+        prof.export_chrome_trace(f'{self.cwd}/op_trace.json')
+        print(f"{averages.table(sort_by=sort_by, row_limit=self.row_limit // 4)}\n"
+              f"| Save the op summary and Chrome trace in: {self.cwd}/op_summary.txt, {self.cwd}/op_trace.json")
+
+    def close(self):
+        self.stop()
+        self.restore()
+        if not self.if_done:
+            print(f'| OpProfiler: training stops before round {self.round_id}, iteration {self.beg_iter}')
@@ -0,0 +1,188 @@
+"""End-to-end time-to-target benchmark harness
+
+python3 TimeToTarget.py run ./time_to_target_new.json [gym]
+python3 TimeToTarget.py compare ./time_to_target_old.json ./time_to_target_new.json
+Each agent in Agent.py and BetaWarning/AgentZoo.py is trained on a fixed set of CPU-only envs (the synthetic
+envs of Env.py by default, the gym envs of get_gym_env_funcs() with the `gym` argument) for
+`seed_num` seeds (Launcher.launch_runs, one pinned core per run). Steps-to-target, wall-time-to-target
+and steps/s of each run are saved in JSON. Comparing the JSON files of two code versions gives the
+median, IQR and a bootstrap confidence interval of the ratio of medians, for each agent and env.
+"""
+import os
+import sys
+import json
+import time
+import numpy as np
+
+DISCRETE_AGENTS = {'AgentDQN', 'AgentDoubleDQN', 'AgentD3QN'}
+
+
+def get_default_agents():
+    import Agent
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'BetaWarning'))
+    import AgentZoo  # AgentZoo imports AgentNet from BetaWarning/
+    return [Agent.AgentDQN, Agent.AgentDoubleDQN, Agent.AgentDDPG, Agent.AgentTD3, Agent.AgentPPO, Agent.AgentSharedPPO,
+            Agent.AgentSAC, AgentZoo.AgentDQN, AgentZoo.AgentDoubleDQN, AgentZoo.AgentD3QN, AgentZoo.AgentDDPG,
+            AgentZoo.AgentTD3, AgentZoo.AgentPPO, AgentZoo.AgentGaePPO, AgentZoo.AgentSharedGaePPO, AgentZoo.AgentSAC,
+            AgentZoo.AgentModSAC]
+
+
+def get_default_env_funcs():  # {env_name: a function that builds the env}, pure NumPy, no gym
+    from Env import LQREnv, ChainMDPEnv, PointMassEnv
+
+    def make_chain_mdp():
+        return ChainMDPEnv(state_dim=2 ** 4)  # a shorter chain than the default, so that DQN reaches the end
+
+    def make_point_mass():
+        return PointMassEnv(action_dim=2 ** 3)
+
+    return {'LQR-v0': LQREnv, 'ChainMDP-v0': make_chain_mdp, 'PointMass-v0': make_point_mass}
+
+
+def get_gym_env_funcs():  # opt-in, gym and its envs must be installed
+    import gym
+    from Env import decorate_env
+
+    def make_cart_pole():
+        return decorate_env(gym.make('CartPole-v0'), if_print=False)
+
+    def make_pendulum():
+        env = decorate_env(gym.make('Pendulum-v0'), if_print=False)
+        env.target_reward = -200  # env.spec.reward_threshold is None
+        return env
+
+    return {'CartPole-v0': make_cart_pole, 'Pendulum-v0': make_pendulum}
+
+
+def run__time_to_target(json_path='./time_to_target.json', agent_rls=None, env_funcs=None, seed_num=5,
+                        break_step=2 ** 17, cpus_per_run=1):
+    from Main import Arguments
+    from Launcher import launch_runs
+    agent_rls = get_default_agents() if agent_rls is None else agent_rls
+    env_funcs = get_default_env_funcs() if env_funcs is None else env_funcs
+
+    args_list = list()
+    labels = list()
+    for agent_rl in agent_rls:
+        agent_name = f'{agent_rl.__module__}.{agent_rl.__name__}'
+        for env_name, env_func in env_funcs.items():
+            for random_seed in range(seed_num):
+                env = env_func()
+                if env.if_discrete != (agent_rl.__name__ in DISCRETE_AGENTS):
+                    break
+
+                args = Arguments(agent_rl, env, gpu_id=0, if_on_policy=getattr(agent_rl, 'if_on_policy', False))
+                args.random_seed = random_seed
+                args.break_step = break_step
+                args.if_break_early = True  # stop a solved run, its core goes to the next run
+                args.show_gap = 2 ** 16
+                args.cwd = f'./time_to_target/{agent_name}/{env_name}_{random_seed}'
+                args_list.append(args)
+                labels.append((agent_name, env_name, random_seed, env.target_reward))
+
+    summary = launch_runs(args_list, cpus_per_run)
+
+    records = list()
+    for run, (agent_name, env_name, random_seed, target_reward) in zip(summary, labels):
+        metrics = run['metrics']
+        if_solve = bool(len(metrics)) and bool(metrics['r_avg'].max() > target_reward)
+        if if_solve:
+            solve_idx = int(np.argmax(metrics['r_avg'] > target_reward))
+            step_to_target = float(metrics['total_step'][solve_idx])
+            time_to_target = float(metrics['used_time'][solve_idx])  # the first evaluation above the target
+        else:  # censored by break_step
+            step_to_target = time_to_target = float('inf')
+        records.append({'agent': agent_name, 'env': env_name, 'seed': random_seed, 'if_solve': if_solve,
+                        'step_to_target': step_to_target, 'time_to_target': time_to_target,
+                        'step_per_sec': run['step_per_sec'], 'error': run['error']})
+
+    meta = {'time': time.strftime('%Y-%m-%d %H:%M:%S'), 'git_commit': get_git_commit(),
+            'seed_num': seed_num, 'break_step': break_step}
+    with open(json_path, 'w') as f:
+        json.dump({'meta': meta, 'records': records}, f, indent=1)  # inf is saved as Infinity
+    print(f'| Save time-to-target results in: {json_path}')
+    return records
+
+
+def get_git_commit():
+    import subprocess
+    try:
+        return subprocess.check_output(('git', 'rev-parse', '--short', 'HEAD'), stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+'''statistics'''
+
+
+def get_median_iqr(values):
+    q1, median, q3 = np.percentile(values, (25, 50, 75))
+    return median, q3 - q1
+
+
+def bootstrap_ratio_ci(values_a, values_b, boot_num=2000, alpha=0.05, seed=0):
+    """the confidence interval of median(values_b) / median(values_a), by bootstrap resampling"""
+    rng = np.random.default_rng(seed)
+    values_a = np.asarray(values_a, dtype=np.float64)
+    values_b = np.asarray(values_b, dtype=np.float64)
+    medians_a = np.median(rng.choice(values_a, size=(boot_num, len(values_a))), axis=1)
+    medians_b = np.median(rng.choice(values_b, size=(boot_num, len(values_b))), axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):  # inf: a run not solved
+        ratios = medians_b / medians_a
+    ratios = ratios[~np.isnan(ratios)]
+    if len(ratios) == 0:
+        return float('nan'), float('nan')
+    low, high = np.percentile(ratios, (alpha / 2 * 100, (1 - alpha / 2) * 100))
+    return low, high
+
+
+def compare_time_to_target(json_path_a, json_path_b, boot_num=2000):
+    """compare two code versions (A: old, B: new). A regression: the CI of the ratio B/A is
+    above 1 for step_to_target and time_to_target, or below 1 for step_per_sec"""
+    with open(json_path_a, 'r') as f:
+        result_a = json.load(f)
+    with open(json_path_b, 'r') as f:
+        result_b = json.load(f)
+    print(f"| A: {json_path_a} ({result_a['meta']['git_commit']})  B: {json_path_b} ({result_b['meta']['git_commit']})")
+
+    groups = dict()
+    for version, result in (('a', result_a), ('b', result_b)):
+        for record in result['records']:
+            group = groups.setdefault((record['agent'], record['env']), {'a': list(), 'b': list()})
+            group[version].append(record)
+
+    regressions = list()
+    print(f"| {'Agent':<24}  {'Env':<14}  {'Metric':<14}  {'A median':>9}  {'A IQR':>9}  "
+          f"{'B median':>9}  {'B IQR':>9}  {'B/A':>6}  {'CI':>15}  {'Solve':>7}")
+    for (agent_name, env_name), group in sorted(groups.items()):
+        if not (group['a'] and group['b']):
+            continue
+        solve_a = sum(record['if_solve'] for record in group['a'])
+        solve_b = sum(record['if_solve'] for record in group['b'])
+
+        for metric, if_lower_better in (('step_to_target', True), ('time_to_target', True),
+                                        ('step_per_sec', False)):
+            values_a = [record[metric] for record in group['a']]
+            values_b = [record[metric] for record in group['b']]
+            median_a, iqr_a = get_median_iqr(values_a)
+            median_b, iqr_b = get_median_iqr(values_b)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                ratio = np.float64(median_b) / np.float64(median_a)
+            low, high = bootstrap_ratio_ci(values_a, values_b, boot_num)
+
+            if_regress = low > 1 if if_lower_better else high < 1
+            if if_regress:
+                regressions.append((agent_name, env_name, metric))
+            print(f"| {agent_name:<24}  {env_name:<14}  {metric:<14}  {median_a:9.3g}  {iqr_a:9.3g}  "
+                  f"{median_b:9.3g}  {iqr_b:9.3g}  {ratio:6.2f}  [{low:6.2f}, {high:6.2f}]  "
+                  f"{solve_a:>3}/{solve_b:<3}" + ('  REGRESSION' if if_regress else ''))
+    print(f'| Regressions: {len(regressions)}')
+    return regressions
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'compare':
+        sys.exit(1 if compare_time_to_target(sys.argv[2], sys.argv[3]) else 0)
+    run__time_to_target(json_path=sys.argv[2] if len(sys.argv) > 2 else './time_to_target.json',
+                        env_funcs=get_gym_env_funcs() if sys.argv[3:4] == ['gym'] else None)